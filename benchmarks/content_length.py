@@ -0,0 +1,62 @@
+"""
+Compare the bytes sent, the writes to the transport and the cost of
+rendering responses returned in full, which are sent with a Content-Length,
+against the same bodies written by the endpoint itself, which are chunked.
+
+Run with::
+
+    python benchmarks/content_length.py
+"""
+from klein import Klein
+
+from util import makeRequest, timeRender
+
+
+SIZES = [16, 1024, 64 * 1024]
+
+
+def makeApp():
+    app = Klein()
+
+    @app.route("/returned/<int:size>")
+    def returned(request, size):
+        return "x" * size
+
+    @app.route("/written/<int:size>")
+    def written(request, size):
+        request.write("x" * size)
+
+    return app
+
+
+def onTheWire(resource, path):
+    """
+    Render one request for C{path} and return the number of bytes written to
+    its transport and the number of calls which wrote them.
+    """
+    request = makeRequest(path)
+    transport = request.channel.transport
+    calls = []
+    write = transport.write
+    transport.write = lambda data: (calls.append(data), write(data))
+    transport.writeSequence = lambda seq: (calls.append(seq),
+                                           write("".join(seq)))
+    resource.render(request)
+    return len(transport.written.getvalue()), len(calls)
+
+
+def main():
+    resource = makeApp().resource()
+    print("%-18s %8s %7s %12s %10s" % (
+        "path", "bytes", "writes", "us/request", "MB/s"))
+    for size in SIZES:
+        for kind in ["returned", "written"]:
+            path = "/%s/%d" % (kind, size)
+            sent, calls = onTheWire(resource, path)
+            seconds = timeRender(resource, path, number=2000)
+            print("%-18s %8d %7d %12.2f %10.1f" % (
+                path, sent, calls, seconds * 1e6, sent / seconds / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Measure the cost of rendering a request which isn't found when the
+application has 20 error handlers, the last of which handles C{NotFound}.
+
+Run with::
+
+    python benchmarks/error_handlers.py
+"""
+from werkzeug.exceptions import NotFound
+
+from klein import Klein
+
+from util import timeRender
+
+
+def makeApp(handlers=20):
+    app = Klein()
+
+    @app.route("/")
+    def root(request):
+        return "root"
+
+    for i in range(handlers - 1):
+        exceptionType = type("Error%d" % (i,), (Exception,), {})
+        app.handle_errors(exceptionType)(lambda request, failure: None)
+
+    @app.handle_errors(NotFound)
+    def notFound(request, failure):
+        request.setResponseCode(404)
+        return "Not found"
+
+    return app
+
+
+def main():
+    resource = makeApp().resource()
+    print("404 with 20 error handlers: %.2f us/request" % (
+        timeRender(resource, "/missing") * 1e6,))
+
+
+if __name__ == "__main__":
+    main()
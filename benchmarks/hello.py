@@ -0,0 +1,40 @@
+"""
+Measure the cost of rendering requests for endpoints which return their
+response body straight away and which return a L{Deferred}.
+
+Run with::
+
+    python benchmarks/hello.py
+"""
+import json
+
+from twisted.internet.defer import succeed
+
+from klein import Klein
+
+from util import timeRender
+
+
+def makeApp():
+    app = Klein()
+
+    @app.route("/hello")
+    def hello(request):
+        return json.dumps({"hello": "world"})
+
+    @app.route("/deferred")
+    def deferred(request):
+        return succeed(json.dumps({"hello": "world"}))
+
+    return app
+
+
+def main():
+    resource = makeApp().resource()
+    for path in ["/hello", "/deferred"]:
+        print("%-10s %.2f us/request" % (
+            path, timeRender(resource, path) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
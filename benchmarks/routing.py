@@ -0,0 +1,58 @@
+"""
+Compare the cost of matching a request with werkzeug and with
+L{klein.routing.CompiledRouter} for routing tables of various sizes.
+
+Run with::
+
+    python benchmarks/routing.py
+"""
+import timeit
+
+from werkzeug.routing import Map, Rule
+
+from klein.routing import CompiledRouter
+
+
+def buildMap(count):
+    """
+    Build a L{Map} of C{count} rules, half static and half with converters,
+    and return it with a list of paths which match rules spread through it.
+    """
+    url_map = Map()
+    paths = []
+    for i in range(count // 2):
+        url_map.add(Rule("/static%d/page" % (i,), endpoint="s%d" % (i,)))
+        url_map.add(Rule("/dynamic%d/<int:id>/<name>" % (i,),
+                         endpoint="d%d" % (i,)))
+        if i % max(1, count // 20) == 0:
+            paths.append("/static%d/page" % (i,))
+            paths.append("/dynamic%d/42/foo" % (i,))
+    return url_map, paths
+
+
+def main(number=2000):
+    print("%8s %14s %14s %8s" % ("routes", "werkzeug us", "compiled us",
+                                 "speedup"))
+    for count in (10, 100, 1000):
+        url_map, paths = buildMap(count)
+        adapter = url_map.bind("localhost")
+        router = CompiledRouter(url_map)
+        router.compile()
+
+        def werkzeug():
+            for path in paths:
+                adapter.match(path, "GET", return_rule=True)
+
+        def compiled():
+            for path in paths:
+                router.match(path, "GET")
+
+        calls = number * len(paths)
+        slow = min(timeit.repeat(werkzeug, number=number, repeat=3)) / calls
+        fast = min(timeit.repeat(compiled, number=number, repeat=3)) / calls
+        print("%8d %14.2f %14.2f %7.1fx" % (count, slow * 1e6, fast * 1e6,
+                                           slow / fast))
+
+
+if __name__ == "__main__":
+    main()
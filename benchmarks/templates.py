@@ -0,0 +1,41 @@
+"""
+Measure the cost of rendering the test suite's C{SimpleElement} 10000
+times, flattening it for every request and writing it from a
+L{klein.templates.FragmentCache}.
+
+Run with::
+
+    python benchmarks/templates.py
+"""
+from klein import Klein
+from klein.templates import CachedFragment, FragmentCache
+from klein.test_resource import SimpleElement
+
+from util import timeRender
+
+
+def makeApp():
+    app = Klein()
+    fragments = FragmentCache()
+
+    @app.route("/element/<name>")
+    def element(request, name):
+        return SimpleElement(name)
+
+    @app.route("/cached/<name>")
+    def cached(request, name):
+        return CachedFragment(("simple", name), lambda: SimpleElement(name),
+                              ttl=60, cache=fragments)
+
+    return app
+
+
+def main():
+    resource = makeApp().resource()
+    for path in ["/element/foo", "/cached/foo"]:
+        print("%-14s %.2f us/request" % (
+            path, timeRender(resource, path, number=10000) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
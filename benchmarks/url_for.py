@@ -0,0 +1,61 @@
+"""
+Compare the cost of building URLs with werkzeug and with
+L{klein.routing.AdapterCache.build} for routing tables of various sizes.
+
+Run with::
+
+    python benchmarks/url_for.py
+"""
+import timeit
+
+from werkzeug.routing import Map, Rule
+
+from klein.routing import AdapterCache
+
+
+def buildMap(count):
+    """
+    Build a L{Map} of C{count} rules, each endpoint having a few rules, and
+    return it with a list of C{(endpoint, values)} to build URLs for.
+    """
+    url_map = Map()
+    links = []
+    for i in range(count // 4):
+        endpoint = "e%d" % (i,)
+        url_map.add(Rule("/e%d/" % (i,), endpoint=endpoint))
+        url_map.add(Rule("/e%d/<int:id>" % (i,), endpoint=endpoint))
+        url_map.add(Rule("/e%d/<int:id>/<name>" % (i,), endpoint=endpoint))
+        url_map.add(Rule("/e%d/<int:id>/<name>/edit" % (i,),
+                         endpoint=endpoint, methods=["POST"]))
+        if i % max(1, count // 40) == 0:
+            links.append((endpoint, {"id": 42, "name": "foo"}))
+            links.append((endpoint, {}))
+    return url_map, links
+
+
+def main(number=2000):
+    print("%8s %14s %14s %8s" % ("routes", "werkzeug us", "cached us",
+                                 "speedup"))
+    bind_args = ("localhost", "/", "http", "GET")
+    for count in (10, 100, 1000):
+        url_map, links = buildMap(count)
+        adapters = AdapterCache(url_map)
+        adapter = adapters.bind(*bind_args)
+
+        def werkzeug():
+            for endpoint, values in links:
+                adapter.build(endpoint, values)
+
+        def cached():
+            for endpoint, values in links:
+                adapters.build(bind_args, endpoint, values)
+
+        calls = number * len(links)
+        slow = min(timeit.repeat(werkzeug, number=number, repeat=3)) / calls
+        fast = min(timeit.repeat(cached, number=number, repeat=3)) / calls
+        print("%8d %14.2f %14.2f %7.1fx" % (count, slow * 1e6, fast * 1e6,
+                                           slow / fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Helpers for rendering requests through a L{KleinResource} outside of a
+reactor.
+"""
+import timeit
+
+from StringIO import StringIO
+
+from twisted.web import server
+from twisted.web.test.test_web import DummyChannel
+
+
+def makeRequest(path, method="GET", host="localhost", port=8080,
+                headers=None):
+    """
+    Make a L{server.Request} for C{path} on a channel which records what is
+    written to it in C{request.channel.transport.written}.
+    """
+    request = server.Request(DummyChannel(), False)
+    request.content = StringIO()
+    request.method = method
+    request.uri = request.path = path
+    request.clientproto = "HTTP/1.1"
+    request.setHost(host, port)
+    request.prepath = []
+    request.postpath = path.split("/")[1:]
+    for name, value in (headers or {}).items():
+        request.requestHeaders.setRawHeaders(name, [value])
+    return request
+
+
+def timeRender(resource, path, number=5000, repeat=3, **kwargs):
+    """
+    Return the best time in seconds, out of C{repeat} runs, to render one
+    request for C{path} with C{resource}.
+    """
+    def render():
+        resource.render(makeRequest(path, **kwargs))
+
+    return min(timeit.repeat(render, number=number, repeat=repeat)) / number
@@ -0,0 +1,90 @@
+"""
+Measure how the throughput of a CPU bound endpoint scales with the number
+of worker processes given to L{Klein.run}.
+
+For every number of workers, a server is started in a subprocess and
+loaded by twice as many client processes as the most workers, each making
+requests over a persistent connection for a few seconds.  Throughput can
+only scale up to the number of CPUs, which the clients share.
+
+Run with::
+
+    python benchmarks/workers.py [seconds]
+"""
+import httplib
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from klein import Klein
+
+
+PORT = 18080
+WORKERS = [1, 2, 4]
+
+
+def serve(workers, port):
+    app = Klein()
+
+    @app.route("/work")
+    def work(request):
+        return str(sum(i * i for i in xrange(20000)))
+
+    app.run("127.0.0.1", port, logFile=open(os.devnull, "w"),
+            workers=workers)
+
+
+def waitForServer(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("The server didn't start listening on %d" % (port,))
+
+
+def load((port, seconds)):
+    """
+    Make requests for C{seconds} and return how many were answered.
+    """
+    connection = httplib.HTTPConnection("127.0.0.1", port)
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection.request("GET", "/work")
+        connection.getresponse().read()
+        count += 1
+    return count
+
+
+def main(seconds=5.0):
+    clients = 2 * max(WORKERS)
+    pool = multiprocessing.Pool(clients)
+    print("%d CPUs, %d clients" % (multiprocessing.cpu_count(), clients))
+    print("%8s %12s" % ("workers", "requests/s"))
+    for workers in WORKERS:
+        server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "serve",
+             str(workers), str(PORT)])
+        try:
+            waitForServer(PORT)
+            # Let every worker start accepting.
+            time.sleep(1)
+            counts = pool.map(load, [(PORT, seconds)] * clients)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        print("%8d %12.1f" % (workers, sum(counts) / seconds))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        serve(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        main(*[float(arg) for arg in sys.argv[1:]])
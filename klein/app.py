@@ -1,6 +1,7 @@
 """
 Applications are great.  Lets have more of them.
 """
+import math
 import sys
 import weakref
 
@@ -11,13 +12,21 @@ from werkzeug.routing import Map, Rule
 from twisted.python import log
 from twisted.python.components import registerAdapter
 
+from twisted.web import http
 from twisted.web.server import Site, Request
-from twisted.internet import reactor
 
 from zope.interface import implements
 
-from klein.resource import KleinResource
+from klein.resource import KleinResource, _not_modified, _quote_etag
 from klein.interfaces import IKleinRequest
+from klein.routing import CompiledRouter, AdapterCache
+from klein.cache import LRUCache, ResponseCache
+from klein.compression import Compression
+from klein.threads import ThreadPools
+from klein.processes import ProcessPool, RequestSnapshot
+from klein.limits import ConcurrencyLimit
+from klein.deadlines import _time_remaining
+from klein import workers as _workers
 
 __all__ = ['Klein', 'run', 'route', 'resource']
 
@@ -30,14 +39,83 @@ def _call(instance, f, *args, **kwargs):
 
 
 class KleinRequest(object):
+    """
+    The L{IKleinRequest} of a request.
+
+    The mapper isn't bound until it is used.  L{KleinResource} leaves what is
+    needed to look it up in an L{AdapterCache} on the request as an
+    C{(adapters, bind_args)} tuple named C{_klein_bind_args}.  Unless a
+    mapper has been set explicitly, L{url_for} builds URLs through the
+    L{AdapterCache} so they are remembered between requests.
+
+    @ivar _request: The adapted request.
+    @ivar _bound_to: The C{_klein_bind_args} of C{_request} when C{_mapper}
+        was set.
+    @ivar _assigned: Whether C{_mapper} was set explicitly.
+    """
     implements(IKleinRequest)
+    __slots__ = ('branch_segments', '_request', '_mapper', '_bound_to',
+                 '_assigned')
 
     def __init__(self, request):
         self.branch_segments = ['']
-        self.mapper = None
+        self._request = request
+        self._mapper = None
+        self._bound_to = None
+        self._assigned = False
 
-    def url_for(self, *args, **kwargs):
-        return self.mapper.build(*args, **kwargs)
+
+    @property
+    def mapper(self):
+        bind_args = getattr(self._request, '_klein_bind_args', None)
+        if bind_args is not self._bound_to:
+            adapters, args = bind_args
+            self._mapper = adapters.bind(*args)
+            self._bound_to = bind_args
+            self._assigned = False
+        return self._mapper
+
+
+    @mapper.setter
+    def mapper(self, mapper):
+        self._mapper = mapper
+        self._bound_to = getattr(self._request, '_klein_bind_args', None)
+        self._assigned = True
+
+
+    def url_for(self, endpoint, values=None, method=None,
+                force_external=False, append_unknown=True):
+        bind_args = getattr(self._request, '_klein_bind_args', None)
+        if bind_args is None or (self._assigned and
+                                 bind_args is self._bound_to):
+            return self.mapper.build(endpoint, values, method,
+                                     force_external, append_unknown)
+
+        adapters, args = bind_args
+        return adapters.build(args, endpoint, values, method,
+                              force_external, append_unknown)
+
+
+    def is_fresh(self, etag=None, last_modified=None):
+        request = self._request
+        if etag is not None:
+            etag = request.etag = _quote_etag(etag)
+        if last_modified is not None:
+            # Only whole seconds make it into HTTP dates.
+            when = int(math.ceil(last_modified))
+            if not request.lastModified or request.lastModified < when:
+                request.lastModified = when
+
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if _not_modified(request, request.etag):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return True
+        return False
+
+
+    def time_remaining(self):
+        return _time_remaining(self._request)
 
 
 registerAdapter(KleinRequest, Request, IKleinRequest)
@@ -51,15 +129,139 @@ class Klein(object):
     @ivar _url_map: A C{werkzeug.routing.Map} object which will be used for
         routing resolution.
     @ivar _endpoints: A C{dict} mapping endpoint names to handler functions.
+    @ivar _error_handlers: A C{list} of C{(exception_types, handler)} tuples
+        in the order they were registered.
+    @ivar _error_handler_index: A C{dict} mapping exception types to the
+        result of L{Klein._error_handlers_for}.
+    @ivar _router: A L{CompiledRouter} used to match requests before falling
+        back to C{_url_map}, or C{None} if compiled routing is not enabled.
+    @ivar _frozen: Whether L{Klein.freeze} has been called.
     """
 
     _bound_klein_instances = weakref.WeakKeyDictionary()
 
-    def __init__(self):
+    def __init__(self, compiled_routing=False, match_cache_size=None,
+                 miss_cache_size=None, flatten_chunk_size=None,
+                 response_cache_bytes=64 * 1024 * 1024, etags=False,
+                 compress_level=None, compress_min_bytes=512,
+                 thread_pools=None, thread_pool_size=10,
+                 process_pool_size=None, process_queue_size=64,
+                 process_max_tasks=None, max_concurrency=None, max_queued=64,
+                 retry_after=1, timeout=None):
+        """
+        @param compiled_routing: If C{True}, match requests with a
+            L{CompiledRouter} built from the routing table instead of trying
+            every rule in turn.  Requests it can't answer exactly are still
+            matched by werkzeug.
+        @type compiled_routing: bool
+
+        @param match_cache_size: If given, remember the route matched by
+            this many of the most recently requested URLs so that they don't
+            need to be matched again.
+        @type match_cache_size: int
+
+        @param miss_cache_size: If given, remember this many of the most
+            recently requested URLs which didn't match any route, so that
+            requests for them are answered without matching them again.
+        @type miss_cache_size: int
+
+        @param flatten_chunk_size: If given, flatten L{IRenderable} results
+            straight to the request, writing it in chunks of about this many
+            bytes, instead of building the whole page in memory first.
+        @type flatten_chunk_size: int
+
+        @param response_cache_bytes: The most bytes of responses to keep for
+            routes with a L{CachePolicy}.
+        @type response_cache_bytes: int
+
+        @param etags: If C{True}, give successful responses to C{GET} and
+            C{HEAD} requests which are returned in full an C{ETag} computed
+            from their body, unless the handler gave them one, and answer
+            requests whose C{If-None-Match} matches it with C{304 Not
+            Modified} and no body.
+        @type etags: bool
+
+        @param compress_level: If given, the zlib compression level, from 1 to
+            9, of the responses of routes which don't give their own, which
+            are compressed with C{gzip} or C{deflate} for clients accepting
+            it.  If C{None}, only routes giving a level are compressed.
+        @type compress_level: int
+
+        @param compress_min_bytes: The size of the smallest response body
+            returned in full to compress.
+        @type compress_min_bytes: int
+
+        @param thread_pools: A C{dict} mapping the names of the thread pools
+            of threaded routes to the most threads each of them runs.
+        @type thread_pools: dict
+
+        @param thread_pool_size: The most threads run by the thread pools not
+            in C{thread_pools}.
+        @type thread_pool_size: int
+
+        @param process_pool_size: The number of worker processes running the
+            routes sent to another process, or C{None} for one per CPU.
+        @type process_pool_size: int
+
+        @param process_queue_size: The most calls of those routes waiting for
+            a worker process, beyond which requests are answered with C{503
+            Service Unavailable}.
+        @type process_queue_size: int
+
+        @param process_max_tasks: If given, the number of calls after which a
+            worker process is replaced by a new one.
+        @type process_max_tasks: int
+
+        @param max_concurrency: If given, the most requests whose handlers
+            are called but haven't finished responding at once, across every
+            route.  Responses served from the response cache don't count.
+        @type max_concurrency: int
+
+        @param max_queued: The most requests waiting for the C{max_concurrency}
+            of the application, or of a route not giving its own, beyond which
+            requests are answered with C{503 Service Unavailable} without
+            calling their handler.
+        @type max_queued: int
+
+        @param retry_after: The C{Retry-After} header, in seconds, of the
+            C{503 Service Unavailable} responses to requests turned away.
+        @type retry_after: int
+
+        @param timeout: If given, the number of seconds after which a
+            handler returning a L{Deferred} which hasn't fired, for a route
+            not giving its own C{timeout}, is cancelled, and the request is
+            answered with C{504 Gateway Timeout} through the error handlers.
+        @type timeout: float
+        """
         self._url_map = Map()
         self._endpoints = {}
         self._error_handlers = []
+        self._error_handler_index = {}
         self._instance = None
+        self._frozen = False
+        self._router = None
+        self._adapters = AdapterCache(self._url_map)
+        self._match_cache = None
+        if compiled_routing:
+            self._router = CompiledRouter(self._url_map)
+        if match_cache_size:
+            self._match_cache = LRUCache(match_cache_size)
+        self._miss_cache = None
+        if miss_cache_size:
+            self._miss_cache = LRUCache(miss_cache_size)
+        self._flatten_chunk_size = flatten_chunk_size
+        self._responses = ResponseCache(response_cache_bytes)
+        self._in_flight = {}
+        self._etags = etags
+        self._compress_level = compress_level
+        self._compress_min_bytes = compress_min_bytes
+        self._thread_pools = ThreadPools(thread_pools, thread_pool_size)
+        self._process_pool = ProcessPool(process_pool_size, process_queue_size,
+                                         process_max_tasks)
+        self._concurrency = ConcurrencyLimit(max_concurrency, max_queued,
+                                             retry_after)
+        self._timeout = timeout
+        self._clock = None
 
 
     @property
@@ -78,12 +280,104 @@ class Klein(object):
         return self._endpoints
 
 
+    @property
+    def match_cache(self):
+        """
+        Read only property exposing L{Klein._match_cache}, whose C{hits} and
+        C{misses} show how effective it is.
+        """
+        return self._match_cache
+
+
+    @property
+    def miss_cache(self):
+        """
+        Read only property exposing L{Klein._miss_cache}.
+        """
+        return self._miss_cache
+
+
+    @property
+    def response_cache(self):
+        """
+        Read only property exposing L{Klein._responses}, the L{ResponseCache}
+        of the routes with a L{CachePolicy}.  Its C{stats} method gives how
+        often each of them was served from it.
+        """
+        return self._responses
+
+
+    @property
+    def thread_pools(self):
+        """
+        Read only property exposing L{Klein._thread_pools}, the
+        L{ThreadPools} running threaded routes.  Its C{stats} method gives
+        how busy each of them is.
+        """
+        return self._thread_pools
+
+
+    @property
+    def process_pool(self):
+        """
+        Read only property exposing L{Klein._process_pool}, the
+        L{ProcessPool} running the routes sent to another process.
+        """
+        return self._process_pool
+
+
+    @property
+    def clock(self):
+        """
+        The L{IReactorTime} timing the deadlines of requests, by default the
+        global reactor.
+        """
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+
+    @clock.setter
+    def clock(self, clock):
+        self._clock = clock
+
+
+    def concurrency_limit(self, endpoint=None):
+        """
+        Return the L{ConcurrencyLimit} of the route named C{endpoint}, or of
+        the whole application.  Its C{limit} and C{max_queued} can be changed
+        while the application runs, and its C{stats} method gives how many
+        requests are being handled, are waiting and were turned away.
+        """
+        if endpoint is None:
+            return self._concurrency
+        return self._endpoints[endpoint].concurrency
+
+
     def execute_endpoint(self, endpoint, *args, **kwargs):
         """
         Execute the named endpoint with all arguments and possibly a bound
         instance.
+
+        Threaded endpoints are called in a thread of their pool, and
+        endpoints sent to another process are called there with a
+        L{RequestSnapshot} instead of the request.  A L{Deferred} firing with
+        their result is returned.
         """
         endpoint_f = self._endpoints[endpoint]
+        if endpoint_f.process_target is not None:
+            request, args = args[0], args[1:]
+            segments = ['']
+            if '__rest__' in kwargs:
+                segments = kwargs.pop('__rest__').split('/')
+                IKleinRequest(request).branch_segments = segments
+            return self._process_pool.run(
+                _call, self._instance, endpoint_f.process_target,
+                RequestSnapshot(request, segments), *args, **kwargs)
+        if endpoint_f.thread_pool is not None:
+            return self._thread_pools.run(endpoint_f.thread_pool, endpoint_f,
+                                          self._instance, *args, **kwargs)
         return endpoint_f(self._instance, *args, **kwargs)
 
 
@@ -118,6 +412,23 @@ class Klein(object):
             k._url_map = self._url_map
             k._endpoints = self._endpoints
             k._error_handlers = self._error_handlers
+            k._error_handler_index = self._error_handler_index
+            k._frozen = self._frozen
+            k._router = self._router
+            k._adapters = self._adapters
+            k._match_cache = self._match_cache
+            k._miss_cache = self._miss_cache
+            k._flatten_chunk_size = self._flatten_chunk_size
+            k._responses = self._responses
+            k._in_flight = self._in_flight
+            k._etags = self._etags
+            k._compress_level = self._compress_level
+            k._compress_min_bytes = self._compress_min_bytes
+            k._thread_pools = self._thread_pools
+            k._process_pool = self._process_pool
+            k._concurrency = self._concurrency
+            k._timeout = self._timeout
+            k._clock = self._clock
             k._instance = instance
             self._bound_klein_instances[instance] = k
 
@@ -144,15 +455,108 @@ class Klein(object):
             match some other route to be consumed.  Default C{False}.
         @type branch: bool
 
+        @param cache: A L{CachePolicy} for caching the responses of the
+            handler, or C{None} not to cache them.  Default C{None}.
+        @type cache: L{CachePolicy}
+
+        @param coalesce: If true, identical C{GET} and C{HEAD} requests which
+            arrive while the handler is waiting for a L{Deferred} to fire are
+            answered with its result instead of calling the handler again.
+            Requests are identical if they have the same host and URI, and
+            also the same values of the request headers named if
+            C{coalesce} is a sequence of header names.  Waiting requests get
+            the response code and headers set by the handler, except for
+            cookies.  The result should not be an iterator, which only one of
+            the requests could consume.  Default C{False}.
+        @type coalesce: bool or sequence of str
+
+        @param compress: The zlib compression level, from 1 to 9, of the
+            responses of the handler, or C{0} not to compress them.  Default
+            C{None}, for the C{compress_level} of the application.
+        @type compress: int
+
+        @param threaded: If C{True}, call the handler in a thread of a pool,
+            so that it can block without stalling the reactor.  Nothing
+            should be written to the request while it runs, since
+            twisted.web isn't thread-safe.  Default C{False}.
+        @type threaded: bool
+
+        @param pool: The name of the thread pool of a threaded handler.
+            Default C{"default"}.
+        @type pool: str
+
+        @param process: If C{True}, call the handler in a worker process of
+            the L{ProcessPool} of the application, so that it can use a CPU
+            without stalling the reactor or holding the GIL.  It is passed a
+            L{RequestSnapshot} instead of the request, and its arguments and
+            result must be picklable, so it must be defined at the top level
+            of a module.  If the client goes away while it is waiting for a
+            process, it isn't called.  Default C{False}.
+        @type process: bool
+
+        @param max_concurrency: The most requests for the route whose handler
+            is called but which haven't finished responding at once.  Further
+            requests wait for their turn, without holding a slot of the
+            C{max_concurrency} of the application.  Default C{None}, for no
+            limit.
+        @type max_concurrency: int
+
+        @param max_queued: The most requests waiting for the
+            C{max_concurrency} of the route, beyond which requests are
+            answered with C{503 Service Unavailable} without calling the
+            handler.  Default C{None}, for the C{max_queued} of the
+            application.
+        @type max_queued: int
+
+        @param timeout: The number of seconds after which the L{Deferred}
+            returned by the handler is cancelled if it hasn't fired, and the
+            request is answered with C{504 Gateway Timeout} by the error
+            handlers for L{GatewayTimeout}, or C{0} for no deadline.  The
+            time left is given by C{IKleinRequest(request).time_remaining()}.
+            Default C{None}, for the C{timeout} of the application.
+        @type timeout: float
 
         @returns: decorated handler function.
+
+        @raise RuntimeError: If the application has been frozen.
         """
+        if self._frozen:
+            raise RuntimeError(
+                "Can't add a route for %r: the routing table of this "
+                "application was frozen by Klein.freeze()" % (url,))
+
         segment_count = url.count('/')
         if url.endswith('/'):
             segment_count -= 1
 
         def deco(f):
             kwargs.setdefault('endpoint', f.__name__)
+            cache_policy = kwargs.pop('cache', None)
+            compression = None
+            compress = kwargs.pop('compress', None)
+            if compress is None:
+                compress = self._compress_level
+            if compress:
+                compression = Compression(compress, self._compress_min_bytes)
+            thread_pool = kwargs.pop('pool', 'default')
+            if not kwargs.pop('threaded', False):
+                thread_pool = None
+            process_target = f if kwargs.pop('process', False) else None
+            max_queued = kwargs.pop('max_queued', None)
+            if max_queued is None:
+                max_queued = self._concurrency.max_queued
+            concurrency = ConcurrencyLimit(kwargs.pop('max_concurrency', None),
+                                           max_queued,
+                                           self._concurrency.retry_after)
+            # The limits requests for the route are subject to, which are
+            # skipped while they have no limit.
+            limits = (concurrency, self._concurrency)
+            timeout = kwargs.pop('timeout', None)
+            coalesce = kwargs.pop('coalesce', False)
+            if coalesce:
+                coalesce = tuple(coalesce) if coalesce is not True else ()
+            else:
+                coalesce = None
             if kwargs.pop('branch', False):
                 branchKwargs = kwargs.copy()
                 branchKwargs['endpoint'] = branchKwargs['endpoint'] + '_branch'
@@ -163,6 +567,14 @@ class Klein(object):
                     return _call(instance, f, request, *a, **kw)
 
                 branch_f.segment_count = segment_count
+                branch_f.cache_policy = cache_policy
+                branch_f.coalesce = coalesce
+                branch_f.compression = compression
+                branch_f.thread_pool = thread_pool
+                branch_f.process_target = process_target
+                branch_f.concurrency = concurrency
+                branch_f.limits = limits
+                branch_f.timeout = timeout
 
                 self._endpoints[branchKwargs['endpoint']] = branch_f
                 self._url_map.add(Rule(url.rstrip('/') + '/' + '<path:__rest__>', *args, **branchKwargs))
@@ -172,14 +584,69 @@ class Klein(object):
                 return _call(instance, f, request, *a, **kw)
 
             _f.segment_count = segment_count
+            _f.cache_policy = cache_policy
+            _f.coalesce = coalesce
+            _f.compression = compression
+            _f.thread_pool = thread_pool
+            _f.process_target = process_target
+            _f.concurrency = concurrency
+            _f.limits = limits
+            _f.timeout = timeout
 
             self._endpoints[kwargs['endpoint']] = _f
             self._url_map.add(Rule(url, *args, **kwargs))
+            self._routing_changed()
             return f
 
         return deco
 
 
+    def freeze(self, cache_path=None):
+        """
+        Lock the routing table and compile it for matching.
+
+        Requests to a frozen application are matched with a L{CompiledRouter}
+        even if C{compiled_routing} wasn't given, and any later call to
+        L{Klein.route} raises C{RuntimeError}.  Applications should be
+        frozen before they are bound to instances, since instances bound
+        earlier don't see it.
+
+        @param cache_path: If given, the path of a file to load the compiled
+            routing table from instead of compiling it.  If the file doesn't
+            exist or was written for different routes, the table is compiled
+            and written to it, so that the next process to start with the
+            same routes can load it.
+        @type cache_path: str
+
+        @raise EnvironmentError: If C{cache_path} needed to be written and
+            couldn't be.
+        """
+        if self._router is None:
+            self._router = CompiledRouter(self._url_map)
+
+        if cache_path is None:
+            self._router.compile()
+        elif not self._router.load(cache_path):
+            self._router.compile()
+            self._router.save(cache_path)
+
+        self._frozen = True
+
+
+    def _routing_changed(self):
+        """
+        Discard anything derived from the routing table after it changed.
+        """
+        self._adapters.clear()
+        self._responses.clear()
+        if self._router is not None:
+            self._router.invalidate()
+        if self._match_cache is not None:
+            self._match_cache.clear()
+        if self._miss_cache is not None:
+            self._miss_cache.clear()
+
+
     def handle_errors(self, f_or_exception, *additional_exceptions):
         """
         Register an error handler. This decorator supports two syntaxes. The
@@ -242,19 +709,44 @@ class Klein(object):
                 return _call(instance, f, request, failure)
 
             self._error_handlers.append(([f_or_exception] + list(additional_exceptions), _f))
+            self._error_handler_index.clear()
             return _f
 
         return deco
 
 
-    def run(self, host, port, logFile=None):
+    def _error_handlers_for(self, exception_type):
+        """
+        Find the error handlers which handle C{exception_type}.
+
+        The answer is remembered for each type, so failures don't have to be
+        checked against every registered handler.
+
+        @param exception_type: An C{Exception} subclass.
+
+        @return: A C{tuple} of C{(position, handler)} tuples, where
+            C{position} is the index of C{handler} in C{_error_handlers}.
+        """
+        handlers = self._error_handler_index.get(exception_type)
+        if handlers is None:
+            handlers = tuple([
+                (position, handler)
+                for position, (exception_types, handler)
+                in enumerate(self._error_handlers)
+                if issubclass(exception_type, tuple(exception_types))])
+            self._error_handler_index[exception_type] = handlers
+        return handlers
+
+
+    def run(self, host, port, logFile=None, workers=None):
         """
         Run a minimal twisted.web server on the specified C{port}, bound to the
         interface specified by C{host} and logging to C{logFile}.
 
         This function will run the default reactor for your platform and so
         will block the main thread of your application.  It should be the last
-        thing your klein application does.
+        thing your klein application does.  Klein only imports the reactor
+        once it is needed, so another one may be installed until then.
 
         @param host: The hostname or IP address to bind the listening socket
             to.  "0.0.0.0" will allow you to listen on all interfaces, and
@@ -266,12 +758,26 @@ class Klein(object):
 
         @param logFile: The file object to log to, by default C{sys.stdout}
         @type logFile: file object
+
+        @param workers: If given, serve from this many processes sharing the
+            listening socket.  Each of them runs the script which called
+            L{run} again, so it must be started as a script, and call L{run}
+            the same way every time.  Workers which exit are started again,
+            and all of them are asked to exit when this process is.  See
+            L{klein.workers.serve}.
+        @type workers: int
         """
+        from twisted.internet import reactor
+
         if logFile is None:
             logFile = sys.stdout
 
         log.startLogging(logFile)
-        reactor.listenTCP(port, Site(self.resource()), interface=host)
+        if workers is None:
+            reactor.listenTCP(port, Site(self.resource()), interface=host)
+        else:
+            _workers.serve(reactor, Site(self.resource()), host, port,
+                           workers)
         reactor.run()
 
 
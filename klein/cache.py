@@ -0,0 +1,391 @@
+"""
+Caches used to avoid repeating work between requests.
+"""
+
+__all__ = ["LRUCache", "CachePolicy", "CacheStats", "ResponseCache"]
+
+
+_PREV, _NEXT, _KEY, _VALUE = range(4)
+
+
+class LRUCache(object):
+    """
+    A mapping which holds at most C{size} items, discarding the least
+    recently used item to make room for a new one.
+
+    @ivar size: The maximum number of items held.
+    @ivar hits: The number of times L{get} found a key.
+    @ivar misses: The number of times L{get} didn't find a key.
+    @ivar evictions: The number of items discarded to make room for others.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be at least 1, not %r" % (size,))
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._links = {}
+        # The root of a circular doubly linked list of [prev, next, key,
+        # value] links, most recently used first.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __contains__(self, key):
+        return key in self._links
+
+
+    def get(self, key, default=None):
+        """
+        Return the value for C{key} and mark it as the most recently used, or
+        return C{default} if it isn't cached.
+        """
+        link = self._links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._moveToFront(link)
+        return link[_VALUE]
+
+
+    def set(self, key, value):
+        """
+        Cache C{value} for C{key} as the most recently used item, evicting the
+        least recently used item if the cache is full.
+        """
+        link = self._links.get(key)
+        if link is not None:
+            link[_VALUE] = value
+            self._moveToFront(link)
+            return
+
+        if len(self._links) >= self.size:
+            self.evictions += 1
+            self.pop(self._root[_PREV][_KEY])
+
+        root = self._root
+        first = root[_NEXT]
+        link = [root, first, key, value]
+        first[_PREV] = root[_NEXT] = self._links[key] = link
+
+
+    def peek(self, key, default=None):
+        """
+        Return the value for C{key}, or C{default} if it isn't cached, without
+        counting the lookup or marking the item as used.
+        """
+        link = self._links.get(key)
+        if link is None:
+            return default
+        return link[_VALUE]
+
+
+    def pop(self, key, default=None):
+        """
+        Remove C{key} and return its value, or C{default} if it isn't cached.
+        """
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        return link[_VALUE]
+
+
+    def popitem(self):
+        """
+        Remove the least recently used item and return it as a C{(key,
+        value)} tuple.
+
+        @raise KeyError: If the cache is empty.
+        """
+        if not self._links:
+            raise KeyError("popitem(): cache is empty")
+        key = self._root[_PREV][_KEY]
+        return key, self.pop(key)
+
+
+    def clear(self):
+        """
+        Remove every item.  The counters are left alone.
+        """
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+
+    def _moveToFront(self, link):
+        root = self._root
+        if root[_NEXT] is link:
+            return
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        first = root[_NEXT]
+        link[_PREV] = root
+        link[_NEXT] = first
+        first[_PREV] = root[_NEXT] = link
+
+
+
+class CachePolicy(object):
+    """
+    How the responses of a route are kept in the L{ResponseCache} of its
+    application.
+
+    Only successful responses to C{GET} and C{HEAD} requests whose bodies
+    were returned by the endpoint in full are cached, and not if they set
+    cookies or forbid caching with C{Cache-Control}.
+
+    @ivar ttl: The number of seconds a response is served from the cache.
+    @ivar vary: The names of the request headers whose values are part of the
+        cache key, in addition to the host, method and URI of the request.
+    @ivar max_bytes: The size of the largest response body to cache, or
+        C{None}.
+    @ivar stale_while_revalidate: The number of seconds after C{ttl} during
+        which a response is still served from the cache, while the endpoint
+        is called in the background to replace it.
+    """
+
+    def __init__(self, ttl, vary=(), max_bytes=None, stale_while_revalidate=0):
+        self.ttl = ttl
+        self.vary = tuple(vary)
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+
+
+
+class CacheStats(object):
+    """
+    How often the responses of a route were served from a L{ResponseCache}.
+
+    @ivar hits: The number of responses served from the cache while fresh.
+    @ivar stale: The number of responses served from the cache while being
+        revalidated.
+    @ivar misses: The number of requests which called the endpoint.
+    """
+    __slots__ = ('hits', 'stale', 'misses')
+
+    def __init__(self):
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+
+
+    @property
+    def hit_rate(self):
+        """
+        The fraction of requests which were served from the cache.
+        """
+        total = self.hits + self.stale + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits + self.stale) / total
+
+
+
+class _CachedResponse(object):
+    """
+    A response held by a L{ResponseCache}.
+
+    @ivar refreshing: Whether the response is stale and being revalidated.
+    @ivar variants: A C{dict} mapping names to variants of C{body}, such as
+        compressed ones, made by L{ResponseCache.variant}.
+    """
+    __slots__ = ('key', 'headers', 'body', 'size', 'fresh_until',
+                 'stale_until', 'refreshing', 'variants')
+
+    def __init__(self, key, headers, body, size, fresh_until, stale_until):
+        self.key = key
+        self.headers = headers
+        self.body = body
+        self.size = size
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.refreshing = False
+        self.variants = {}
+
+
+
+# What a response costs on top of its headers and body, roughly.
+_ENTRY_OVERHEAD = 256
+
+# Response headers which describe a particular response rather than the
+# resource, or which must not be shared between clients.
+_UNCACHED_HEADERS = frozenset(['date', 'set-cookie', 'content-length'])
+
+
+
+class ResponseCache(object):
+    """
+    The responses of the routes of an application which have a
+    L{CachePolicy}, holding at most C{max_bytes} of them and discarding the
+    least recently used responses to make room for new ones.
+
+    @ivar max_bytes: The most bytes of headers and bodies to hold.
+    @ivar size: The number of bytes held.
+    @ivar clock: The L{IReactorTime} used to expire responses and schedule
+        their revalidation, by default the global reactor.
+    @ivar _entries: An L{LRUCache} mapping keys to L{_CachedResponse}s.
+    @ivar _stats: A C{dict} mapping endpoints to their L{CacheStats}.
+    """
+
+    def __init__(self, max_bytes, clock=None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._clock = clock
+        # Every response counts for more than one byte, so the number of
+        # items never limits the cache before its size does.
+        self._entries = LRUCache(max_bytes)
+        self._stats = {}
+
+
+    @property
+    def clock(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+
+    @clock.setter
+    def clock(self, clock):
+        self._clock = clock
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def stats(self, endpoint):
+        """
+        Return the L{CacheStats} of the route named C{endpoint}.
+        """
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            stats = self._stats[endpoint] = CacheStats()
+        return stats
+
+
+    def get(self, endpoint, key):
+        """
+        Look up the response cached for C{key}, counting the lookup in the
+        statistics of C{endpoint}.
+
+        @return: A C{(response, fresh)} tuple, where C{fresh} is C{False} if
+            the response should be revalidated, or C{(None, False)} if
+            nothing usable is cached.
+        """
+        stats = self.stats(endpoint)
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = self.clock.seconds()
+            if now < entry.fresh_until:
+                stats.hits += 1
+                return entry, True
+            if now < entry.stale_until:
+                stats.stale += 1
+                return entry, False
+            self._discard(key)
+
+        stats.misses += 1
+        return None, False
+
+
+    def store(self, policy, key, request, body):
+        """
+        Cache C{body} and the response headers of C{request} under C{key} if
+        C{policy} allows it.
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        elif body is None:
+            body = ''
+        elif not isinstance(body, str):
+            return
+
+        if request.code != 200 or request.cookies:
+            return
+        # Part of the response went out already, so that body is only the
+        # rest of it.
+        if request.startedWriting:
+            return
+        if policy.max_bytes is not None and len(body) > policy.max_bytes:
+            return
+
+        size = len(body) + _ENTRY_OVERHEAD
+        headers = []
+        for name, values in request.responseHeaders.getAllRawHeaders():
+            lowered = name.lower()
+            if lowered == 'cache-control':
+                for value in values:
+                    if 'no-store' in value or 'private' in value:
+                        return
+            if lowered == 'set-cookie':
+                return
+            if lowered in _UNCACHED_HEADERS:
+                continue
+            headers.append((name, list(values)))
+            size += len(name) + sum(map(len, values))
+
+        # An entity tag given with Request.setETag is only written as a
+        # header along with the response.
+        if request.etag is not None:
+            headers.append(('ETag', [request.etag]))
+            size += len(request.etag)
+
+        if size > self.max_bytes:
+            return
+
+        now = self.clock.seconds()
+        self._discard(key)
+        self._entries.set(key, _CachedResponse(
+            key, headers, body, size, now + policy.ttl,
+            now + policy.ttl + policy.stale_while_revalidate))
+        self.size += size
+        self._evict()
+
+
+    def variant(self, entry, name, make):
+        """
+        Return the variant C{name} of the body of C{entry}, a response
+        returned by L{get}, calling C{make} with the body to make it the
+        first time it is asked for.  It is held along with the response, and
+        counts towards its size.
+        """
+        body = entry.variants.get(name)
+        if body is None:
+            body = entry.variants[name] = make(entry.body)
+            entry.size += len(body)
+            if self._entries.peek(entry.key) is entry:
+                self.size += len(body)
+                self._evict()
+        return body
+
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            evicted, entry = self._entries.popitem()
+            self.size -= entry.size
+
+
+    def _discard(self, key):
+        entry = self._entries.pop(key)
+        if entry is not None:
+            self.size -= entry.size
+
+
+    def clear(self):
+        """
+        Discard every response.  The statistics are left alone.
+        """
+        self._entries.clear()
+        self.size = 0
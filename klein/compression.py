@@ -0,0 +1,170 @@
+"""
+Compression of response bodies with the content codings clients accept.
+"""
+import zlib
+
+__all__ = ["Compression"]
+
+
+# The window bits zlib needs to write each content coding.
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# The content codings in order of preference, when a client accepts several
+# of them equally.
+_PREFERENCE = ('gzip', 'deflate')
+
+# Media types whose content is compressed already, so that compressing it
+# again costs time without saving much space.
+_COMPRESSED_TYPES = ('image/', 'video/', 'audio/', 'font/woff',
+                     'application/zip', 'application/gzip',
+                     'application/x-gzip', 'application/x-bzip2',
+                     'application/x-xz', 'application/x-7z-compressed',
+                     'application/pdf')
+
+
+def _accepted_encoding(request):
+    """
+    Return the content coding of C{request}'s C{Accept-Encoding} header it
+    prefers among the ones which can be written, or C{None}.
+
+    C{*} only stands for the codings the header doesn't name.
+    """
+    header = request.getHeader('accept-encoding')
+    if not header:
+        return None
+
+    qs = {}
+    for item in header.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        if coding != '*' and coding not in _WBITS:
+            continue
+
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qs[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in _PREFERENCE:
+        q = qs.get(coding, qs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+
+class _StreamEncoder(object):
+    """
+    Compresses a response which is written in several chunks as they are
+    written, flushing the compressor after each so that the client gets
+    every chunk without waiting for the next.
+
+    Twisted's L{server.Request} passes what is written to it through the
+    encoder named C{_encoder}, if it has one, from version 12.3.
+    """
+    __slots__ = ('_compressor',)
+
+    def __init__(self, encoding, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            _WBITS[encoding])
+
+
+    def encode(self, data):
+        if not data:
+            return ''
+        return (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+
+class Compression(object):
+    """
+    How the responses of a route are compressed.
+
+    Responses are only compressed if the client accepts C{gzip} or
+    C{deflate}, the handler didn't set a C{Content-Encoding} and their
+    C{Content-Type} isn't one which is compressed already.  Responses
+    returned in full are also left alone if they are smaller than
+    C{min_bytes}; streamed responses are compressed as they are written.
+
+    @ivar level: The zlib compression level, from 1 to 9.
+    @ivar min_bytes: The size of the smallest body returned in full to
+        compress.
+    """
+    __slots__ = ('level', 'min_bytes')
+
+    def __init__(self, level=6, min_bytes=512):
+        if not 1 <= level <= 9:
+            raise ValueError("level must be from 1 to 9, not %r" % (level,))
+        self.level = level
+        self.min_bytes = min_bytes
+
+
+    def applies(self, request):
+        """
+        Whether the response to C{request}, with the headers it has, may be
+        compressed at all, whether or not its client accepts it.
+        """
+        if request.responseHeaders.hasHeader('content-encoding'):
+            return False
+        content_type = request.responseHeaders.getRawHeaders(
+            'content-type', [''])[0].lower()
+        return not content_type.startswith(_COMPRESSED_TYPES)
+
+
+    def vary(self, request):
+        """
+        Add C{Accept-Encoding} to the C{Vary} header of the response to
+        C{request}.
+        """
+        vary = request.responseHeaders.getRawHeaders('vary', [])
+        for value in vary:
+            for name in value.split(','):
+                if name.strip().lower() in ('accept-encoding', '*'):
+                    return
+        request.responseHeaders.setRawHeaders(
+            'vary', vary + ['Accept-Encoding'])
+
+
+    def encoding(self, request, size=None):
+        """
+        Return the content coding to compress the response to C{request}
+        with, or C{None} if it shouldn't be compressed.
+
+        @param size: The size of the body, if it is returned in full.
+        """
+        if size is not None and size < self.min_bytes:
+            return None
+        if not self.applies(request):
+            return None
+        self.vary(request)
+        return _accepted_encoding(request)
+
+
+    def compress(self, encoding, body):
+        """
+        Return C{body} compressed with the content coding C{encoding}.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      _WBITS[encoding])
+        return compressor.compress(body) + compressor.flush()
+
+
+    def encoder(self, encoding):
+        """
+        Return an encoder which compresses a streamed response with the
+        content coding C{encoding}.
+        """
+        return _StreamEncoder(encoding, self.level)
@@ -0,0 +1,61 @@
+"""
+Deadlines by which requests must be answered.
+"""
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from werkzeug.exceptions import HTTPException
+
+__all__ = ["GatewayTimeout"]
+
+
+try:
+    from werkzeug.exceptions import GatewayTimeout
+except ImportError:
+    class GatewayTimeout(HTTPException):
+        """
+        C{504 Gateway Timeout}, which werkzeug only has from version 0.10.
+        """
+        code = 504
+        description = (
+            '<p>The connection to an upstream server timed out.</p>'
+        )
+
+
+
+def _time_remaining(request):
+    """
+    Return the number of seconds left before the deadline of C{request}, or
+    C{None} if it has none.
+    """
+    deadline = getattr(request, '_klein_deadline', None)
+    if deadline is None:
+        return None
+    clock, when = deadline
+    return max(0.0, when - clock.seconds())
+
+
+def _enforce(request, d):
+    """
+    Cancel C{d}, which the response to C{request} is waiting for, if it
+    hasn't fired by the deadline of C{request}, and fail it with
+    L{GatewayTimeout} instead of L{defer.CancelledError} then.
+    """
+    clock, when = request._klein_deadline
+    expired = []
+
+    def _expire():
+        expired.append(True)
+        d.cancel()
+
+    call = clock.callLater(max(0.0, when - clock.seconds()), _expire)
+
+    def _done(result):
+        if call.active():
+            call.cancel()
+        if (expired and isinstance(result, Failure) and
+                result.check(defer.CancelledError)):
+            return Failure(GatewayTimeout())
+        return result
+
+    d.addBoth(_done)
@@ -6,7 +6,38 @@ class IKleinRequest(Interface):
     branch_segments = Attribute("Segments consumed by a branch route.")
     mapper = Attribute("L{werkzeug.routing.MapAdapter}")
 
-    def url_for(self, endpoint, values=None, method=None, force_external=False, append_unknown=True):
+    def url_for(endpoint, values=None, method=None, force_external=False, append_unknown=True):
         """
         L{werkzeug.routing.MapAdapter.build}
         """
+
+    def is_fresh(etag=None, last_modified=None):
+        """
+        Set the entity tag and last modification time of the response, and
+        check whether the client already has it.
+
+        Handlers can call this before doing the work of producing the
+        response, and return without a body if it is fresh::
+
+            if IKleinRequest(request).is_fresh(etag=page.version):
+                return None
+
+        @param etag: The entity tag of the response, quoted if it isn't
+            already.
+        @param last_modified: When the response last changed, in seconds
+            since the epoch.
+
+        @return: C{True} if the request is a conditional C{GET} or C{HEAD}
+            request whose conditions show the client has the response, in
+            which case the response code is set to C{304 Not Modified}.
+        """
+
+    def time_remaining():
+        """
+        Return the number of seconds left before the deadline of the request,
+        after which its handler is cancelled and it is answered with C{504
+        Gateway Timeout}, or C{None} if it has no deadline.
+
+        Handlers can pass it on as the timeout of the calls they make, so
+        that those don't outlive the request.
+        """
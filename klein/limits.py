@@ -0,0 +1,140 @@
+"""
+Limits on the number of requests handled at once.
+"""
+from collections import deque
+
+from twisted.internet import defer
+
+__all__ = ["ConcurrencyLimit", "ConcurrencyStats"]
+
+
+class ConcurrencyStats(object):
+    """
+    A snapshot of how busy a L{ConcurrencyLimit} is.
+
+    @ivar active: The number of requests being handled.
+    @ivar queued: The number of requests waiting to be handled.
+    @ivar rejected: The number of requests turned away because too many were
+        waiting already.
+    @ivar limit: The most requests handled at once, or C{None}.
+    @ivar max_queued: The most requests waiting to be handled.
+    """
+    __slots__ = ('active', 'queued', 'rejected', 'limit', 'max_queued')
+
+    def __init__(self, active, queued, rejected, limit, max_queued):
+        self.active = active
+        self.queued = queued
+        self.rejected = rejected
+        self.limit = limit
+        self.max_queued = max_queued
+
+
+    def __repr__(self):
+        return ("<ConcurrencyStats active=%d queued=%d rejected=%d limit=%r "
+                "max_queued=%d>" % (self.active, self.queued, self.rejected,
+                                    self.limit, self.max_queued))
+
+
+
+class ConcurrencyLimit(object):
+    """
+    A semaphore like L{defer.DeferredSemaphore}, letting at most C{limit}
+    requests be handled at once, with a queue of at most C{max_queued}
+    requests waiting for their turn.
+
+    C{limit} and C{max_queued} can be changed at any time.  Raising C{limit}
+    lets waiting requests through straight away; lowering it lets no more
+    through until enough of the requests being handled are done.
+
+    @ivar max_queued: The most requests waiting to be handled, beyond which
+        they are turned away.
+    @ivar retry_after: The number of seconds after which clients turned away
+        are told to try again.
+    @ivar active: The number of requests being handled.
+    @ivar rejected: The number of requests turned away.
+    @ivar _waiting: The L{defer.Deferred}s of the waiting requests.
+    """
+
+    def __init__(self, limit=None, max_queued=64, retry_after=1):
+        self._limit = limit
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self.active = 0
+        self.rejected = 0
+        self._waiting = deque()
+
+
+    @property
+    def limit(self):
+        """
+        The most requests handled at once, or C{None} for no limit.
+        """
+        return self._limit
+
+
+    @limit.setter
+    def limit(self, limit):
+        self._limit = limit
+        self._wake()
+
+
+    @property
+    def queued(self):
+        """
+        The number of requests waiting to be handled.
+        """
+        return len(self._waiting)
+
+
+    def try_acquire(self):
+        """
+        Take a slot if one is free and no request is waiting for one.
+
+        @return: Whether a slot was taken.
+        """
+        if self._waiting or (self._limit is not None and
+                             self.active >= self._limit):
+            return False
+        self.active += 1
+        return True
+
+
+    def acquire(self):
+        """
+        Take a slot, waiting for one if none is free.
+
+        @return: A L{defer.Deferred} which fires once a slot is taken, and
+            which stops waiting if cancelled, or C{None} if too many requests
+            are waiting already.
+        """
+        if self.try_acquire():
+            return defer.succeed(self)
+        if len(self._waiting) >= self.max_queued:
+            self.rejected += 1
+            return None
+        d = defer.Deferred(self._waiting.remove)
+        self._waiting.append(d)
+        return d
+
+
+    def release(self):
+        """
+        Give back a slot taken by L{try_acquire} or L{acquire}.
+        """
+        self.active -= 1
+        self._wake()
+
+
+    def stats(self):
+        """
+        Return a L{ConcurrencyStats} for this limit.
+        """
+        return ConcurrencyStats(self.active, len(self._waiting), self.rejected,
+                                self._limit, self.max_queued)
+
+
+    def _wake(self):
+        while self._waiting and (self._limit is None or
+                                 self.active < self._limit):
+            self.active += 1
+            self._waiting.popleft().callback(self)
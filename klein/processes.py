@@ -0,0 +1,386 @@
+"""
+A process pool for running endpoints which are CPU bound.
+"""
+import cPickle as pickle
+import errno
+import itertools
+import multiprocessing
+import os
+import signal
+import sys
+import traceback
+
+from collections import deque
+from multiprocessing.queues import SimpleQueue
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from werkzeug.exceptions import ServiceUnavailable
+
+__all__ = ["ProcessPool", "RequestSnapshot", "RemoteError"]
+
+
+class RequestSnapshot(object):
+    """
+    What a handler running in another process can know about the request it
+    is responding to.
+
+    @ivar method: The method of the request.
+    @ivar uri: The URI of the request.
+    @ivar path: The path of the request.
+    @ivar args: A C{dict} mapping the names of the query and form arguments
+        of the request to C{list}s of their values.
+    @ivar headers: A C{dict} mapping the lower-cased names of the request
+        headers to C{list}s of their values.
+    @ivar content: The body of the request.
+    @ivar client_ip: The IP address of the client, or C{None}.
+    @ivar host: The host name the request was made to.
+    @ivar port: The port the request was made to.
+    @ivar secure: Whether the request was made over TLS.
+    @ivar branch_segments: The segments consumed by a branch route.
+    """
+
+    def __init__(self, request, branch_segments=('',)):
+        self.method = request.method
+        self.uri = request.uri
+        self.path = request.path
+        self.args = dict([(name, list(values))
+                          for name, values in (request.args or {}).items()])
+        self.headers = dict([
+            (name.lower(), list(values))
+            for name, values in request.requestHeaders.getAllRawHeaders()])
+        self.content = ''
+        if request.content is not None:
+            request.content.seek(0)
+            self.content = request.content.read()
+            request.content.seek(0)
+        self.client_ip = request.getClientIP()
+        self.host = request.getRequestHostname()
+        self.port = request.getHost().port
+        self.secure = request.isSecure()
+        self.branch_segments = list(branch_segments)
+
+
+    def getHeader(self, name):
+        """
+        Return the last value of the request header C{name}, or C{None}.
+        """
+        values = self.headers.get(name.lower())
+        if values:
+            return values[-1]
+        return None
+
+
+
+class RemoteError(Exception):
+    """
+    A handler running in another process raised an exception which couldn't
+    be sent back, or the process died before it returned.
+
+    @ivar traceback: The formatted traceback of the exception, or C{None}.
+    """
+
+    def __init__(self, description, traceback):
+        Exception.__init__(self, description, traceback)
+        self.traceback = traceback
+
+
+    def __str__(self):
+        return self.args[0]
+
+
+
+# The queue a worker process reports the calls it starts to.
+_started = None
+
+
+def _init_worker(started=None):
+    """
+    Undo, in a worker process, the signal handling it inherited from the
+    reactor of the process which forked it.
+
+    Otherwise C{SIGTERM} would only stop the reactor of the worker, which
+    isn't running, instead of ending it, and C{SIGINT} would end it with a
+    traceback when it should be left to the pool.
+
+    @param started: A queue to put a C{(key, pid)} tuple on whenever the
+        worker starts a call, or C{None}.
+    """
+    global _started
+    _started = started
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+
+def _alive(pid):
+    """
+    Return whether there is a process with the ID C{pid}.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _call(f, args, kwargs):
+    """
+    Call C{f} in a worker process.
+
+    The outcome is pickled here, so that a result which can't be pickled is
+    reported like an exception instead of never coming back.
+
+    @return: A pickled C{(succeeded, result)} tuple, where C{result} is what
+        C{f} returned or the exception it raised.
+    """
+    try:
+        outcome = (True, f(*args, **kwargs))
+    except:
+        outcome = (False, sys.exc_info()[1])
+    try:
+        return pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        error = RemoteError(repr(outcome[1]), traceback.format_exc())
+        return pickle.dumps((False, error), pickle.HIGHEST_PROTOCOL)
+
+
+def _run(key, f, args, kwargs):
+    """
+    Report to the pool that the call it knows as C{key} is starting in this
+    process, and make it with L{_call}.
+    """
+    if _started is not None:
+        _started.put((key, os.getpid()))
+    return _call(f, args, kwargs)
+
+
+
+class _Task(object):
+    """
+    A call waiting for or running in a L{ProcessPool}.
+
+    @ivar key: The key of the call while it is running, or C{None}.
+    @ivar pid: The ID of the process running the call, once it has started.
+    @ivar gone: Whether that process was found to have gone.
+    """
+    __slots__ = ('f', 'args', 'kwargs', 'deferred', 'running', 'key', 'pid',
+                 'gone')
+
+    def __init__(self, f, args, kwargs, canceller):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.deferred = defer.Deferred(lambda d: canceller(self))
+        self.running = False
+        self.key = None
+        self.pid = None
+        self.gone = False
+
+
+
+class ProcessPool(object):
+    """
+    Worker processes which functions are sent to, with their arguments, and
+    whose results come back as L{Deferred}s.
+
+    At most one call per process is handed to C{multiprocessing}; the others
+    wait in a queue of at most C{max_queued} calls here, so that cancelling
+    one of them means it never runs.  Cancelling a running call only
+    discards its result.
+
+    While calls are running, the pool checks every C{check_interval} seconds
+    that the processes running them are still there.  A call whose process
+    died, say because it crashed or ran out of memory, fails with
+    L{RemoteError}, and its place is given to another call.
+
+    Functions, arguments and results are pickled, so functions must be
+    defined at the top level of a module.
+
+    @ivar processes: The number of worker processes.
+    @ivar max_queued: The most calls waiting for a process, beyond which
+        L{run} fails with L{ServiceUnavailable}.
+    @ivar max_tasks: The number of calls after which a worker process is
+        replaced by a new one, or C{None}.
+    @ivar check_interval: The number of seconds between checks of the worker
+        processes running calls.
+    @ivar _reactor: The reactor results are sent back to, by default the
+        global reactor.
+    @ivar _tasks: A C{dict} mapping the keys of the running calls to their
+        L{_Task}s.
+    @ivar _keys: An iterator of keys for the calls, which are never reused,
+        so that a worker process reporting a call it started long ago can't
+        be taken for the process running another one.
+    @ivar _started: The queue worker processes report the calls they start
+        to.
+    @ivar _check: The L{IDelayedCall} of the next check of the worker
+        processes, or C{None}.
+    """
+    check_interval = 1.0
+
+    def __init__(self, processes=None, max_queued=64, max_tasks=None,
+                 reactor=None, pool_factory=multiprocessing.Pool):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.max_queued = max_queued
+        self.max_tasks = max_tasks
+        self._reactor = reactor
+        self._pool_factory = pool_factory
+        self._pool = None
+        self._queue = deque()
+        self._tasks = {}
+        self._keys = itertools.count()
+        self._started = None
+        self._check = None
+
+
+    @property
+    def queued(self):
+        """
+        The number of calls waiting for a process.
+        """
+        return len(self._queue)
+
+
+    @property
+    def running(self):
+        """
+        The number of calls running in a process.
+        """
+        return len(self._tasks)
+
+
+    def run(self, f, *args, **kwargs):
+        """
+        Call C{f} with C{args} and C{kwargs} in a worker process.
+
+        @return: A L{Deferred} which fires with the result of C{f}, or fails
+            with the exception it raised.  It fails with
+            L{ServiceUnavailable} if too many calls are waiting already.
+        """
+        if len(self._queue) >= self.max_queued:
+            return defer.fail(ServiceUnavailable(
+                "Too many requests are waiting for a worker process."))
+
+        task = _Task(f, args, kwargs, self._cancel)
+        self._queue.append(task)
+        self._submit()
+        return task.deferred
+
+
+    def stop(self):
+        """
+        Stop the worker processes, failing the calls they are running and
+        the calls waiting for them with L{RemoteError}.
+        """
+        if self._check is not None:
+            self._check.cancel()
+            self._check = None
+        pool, self._pool = self._pool, None
+        tasks, self._tasks = self._tasks, {}
+        queue, self._queue = self._queue, deque()
+
+        for task in tasks.values():
+            task.running = False
+            if not task.deferred.called:
+                task.deferred.errback(RemoteError(
+                    "The pool was stopped while running %r" % (task.f,),
+                    None))
+        for task in queue:
+            task.deferred.errback(RemoteError(
+                "The pool was stopped before running %r" % (task.f,), None))
+
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+    def _submit(self):
+        while self._queue and len(self._tasks) < self.processes:
+            if self._pool is None:
+                if self._reactor is None:
+                    from twisted.internet import reactor
+                    self._reactor = reactor
+                self._started = SimpleQueue()
+                self._pool = self._pool_factory(
+                    self.processes, _init_worker, (self._started,),
+                    maxtasksperchild=self.max_tasks)
+                self._reactor.addSystemEventTrigger(
+                    'during', 'shutdown', self.stop)
+
+            task = self._queue.popleft()
+            task.running = True
+            task.key = next(self._keys)
+            self._tasks[task.key] = task
+            # The callback is called in a thread of the pool.
+            self._pool.apply_async(
+                _run, (task.key, task.f, task.args, task.kwargs),
+                callback=lambda outcome, task=task:
+                    self._reactor.callFromThread(self._done, task, outcome))
+
+        if self._tasks and self._check is None:
+            self._check = self._reactor.callLater(self.check_interval,
+                                                  self._check_workers)
+
+
+    def _check_workers(self):
+        """
+        Fail the calls whose worker processes have gone.
+
+        A process may end once it has sent the result of its last call, so
+        a call only fails if its process was gone at the previous check too,
+        by when its result would have come back.
+        """
+        self._check = None
+        while not self._started.empty():
+            key, pid = self._started.get()
+            if key in self._tasks:
+                self._tasks[key].pid = pid
+
+        for task in self._tasks.values():
+            if task.pid is None or _alive(task.pid):
+                continue
+            if not task.gone:
+                task.gone = True
+                continue
+
+            del self._tasks[task.key]
+            task.running = False
+            if not task.deferred.called:
+                task.deferred.errback(RemoteError(
+                    "The worker process running %r died" % (task.f,), None))
+
+        self._submit()
+
+
+    def _done(self, task, outcome):
+        # A call whose process was found to have gone has failed already.
+        if self._tasks.get(task.key) is not task:
+            return
+        del self._tasks[task.key]
+        task.running = False
+        self._submit()
+
+        if task.deferred.called:
+            return
+        try:
+            succeeded, result = pickle.loads(outcome)
+        except Exception:
+            succeeded, result = False, RemoteError(
+                "The outcome of %r couldn't be unpickled" % (task.f,),
+                traceback.format_exc())
+        if succeeded:
+            task.deferred.callback(result)
+        else:
+            task.deferred.errback(Failure(result))
+
+
+    def _cancel(self, task):
+        if not task.running:
+            try:
+                self._queue.remove(task)
+            except ValueError:
+                pass
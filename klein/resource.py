@@ -1,16 +1,30 @@
+import zlib
+
+from collections import Iterator
+from functools import partial
+from StringIO import StringIO
+
+from zope.interface import implements
+
 from twisted.web.resource import Resource, IResource, getChildForRequest
 from twisted.web.iweb import IRenderable
-from twisted.web.template import flattenString
-from twisted.web import server
+from twisted.web.template import flatten, flattenString
+from twisted.web import http, server
 
 from twisted.python import log
+from twisted.python.failure import Failure
 
 from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 
 
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import (HTTPException, NotFound, MethodNotAllowed,
+                                 ServiceUnavailable)
+from werkzeug.routing import RequestRedirect
 
-from klein.interfaces import IKleinRequest
+from klein.cache import LRUCache
+from klein.deadlines import _enforce
+from klein.templates import CachedFragment
 
 __all__ = ["KleinResource", "ensure_utf8_bytes"]
 
@@ -25,151 +39,979 @@ def ensure_utf8_bytes(v):
     return v
 
 
-class StandInResource(object):
+_defaultResponses = LRUCache(256)
+
+
+def _http_exception_response(he):
     """
-    A standin for a Resource.
+    Return the response code, headers and body werkzeug would send for
+    C{he}.
+
+    The responses to the exceptions raised while routing are remembered, so
+    that a flood of requests for URLs which don't exist doesn't build the
+    same werkzeug response over and over again.
+
+    @param he: An C{HTTPException}.
+    @return: A C{(code, headers, body)} tuple, where C{headers} is a C{list}
+        of C{(name, value)} tuples.
     """
+    key = None
+    if getattr(he, "response", None) is None:
+        if type(he) is NotFound:
+            key = (NotFound, he.description)
+        elif type(he) is MethodNotAllowed:
+            key = (MethodNotAllowed, he.description,
+                   tuple(he.valid_methods or ()))
+        elif type(he) is RequestRedirect:
+            key = (RequestRedirect, he.new_url)
 
+    if key is not None:
+        response = _defaultResponses.get(key)
+        if response is not None:
+            return response
 
-class KleinResource(Resource):
+    headers = [(ensure_utf8_bytes(name), ensure_utf8_bytes(value))
+               for name, value in he.get_response({}).headers]
+    response = (he.code, headers, ensure_utf8_bytes(he.get_body({})))
+
+    if key is not None:
+        _defaultResponses.set(key, response)
+    return response
+
+
+# The response to requests turned away by a ConcurrencyLimit, which is built
+# once since it is sent when the server can least afford to build it.
+_overloaded = _http_exception_response(ServiceUnavailable())
+
+
+def _shed(request, limit):
     """
-    A ``Resource`` that can do URL routing.
+    Answer C{request}, which C{limit} turned away, with C{503 Service
+    Unavailable}.
+
+    @return: The body of the response.
     """
-    isLeaf = True
+    code, headers, body = _overloaded
+    request.setResponseCode(code)
+    for name, value in headers:
+        request.setHeader(name, value)
+    request.setHeader('retry-after', str(limit.retry_after))
+    return body
 
 
-    def __init__(self, app):
-        Resource.__init__(self)
-        self._app = app
+def _hold(request, limit):
+    """
+    Give back the slot of C{limit} taken for C{request} once it is finished,
+    or its connection has gone away.
+    """
+    request.notifyFinish().addBoth(lambda ignored: limit.release())
 
 
-    def render(self, request):
-        # Stuff we need to know for the mapper.
-        server_name = request.getRequestHostname()
-        server_port = request.getHost().port
-        if (bool(request.isSecure()), server_port) not in [
-                (True, 443), (False, 80)]:
-            server_name = '%s:%d' % (server_name, server_port)
-        script_name = ''
-        if request.prepath:
-            script_name = '/'.join(request.prepath)
+def _finished(request):
+    """
+    Whether C{request} has been finished or its connection has gone away.
+    """
+    return request.finished or request._disconnected
 
-            if not script_name.startswith('/'):
-                script_name = '/' + script_name
 
-        path_info = ''
-        if request.postpath:
-            path_info = '/'.join(request.postpath)
+def _quote_etag(etag):
+    """
+    Return C{etag} as an entity tag, quoting it unless it already is one.
+    """
+    if etag.startswith('"') or etag.startswith('W/"'):
+        return etag
+    return '"%s"' % (etag,)
 
-            if not path_info.startswith('/'):
-                path_info = '/' + path_info
 
-        url_scheme = 'https' if request.isSecure() else 'http'
-        # Bind our mapper.
-        mapper = self._app.url_map.bind(server_name, script_name, path_info=path_info,
-            default_method=request.method, url_scheme=url_scheme)
-        # Make the mapper available to the view.
-        kleinRequest = IKleinRequest(request)
-        kleinRequest.mapper = mapper
-
-        # Make sure we'll notice when the connection goes away unambiguously.
-        request_finished = [False]
-
-        def _finish(result):
-            request_finished[0] = True
-
-        def _execute():
-            # Actually doing the match right here. This can cause an exception
-            # to percolate up. If that happens it will be handled below in
-            # processing_failed, either by a user-registered error handler or
-            # one of our defaults.
-            (rule, kwargs) = mapper.match(return_rule=True)
-            endpoint = rule.endpoint
+def _opaque_tag(etag):
+    """
+    Return C{etag} without the marker of a weak entity tag, if it has one,
+    since C{If-None-Match} is compared weakly.
+    """
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
 
-            # Try pretty hard to fix up prepath and postpath.
-            segment_count = self._app.endpoints[endpoint].segment_count
-            request.prepath.extend(request.postpath[:segment_count])
-            request.postpath = request.postpath[segment_count:]
 
-            request.notifyFinish().addBoth(_finish)
+def _not_modified(request, etag):
+    """
+    Whether the client making the conditional C{request} already has the
+    response to it, whose entity tag is C{etag} and whose last modification
+    time is the C{lastModified} of C{request}.
 
-            # Standard Twisted Web stuff. Defer the method action, giving us
-            # something renderable or printable. Return NOT_DONE_YET and set up
-            # the incremental renderer.
-            d = defer.maybeDeferred(self._app.execute_endpoint,
-                                    endpoint,
-                                    request,
-                                    **kwargs)
+    C{If-None-Match} takes precedence over C{If-Modified-Since}, which is
+    only looked at if the request doesn't have it.
 
-            request.notifyFinish().addErrback(lambda _: d.cancel())
+    @param etag: The entity tag of the response, or C{None}.
+    """
+    tags = request.getHeader('if-none-match')
+    if tags:
+        tags = [_opaque_tag(tag.strip()) for tag in tags.split(',')]
+        return '*' in tags or (etag is not None and
+                               _opaque_tag(etag) in tags)
+
+    since = request.getHeader('if-modified-since')
+    if since and request.lastModified is not None:
+        try:
+            since = http.stringToDatetime(since.split(';', 1)[0])
+        except ValueError:
+            return False
+        return since >= request.lastModified
+    return False
+
+
+def _encoded_etag(etag, encoding):
+    """
+    Return the entity tag of the response whose entity tag is C{etag} once
+    compressed with the content coding C{encoding}, so that clients can tell
+    the two apart.
+    """
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], encoding)
+    return etag
 
-            return d
 
-        d = defer.maybeDeferred(_execute)
+# Twisted only passes what is written to a request through its encoder
+# from version 12.3.
+_STREAM_ENCODING = hasattr(server.Request, '_encoder')
 
-        def write_response(r):
-            if not isinstance(r, StandInResource):
-                if isinstance(r, unicode):
-                    r = r.encode('utf-8')
 
-                if r is not None:
-                    request.write(r)
+def _start_encoding(request):
+    """
+    Compress a streamed response to C{request} as it is written, if its
+    route compresses responses, nothing has been written yet and this
+    version of Twisted can.
+    """
+    compression = getattr(request, '_klein_compression', None)
+    if (compression is None or not _STREAM_ENCODING or
+            request.startedWriting or request.code in http.NO_BODY_CODES):
+        return
+
+    encoding = compression.encoding(request)
+    if encoding is not None:
+        request.responseHeaders.setRawHeaders('content-encoding', [encoding])
+        request.responseHeaders.removeHeader('content-length')
+        if request.etag is not None:
+            request.etag = _encoded_etag(request.etag, encoding)
+        request._encoder = compression.encoder(encoding)
+
+
+def _write_response(request, body, etags=False):
+    """
+    Write C{body}, a C{str}, C{unicode} or C{None}, as the response to
+    C{request} and finish it if that hasn't happened already.
+
+    @param etags: If C{True}, give a successful response to a C{GET} or
+        C{HEAD} request which hasn't been written yet an entity tag, unless it
+        has one, computed from the length and CRC-32 of C{body}.  If the
+        client already has the response, answer with C{304 Not Modified}
+        and no body instead.
+
+    If the route of C{request} compresses its responses, C{body} is
+    compressed when its client accepts it.  Unless something was written
+    already, the response is given a C{Content-Length}.
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    compression = getattr(request, '_klein_compression', None)
+    encoding = None
+    if (compression is not None and body and not request.startedWriting and
+            request.code not in http.NO_BODY_CODES):
+        encoding = compression.encoding(request, len(body))
+
+    etag = request.etag
+    if etag is None and (etags or encoding is not None):
+        etag = request.responseHeaders.getRawHeaders('etag', [None])[0]
+
+    if (etags and request.code == http.OK and not request.startedWriting
+            and request.method in ('GET', 'HEAD')):
+        if etag is None:
+            data = body or ''
+            etag = '"%x-%08x"' % (len(data), zlib.crc32(data) & 0xffffffff)
+        if encoding is not None:
+            etag = _encoded_etag(etag, encoding)
+        request.etag = etag
+
+        if _not_modified(request, etag):
+            request.setResponseCode(http.NOT_MODIFIED)
+    elif etag is not None and encoding is not None:
+        request.etag = _encoded_etag(etag, encoding)
+
+    # Responses such as the 304s of Request.setETag have no body.
+    if request.code in http.NO_BODY_CODES:
+        body = None
+    elif encoding is not None:
+        # Responses from the response cache keep their compressed variants.
+        cached = getattr(request, '_klein_cached', None)
+        make = partial(compression.compress, encoding)
+        if cached is not None:
+            responses, entry = cached
+            body = responses.variant(entry, (encoding, compression.level),
+                                     make)
+        else:
+            body = make(body)
+        request.responseHeaders.setRawHeaders('content-encoding', [encoding])
+        # A length the endpoint set is the length of the uncompressed body.
+        request.responseHeaders.removeHeader('content-length')
+
+    # The whole body is known before anything is written, so it can be sent
+    # with a Content-Length rather than chunked, unless it is being encoded
+    # as it is written.
+    if (not request.startedWriting and request.code not in http.NO_BODY_CODES
+            and getattr(request, '_encoder', None) is None
+            and not request.responseHeaders.hasHeader('content-length')):
+        request.responseHeaders.setRawHeaders('content-length',
+                                              [str(len(body or ''))])
+
+    if body is not None:
+        request.write(body)
+
+    if not _finished(request):
+        request.finish()
+
+
+def _revalidation_request(request):
+    """
+    Return a copy of C{request}, as it is before being routed, which keeps
+    its response to itself.  It is rendered to replace a stale cached
+    response.
+    """
+    shadow = server.Request(None, True)
+    for name in ('method', 'uri', 'path', 'clientproto', 'client', 'host',
+                 'site', 'sitepath'):
+        setattr(shadow, name, getattr(request, name, None))
+    shadow.args = dict([(name, list(values))
+                        for name, values in (request.args or {}).items()])
+    shadow.requestHeaders = request.requestHeaders.copy()
+    shadow.content = StringIO()
+    shadow.prepath = list(request.prepath)
+    shadow.postpath = list(request.postpath)
+    shadow._forceSSL = request.isSecure()
+    shadow._klein_revalidating = True
+    return shadow
+
+
+def _request_key(request, endpoint, bind_args, vary):
+    """
+    Return a key identifying the requests for C{endpoint} which are the same
+    as C{request}: they have the same method, host, URI and values of the
+    request headers named in C{vary}.
+    """
+    return (endpoint, bind_args, request.uri,
+            tuple([request.getHeader(name) for name in vary]))
 
-                if not request_finished[0]:
-                    request.finish()
 
-        def process(r):
-            if IResource.providedBy(r):
-                request.render(getChildForRequest(r, request))
-                return StandInResource()
 
-            if IRenderable.providedBy(r):
-                return flattenString(request, r).addCallback(process)
+class _SharedCall(object):
+    """
+    A call to an endpoint whose result is sent to every identical request
+    which arrives while it is running, rather than calling the endpoint
+    again for each of them.
+
+    Every request waits on a L{defer.Deferred} of its own, so one of them
+    going away cancels only its own wait.  The call itself is cancelled once
+    nothing waits for it any more.
+
+    Requests other than the one the endpoint was called with get the
+    response code and headers it set, except for cookies.
+
+    An iterator can only be streamed to one request, so if the result is one
+    the endpoint is called again for each of the other requests.
+
+    @ivar _request: The request the endpoint was called with.
+    @ivar _deferred: The L{defer.Deferred} returned by the endpoint.
+    @ivar _waiters: A C{list} of C{(request, deferred)} tuples.
+    @ivar _call: A callable taking a request and calling the endpoint for it.
+    @ivar _calls: A C{dict} mapping the L{defer.Deferred}s of requests the
+        endpoint was called again for to the L{defer.Deferred}s it returned
+        for them.
+    """
+    __slots__ = ('_request', '_deferred', '_waiters', '_call', '_calls')
+
+    def __init__(self, request, deferred, done, call):
+        self._request = request
+        self._deferred = deferred
+        self._waiters = []
+        self._call = call
+        self._calls = {}
+        deferred.addBoth(self._fire, done)
+
+
+    def wait(self, request):
+        """
+        Return a L{defer.Deferred} which fires with the result of the call
+        for C{request}.
+        """
+        d = defer.Deferred(self._cancelled)
+        self._waiters.append((request, d))
+        return d
+
+
+    def _cancelled(self, d):
+        if d in self._calls:
+            self._calls.pop(d).cancel()
+            return
+        self._waiters = [(request, waiter) for request, waiter in
+                         self._waiters if waiter is not d]
+        if not self._waiters:
+            self._deferred.cancel()
+
+
+    def _fire(self, result, done):
+        done()
+        waiters, self._waiters = self._waiters, []
+        for request, d in waiters:
+            if request is not self._request and isinstance(result, Iterator):
+                self._recall(request, d)
+                continue
+
+            if request is not self._request:
+                request.setResponseCode(self._request.code,
+                                        self._request.code_message)
+                for name, values in (
+                        self._request.responseHeaders.getAllRawHeaders()):
+                    if name.lower() != 'set-cookie':
+                        request.responseHeaders.setRawHeaders(name, values)
+
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def _recall(self, request, d):
+        """
+        Call the endpoint again for C{request}, and fire C{d}, which it is
+        waiting on, with the result.
+        """
+        try:
+            result = self._call(request)
+        except:
+            d.errback()
+            return
+
+        if not isinstance(result, defer.Deferred):
+            d.callback(result)
+            return
+
+        def _fired(result):
+            self._calls.pop(d, None)
+            return result
+
+        self._calls[d] = result
+        result.addBoth(_fired).chainDeferred(d)
 
-            return r
 
-        d.addCallback(process)
 
-        def processing_failed(failure, error_handlers):
-            # The failure processor writes to the request.  If the
-            # request is already finished we should suppress failure
-            # processing.  We don't return failure here because there
-            # is no way to surface this failure to the user if the
-            # request is finished.
-            if request_finished[0]:
-                if not failure.check(defer.CancelledError):
-                    log.err(failure, _why="Unhandled Error Processing Request.")
-                return
+class StandInResource(object):
+    """
+    A standin for a Resource.
+    """
 
-            # If there are no more registered handlers, apply some defaults
-            if len(error_handlers) == 0:
-                if failure.check(HTTPException):
-                    he = failure.value
-                    request.setResponseCode(he.code)
-                    resp = he.get_response({})
 
-                    for header, value in resp.headers:
-                        request.setHeader(ensure_utf8_bytes(header), ensure_utf8_bytes(value))
+def _cancel(reason, d):
+    """
+    Cancel C{d} because the request it is producing the response for went
+    away.
+    """
+    d.cancel()
 
-                    return ensure_utf8_bytes(he.get_body({}))
-                else:
-                    request.processingFailed(failure)
+
+class _IteratorProducer(object):
+    """
+    A producer which streams the chunks produced by an iterator, such as a
+    generator returned by an endpoint, to a request, pausing whenever the
+    transport asks it to.
+
+    The iterator may produce C{str}, C{unicode} or C{None} chunks, or
+    L{Deferred}s which fire with one; the next chunk isn't asked for until
+    the L{Deferred} has fired.
+
+    @ivar _request: The L{server.Request} being responded to.
+    @ivar _iterator: The iterator producing the chunks.
+    @ivar _done: A L{Deferred} which fires with a L{StandInResource} when the
+        response is complete, or with the failure of the iterator if it
+        failed before anything was written.  Cancelling it stops the
+        iterator.
+    @ivar _waiting: The L{Deferred} produced by the iterator which is being
+        waited for, if any.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, request, iterator):
+        self._request = request
+        self._iterator = iterator
+        self._done = defer.Deferred(self._cancelled)
+        self._waiting = None
+        self._paused = False
+        self._producing = False
+        self._stopped = False
+
+
+    def start(self):
+        """
+        Start streaming to the request.
+
+        @return: L{_done}
+        """
+        if _finished(self._request):
+            self._close()
+            return defer.succeed(StandInResource())
+
+        self._request.registerProducer(self, True)
+        self._produce()
+        return self._done
+
+
+    def pauseProducing(self):
+        self._paused = True
+
+
+    def resumeProducing(self):
+        self._paused = False
+        self._produce()
+
+
+    def stopProducing(self):
+        self._done.cancel()
+
+
+    def _produce(self):
+        if self._producing:
+            return
+        self._producing = True
+        try:
+            while (not self._paused and not self._stopped and
+                   self._waiting is None):
+                try:
+                    chunk = next(self._iterator)
+                    if not isinstance(chunk, defer.Deferred):
+                        self._write(chunk)
+                        continue
+                except StopIteration:
+                    self._end()
+                    return
+                except:
+                    self._fail(Failure())
                     return
 
-            error_handler = error_handlers[0]
+                self._waiting = chunk
+                chunk.addCallbacks(self._resume, self._fail)
+        finally:
+            self._producing = False
+
+
+    def _resume(self, chunk):
+        self._waiting = None
+        if not self._stopped:
+            try:
+                self._write(chunk)
+            except:
+                self._fail(Failure())
+            else:
+                self._produce()
+
+
+    def _write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        elif chunk is not None and not isinstance(chunk, str):
+            raise TypeError("Response chunks must be str, unicode or None, "
+                            "not %r" % (chunk,))
+        if chunk:
+            if not self._request.startedWriting:
+                _start_encoding(self._request)
+            self._request.write(chunk)
+
+
+    def _end(self):
+        self._stopped = True
+        self._request.unregisterProducer()
+        if not _finished(self._request):
+            self._request.finish()
+        self._done.callback(StandInResource())
+
+
+    def _fail(self, failure):
+        self._waiting = None
+        if self._stopped:
+            if not failure.check(defer.CancelledError):
+                log.err(failure, "Unhandled Error streaming response")
+            return
+
+        self._stopped = True
+        self._request.unregisterProducer()
+        self._close()
+
+        # Nothing has been sent yet, so the failure can still be turned into
+        # an error response.  Otherwise the client must not be led to
+        # believe it got the whole response.
+        if not self._request.startedWriting:
+            self._done.errback(failure)
+            return
+
+        log.err(failure, "Unhandled Error streaming response")
+        if not _finished(self._request):
+            self._request.transport.loseConnection()
+        self._done.callback(StandInResource())
+
+
+    def _cancelled(self, d):
+        self._stopped = True
+        if not _finished(self._request):
+            self._request.unregisterProducer()
+        self._close()
+        if self._waiting is not None:
+            self._waiting.cancel()
+
+
+    def _close(self):
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except:
+                log.err(None, "Unhandled Error closing response iterator")
+
+
+
+class _CoalescingWriter(object):
+    """
+    Collects the many small strings produced by flattening a renderable and
+    writes them to a request in chunks of at least C{chunk_size} bytes.
+
+    @ivar _request: The L{server.Request} to write to.
+    @ivar _chunk_size: The number of bytes to collect before writing them.
+    @ivar _buffer: A C{list} of the strings collected since the last write.
+    @ivar _buffered: The total length of C{_buffer}.
+    @ivar flushed: Whether anything has been written to the request.
+    """
+    __slots__ = ('_request', '_chunk_size', '_buffer', '_buffered', 'flushed')
+
+    def __init__(self, request, chunk_size):
+        self._request = request
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+        self.flushed = False
+
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._chunk_size:
+            data = self.remaining()
+            if not _finished(self._request):
+                if not self.flushed:
+                    _start_encoding(self._request)
+                self.flushed = True
+                self._request.write(data)
+
+
+    def remaining(self):
+        """
+        Return everything collected since the last write, and forget it.
+        """
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        return data
+
+
+    def succeeded(self, ignored):
+        """
+        Return whatever is left after the last full chunk, to be written as
+        the end of the response.
+        """
+        return self.remaining() or None
+
+
+    def failed(self, failure):
+        """
+        Handle the failure of flattening.
+
+        If nothing has been written yet the failure is returned so that it
+        can be given to the error handlers.  Otherwise it is too late for an
+        error response; the failure is logged and the connection dropped, so
+        that the client can't mistake the partial page for a complete one.
+        """
+        self.remaining()
+        if not self.flushed:
+            return failure
+
+        if not failure.check(defer.CancelledError):
+            log.err(failure, "Unhandled Error flattening response")
+        if not _finished(self._request):
+            self._request.transport.loseConnection()
+        return StandInResource()
+
+
+
+class _Dispatch(object):
+    """
+    The state of a request whose endpoint didn't return its response body
+    straight away.  Its methods are the callbacks which turn the result of
+    the endpoint into the response.
+
+    @ivar _app: The L{Klein} application.
+    @ivar _request: The L{server.Request} being responded to.
+    @ivar _store: A callable which caches the body of the response, or
+        C{None}.
+    """
+    __slots__ = ('_app', '_request', '_store')
 
-            # Each error handler is a tuple of (list_of_exception_types, handler_fn)
-            if failure.check(*error_handler[0]):
+    def __init__(self, app, request, store=None):
+        self._app = app
+        self._request = request
+        self._store = store
+
+
+    def process(self, r):
+        request = self._request
+        if IResource.providedBy(r):
+            request.render(getChildForRequest(r, request))
+            return StandInResource()
+
+        if isinstance(r, CachedFragment):
+            return r.flatten(request)
+
+        if IRenderable.providedBy(r):
+            chunk_size = self._app._flatten_chunk_size
+            if chunk_size:
+                writer = _CoalescingWriter(request, chunk_size)
+                return flatten(request, r, writer.write).addCallbacks(
+                    writer.succeeded, writer.failed)
+            return flattenString(request, r).addCallback(self.process)
+
+        if isinstance(r, Iterator):
+            return _IteratorProducer(request, r).start()
+
+        return r
+
+
+    def processing_failed(self, failure, start):
+        request = self._request
+        # The failure processor writes to the request.  If the
+        # request is already finished we should suppress failure
+        # processing.  We don't return failure here because there
+        # is no way to surface this failure to the user if the
+        # request is finished.
+        if _finished(request):
+            if not failure.check(defer.CancelledError):
+                log.err(failure, _why="Unhandled Error Processing Request.")
+            return
+
+        # Give the failure to the first handler for its type which was
+        # registered at or after position start.  If that handler fails
+        # too its failure is given to the handlers registered after it.
+        for position, handler in self._app._error_handlers_for(failure.type):
+            if position >= start:
                 d = defer.maybeDeferred(self._app.execute_error_handler,
-                                        error_handler[1],
+                                        handler,
                                         request,
                                         failure)
 
-                return d.addErrback(processing_failed, error_handlers[1:])
+                return d.addErrback(self.processing_failed, position + 1)
+
+        # If there are no more registered handlers, apply some defaults
+        if failure.check(HTTPException):
+            code, headers, body = _http_exception_response(failure.value)
+            request.setResponseCode(code)
+
+            for header, value in headers:
+                request.setHeader(header, value)
+
+            return body
+        else:
+            request.processingFailed(failure)
+            return
+
+
+    def write_response(self, r):
+        if not isinstance(r, StandInResource):
+            if self._store is not None:
+                self._store(r)
+            _write_response(self._request, r, self._app._etags)
+
 
-            return processing_failed(failure, error_handlers[1:])
+class KleinResource(Resource):
+    """
+    A ``Resource`` that can do URL routing.
+    """
+    isLeaf = True
 
 
-        d.addErrback(processing_failed, self._app._error_handlers)
-        d.addCallback(write_response).addErrback(log.err, _why="Unhandled Error writing response")
+    def __init__(self, app):
+        Resource.__init__(self)
+        self._app = app
+
+
+    def _match(self, bind_args, path_info):
+        """
+        Find the rule matching a request, trying the application's match
+        cache and compiled router before werkzeug.
+
+        Requests which don't match any rule are remembered in the
+        application's miss cache, if it has one.
+
+        @param bind_args: The C{(server_name, script_name, url_scheme,
+            method)} of the request.
+
+        @return: A C{(rule, kwargs)} tuple.
+        @raise werkzeug.exceptions.HTTPException: If no rule matches.
+        """
+        server_name, method = bind_args[0], bind_args[3]
+        key = (method, server_name, path_info)
+        cache = self._app._match_cache
+        if cache is not None:
+            match = cache.get(key)
+            if match is not None:
+                return match
+
+        match = None
+        if self._app._router is not None:
+            match = self._app._router.match(path_info, method)
+        if match is None:
+            try:
+                mapper = self._app._adapters.bind(*bind_args)
+                match = mapper.match(path_info, return_rule=True)
+            except (NotFound, MethodNotAllowed) as e:
+                if self._app._miss_cache is not None:
+                    self._app._miss_cache.set(key, e)
+                raise
+
+        if cache is not None:
+            cache.set(key, match)
+        return match
+
+
+    def _cached(self, request, policy, endpoint, bind_args):
+        """
+        Look up the cached response to C{request}.
+
+        A stale response is still used, but a copy of C{request} is rendered
+        soon after to replace it.
+
+        @return: A C{(body, store)} tuple.  If a response was cached, C{body}
+            is its body and its headers have been set on C{request}.
+            Otherwise C{body} is C{None} and C{store} a callable which
+            caches the body of the response when it is called with it.
+        """
+        responses = self._app._responses
+        key = _request_key(request, endpoint, bind_args, policy.vary)
+
+        if not getattr(request, '_klein_revalidating', False):
+            entry, fresh = responses.get(endpoint, key)
+            if entry is not None:
+                if not fresh and not entry.refreshing:
+                    entry.refreshing = True
+                    responses.clock.callLater(
+                        0, self._revalidate, _revalidation_request(request))
+
+                for name, values in entry.headers:
+                    request.responseHeaders.setRawHeaders(name, values)
+                request._klein_cached = (responses, entry)
+                return entry.body, None
+
+        return None, partial(responses.store, policy, key, request)
+
+
+    def _revalidate(self, request):
+        """
+        Render C{request}, made by L{_revalidation_request}, so that its
+        response replaces the stale one in the cache.
+        """
+        try:
+            self.render(request)
+        except:
+            log.err(None, "Unhandled Error revalidating cached response")
+
+
+    def _call_endpoint(self, request, endpoint, kwargs, limits):
+        """
+        Call C{endpoint} for C{request} with C{kwargs} once C{request} holds
+        a slot of each of the L{ConcurrencyLimit}s C{limits} which has a
+        limit, taken in turn so that a request waiting for one of them
+        doesn't hold the slots of the others.
+
+        @return: The result of the endpoint, or a L{defer.Deferred} firing
+            with it if the request has to wait.  If too many requests are
+            waiting for one of the slots, the endpoint isn't called and the
+            body of a C{503 Service Unavailable} response is returned
+            instead.
+        """
+        for index, limit in enumerate(limits):
+            if limit.limit is None:
+                continue
+            if limit.try_acquire():
+                _hold(request, limit)
+                continue
+
+            d = limit.acquire()
+            if d is None:
+                return _shed(request, limit)
+
+            def _acquired(ignored, limit=limit, rest=limits[index + 1:]):
+                _hold(request, limit)
+                return self._call_endpoint(request, endpoint, kwargs, rest)
+            return d.addCallback(_acquired)
+        return self._app.execute_endpoint(endpoint, request, **kwargs)
+
+
+    def _coalesced(self, key, request, call):
+        """
+        Call C{call} for C{request} unless an identical request, with the
+        same C{key}, is already waiting for it to return, and if so wait for
+        the same result.
+
+        @param call: A callable taking the request to call the endpoint for.
+        """
+        in_flight = self._app._in_flight
+        shared = in_flight.get(key)
+        if shared is None:
+            result = call(request)
+            if not isinstance(result, defer.Deferred) or result.called:
+                return result
+
+            shared = in_flight[key] = _SharedCall(
+                request, result, partial(in_flight.pop, key, None), call)
+        return shared.wait(request)
+
+
+    def _execute(self, request, bind_args, path_info):
+        """
+        Match C{request} and call the endpoint for it, unless its response
+        is cached.
+
+        @return: A C{(result, store)} tuple, where C{result} is whatever the
+            endpoint returned, or a L{Failure} if matching the request or
+            calling the endpoint raised an exception, and C{store} is
+            C{None} or a callable which caches the body of the response.
+        """
+        store = None
+        try:
+            # Actually doing the match right here. If this fails the failure
+            # will be handled by processing_failed, either by a
+            # user-registered error handler or one of our defaults.
+            try:
+                (rule, kwargs) = self._match(bind_args, path_info)
+            except HTTPException as e:
+                # Not matching is routine, so don't capture a traceback.
+                return Failure(e), None
+            endpoint = rule.endpoint
+            endpoint_f = self._app.endpoints[endpoint]
+
+            if endpoint_f.compression is not None:
+                request._klein_compression = endpoint_f.compression
+
+            timeout = endpoint_f.timeout
+            if timeout is None:
+                timeout = self._app._timeout
+            if timeout:
+                clock = self._app.clock
+                request._klein_deadline = (clock, clock.seconds() + timeout)
+
+            cached = None
+            policy = endpoint_f.cache_policy
+            if policy is not None and request.method in ('GET', 'HEAD'):
+                cached, store = self._cached(request, policy, endpoint,
+                                             bind_args)
+
+            # Try pretty hard to fix up prepath and postpath.
+            segment_count = endpoint_f.segment_count
+            request.prepath.extend(request.postpath[:segment_count])
+            request.postpath = request.postpath[segment_count:]
+
+            if cached is not None:
+                return cached, None
+
+            coalesce = endpoint_f.coalesce
+            if coalesce is not None and request.method in ('GET', 'HEAD'):
+                result = self._coalesced(
+                    _request_key(request, endpoint, bind_args, coalesce),
+                    request, partial(self._call_endpoint, endpoint=endpoint,
+                                     kwargs=kwargs, limits=endpoint_f.limits))
+            else:
+                result = self._call_endpoint(request, endpoint, kwargs,
+                                             endpoint_f.limits)
+
+            # A cached fragment is usually flattened already.
+            if isinstance(result, CachedFragment):
+                result = result.flatten(request)
+            return result, store
+        except:
+            return Failure(), None
+
+
+    def render(self, request):
+        # Stuff we need to know for the mapper.
+        server_name = request.getRequestHostname()
+        server_port = request.getHost().port
+        if (bool(request.isSecure()), server_port) not in [
+                (True, 443), (False, 80)]:
+            server_name = '%s:%d' % (server_name, server_port)
+        script_name = ''
+        if request.prepath:
+            script_name = '/'.join(request.prepath)
+
+            if not script_name.startswith('/'):
+                script_name = '/' + script_name
+
+        path_info = ''
+        if request.postpath:
+            path_info = '/'.join(request.postpath)
+
+            if not path_info.startswith('/'):
+                path_info = '/' + path_info
+
+        url_scheme = 'https' if request.isSecure() else 'http'
+        bind_args = (server_name, script_name, url_scheme, request.method)
+        # Leave what's needed to make a mapper available to the view.  It is
+        # only looked up if IKleinRequest(request).mapper is used.
+        request._klein_bind_args = (self._app._adapters, bind_args)
+
+        # Requests we already know don't match anything go straight to the
+        # error handlers, without matching again or capturing a traceback.
+        miss = None
+        if self._app._miss_cache is not None:
+            miss = self._app._miss_cache.get(
+                (request.method, server_name, path_info))
+
+        if miss is not None:
+            result, store = Failure(miss), None
+        else:
+            result, store = self._execute(request, bind_args, path_info)
+
+        # Most endpoints return their response body straight away, which can
+        # be written without setting up any of the machinery below.
+        if result is None or isinstance(result, (str, unicode)):
+            try:
+                if store is not None:
+                    store(result)
+                _write_response(request, result, self._app._etags)
+            except:
+                log.err(None, "Unhandled Error writing response")
+            return server.NOT_DONE_YET
+
+        # Standard Twisted Web stuff. Defer the method action, giving us
+        # something renderable or printable. Return NOT_DONE_YET and set up
+        # the incremental renderer.
+        if isinstance(result, defer.Deferred):
+            d = result
+        elif isinstance(result, Failure):
+            d = defer.fail(result)
+        else:
+            d = defer.succeed(result)
+
+        if d is result or isinstance(result, Iterator):
+            request.notifyFinish().addErrback(_cancel, d)
+        if (d is result and not d.called and
+                getattr(request, '_klein_deadline', None) is not None):
+            _enforce(request, d)
+
+        dispatch = _Dispatch(self._app, request, store)
+        d.addCallback(dispatch.process)
+        d.addErrback(dispatch.processing_failed, 0)
+        d.addCallback(dispatch.write_response).addErrback(log.err, _why="Unhandled Error writing response")
         return server.NOT_DONE_YET
@@ -0,0 +1,483 @@
+"""
+Fast URL dispatch on top of L{werkzeug.routing}.
+"""
+import hashlib
+import marshal
+import os
+
+import werkzeug
+from werkzeug.routing import parse_rule, RequestSlash, RequestAliasRedirect
+
+from klein.cache import LRUCache
+
+__all__ = ["CompiledRouter", "AdapterCache"]
+
+
+class _Node(object):
+    """
+    A node in the segment trie of a L{CompiledRouter}.
+
+    @ivar children: A C{dict} mapping a literal path segment to a child
+        L{_Node}.
+    @ivar rules: A C{list} of C{(index, rule)} tuples for rules whose literal
+        prefix ends at this node.
+    """
+    __slots__ = ('children', 'rules')
+
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+
+
+
+def _literal_prefix(rule):
+    """
+    Return the complete literal path segments a URL must start with to be
+    matched by C{rule}.
+    """
+    prefix = []
+    for converter, arguments, variable in parse_rule(rule.rule):
+        if converter is not None:
+            break
+        prefix.append(variable)
+    # The final piece is either empty or shares its segment with a converter,
+    # so only the segments before it are known in full.
+    return u''.join(prefix).split(u'/')[1:-1]
+
+
+
+_SNAPSHOT_VERSION = 1
+
+
+
+def _digest(url_map, rules, rules_by_endpoint):
+    """
+    Return a digest of the definitions of C{rules}, in order, and of the
+    settings of C{url_map} which affect matching.
+
+    The order matters because werkzeug tries rules which sort equally in the
+    order they were added.
+
+    @param rules: The rules of C{url_map}, as they were before it was
+        sorted.
+    @param rules_by_endpoint: A C{dict} mapping endpoints to their rules, as
+        it was before C{url_map} was sorted.
+    @rtype: C{str}
+    """
+    digest = hashlib.sha1(repr((
+        _SNAPSHOT_VERSION, werkzeug.__version__, url_map.host_matching,
+        url_map.redirect_defaults, url_map.strict_slashes,
+        sorted([(name, repr(converter))
+                for name, converter in url_map.converters.items()]))))
+
+    ids = {}
+    for i, rule in enumerate(rules):
+        ids[id(rule)] = i
+        digest.update(repr((
+            rule.rule, rule.endpoint,
+            sorted(rule.methods) if rule.methods is not None else None,
+            sorted(rule.defaults.items()) if rule.defaults else None,
+            rule.strict_slashes, rule.build_only, rule.redirect_to,
+            rule.subdomain, rule.alias, rule.host)) + '\n')
+
+    digest.update(repr(sorted([
+        (endpoint, [ids[id(rule)] for rule in endpointRules])
+        for endpoint, endpointRules in rules_by_endpoint.iteritems()])))
+    return digest.hexdigest()
+
+
+
+def _dump_node(node):
+    return (dict([(segment, _dump_node(child))
+                  for segment, child in node.children.iteritems()]),
+            [index for index, rule in node.rules])
+
+
+
+def _load_node(dumped, rules):
+    node = _Node()
+    children, indices = dumped
+    for segment, child in children.iteritems():
+        node.children[segment] = _load_node(child, rules)
+    node.rules = [(index, rules[index]) for index in indices]
+    return node
+
+
+
+class CompiledRouter(object):
+    """
+    A dispatcher which answers the same question as
+    C{MapAdapter.match(return_rule=True)} without trying every rule in turn.
+
+    Rules without converters are looked up in a C{dict} keyed on their path.
+    The remaining rules are indexed in a trie on their leading literal
+    segments, so only rules which could possibly match a path have their
+    regular expression run against it, in the same order werkzeug would try
+    them.
+
+    Anything the router cannot answer exactly (misses, redirects, rules with
+    C{redirect_to}, aliases or default redirects, and maps using subdomains
+    or host matching) makes L{match} return C{None} so that the caller can
+    fall back to werkzeug.
+
+    The compiled tables, along with the order werkzeug sorts the rules of the
+    map in, can be exported with L{snapshot} or L{save} and restored by
+    another process defining the same rules with L{restore} or L{load},
+    which saves sorting the rules and building the tables again.
+
+    @ivar _url_map: The C{werkzeug.routing.Map} to dispatch on.
+    """
+
+    def __init__(self, url_map):
+        self._url_map = url_map
+        self._compiled = False
+
+
+    def invalidate(self):
+        """
+        Forget the compiled tables; they will be rebuilt on the next
+        L{match}.
+        """
+        self._compiled = False
+
+
+    def compile(self):
+        """
+        Build the dispatch tables from the current rules of the map.
+        """
+        url_map = self._url_map
+        # Remember the rules as they were before werkzeug sorts them, which
+        # is what a snapshot of these tables must be restored on top of.
+        self._source = (list(url_map._rules),
+                        dict([(endpoint, list(rules)) for endpoint, rules
+                              in url_map._rules_by_endpoint.iteritems()]))
+        url_map.update()
+
+        self._static = {}
+        self._root = _Node()
+        self._delegate = set()
+        self._enabled = not url_map.host_matching
+
+        for index, rule in enumerate(url_map._rules):
+            if rule.build_only:
+                continue
+
+            if rule.subdomain:
+                self._enabled = False
+
+            if (rule.redirect_to is not None or
+                    (rule.alias and url_map.redirect_defaults) or
+                    (url_map.redirect_defaults and
+                     self._hasDefaultRedirect(rule))):
+                self._delegate.add(index)
+
+            entry = (index, rule)
+            if not rule.arguments:
+                self._static.setdefault(rule.rule, []).append(entry)
+                if not rule.is_leaf:
+                    self._static.setdefault(
+                        rule.rule.rstrip(u'/'), []).append(entry)
+                continue
+
+            node = self._root
+            for segment in _literal_prefix(rule):
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _Node()
+                node = child
+            node.rules.append(entry)
+
+        self._compiled = True
+
+
+    def snapshot(self):
+        """
+        Return the compiled tables and the order of the rules of the map as
+        plain data.
+
+        Rules are identified by the position they had in the map before it
+        was sorted, so a snapshot taken in one process can be restored in
+        another which added the same rules in the same order.
+
+        @return: A C{dict} of C{dict}s, C{list}s, C{tuple}s, strings and
+            integers.
+        """
+        if not self._compiled:
+            self.compile()
+
+        url_map = self._url_map
+        rules, rules_by_endpoint = self._source
+        digest = _digest(url_map, rules, rules_by_endpoint)
+        ids = dict([(id(rule), i) for i, rule in enumerate(rules)])
+
+        return {
+            'version': _SNAPSHOT_VERSION,
+            'digest': digest,
+            'order': [ids[id(rule)] for rule in url_map._rules],
+            'endpoints': dict([
+                (endpoint, [ids[id(rule)] for rule in endpointRules])
+                for endpoint, endpointRules
+                in url_map._rules_by_endpoint.iteritems()]),
+            'static': dict([
+                (path, [index for index, rule in entries])
+                for path, entries in self._static.iteritems()]),
+            'trie': _dump_node(self._root),
+            'delegate': sorted(self._delegate),
+            'enabled': self._enabled,
+        }
+
+
+    def restore(self, snapshot):
+        """
+        Install the tables from a L{snapshot} instead of compiling them, if
+        it was taken with the same rules.
+
+        @return: C{True} if the snapshot was restored, C{False} if it was
+            taken with different rules and the tables are left alone.
+        """
+        url_map = self._url_map
+        rules = list(url_map._rules)
+        digest = _digest(url_map, rules, url_map._rules_by_endpoint)
+        if (snapshot.get('version') != _SNAPSHOT_VERSION or
+                snapshot.get('digest') != digest):
+            return False
+
+        ordered = [rules[i] for i in snapshot['order']]
+        byEndpoint = dict([(endpoint, [rules[i] for i in indices])
+                           for endpoint, indices
+                           in snapshot['endpoints'].iteritems()])
+        static = dict([(path, [(index, ordered[index]) for index in indices])
+                       for path, indices in snapshot['static'].iteritems()])
+        root = _load_node(snapshot['trie'], ordered)
+        source = (rules, dict([(endpoint, list(endpointRules))
+                               for endpoint, endpointRules
+                               in url_map._rules_by_endpoint.iteritems()]))
+
+        url_map._rules[:] = ordered
+        url_map._rules_by_endpoint.update(byEndpoint)
+        url_map._remap = False
+
+        self._static = static
+        self._root = root
+        self._delegate = set(snapshot['delegate'])
+        self._enabled = snapshot['enabled']
+        self._source = source
+        self._compiled = True
+        return True
+
+
+    def save(self, path):
+        """
+        Write a L{snapshot} to the file at C{path}.
+
+        The file is written next to C{path} and renamed into place, so that
+        processes starting at the same time never read half of it.
+
+        @raise EnvironmentError: If the file can't be written.
+        """
+        data = marshal.dumps(self.snapshot())
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            os.remove(temporary)
+            raise
+
+
+    def load(self, path):
+        """
+        L{restore} the snapshot in the file at C{path}.
+
+        Snapshots are stored with L{marshal} rather than L{pickle}, so
+        loading one can't run arbitrary code.
+
+        @return: C{True} if the snapshot was restored, C{False} if the file
+            doesn't exist, can't be read or was saved with different rules.
+        """
+        try:
+            with open(path, 'rb') as f:
+                snapshot = marshal.load(f)
+            return self.restore(snapshot)
+        except (EnvironmentError, EOFError, ValueError, TypeError,
+                KeyError, IndexError, AttributeError):
+            return False
+
+
+    def _hasDefaultRedirect(self, rule):
+        """
+        Whether werkzeug may answer a match of C{rule} with a redirect to a
+        rule which provides defaults for it.
+        """
+        for other in self._url_map._rules_by_endpoint.get(rule.endpoint, ()):
+            if other.provides_defaults_for(rule):
+                return True
+        return False
+
+
+    def _candidates(self, path):
+        """
+        Return the C{(index, rule)} tuples which could match C{path}, in the
+        order werkzeug tries them.
+        """
+        dynamic = []
+        segments = iter(path.split(u'/')[1:])
+        node = self._root
+        while node is not None:
+            dynamic.extend(node.rules)
+            node = node.children.get(next(segments, None))
+        dynamic.sort()
+
+        # Rules without arguments always sort before those with arguments.
+        return self._static.get(path, []) + dynamic
+
+
+    def match(self, path_info, method):
+        """
+        Match C{path_info} and C{method} against the rules.
+
+        @param path_info: The path to match, relative to the script name.
+        @type path_info: C{str} or C{unicode}
+
+        @param method: The HTTP method of the request.
+        @type method: C{str}
+
+        @return: A C{(rule, kwargs)} tuple exactly as werkzeug would return
+            it, or C{None} if werkzeug should be asked instead.
+        """
+        if not self._compiled:
+            self.compile()
+
+        if not self._enabled:
+            return None
+
+        if isinstance(path_info, str):
+            try:
+                path_info = path_info.decode(self._url_map.charset)
+            except UnicodeDecodeError:
+                return None
+
+        path = u'/' + path_info.lstrip(u'/')
+        method = method.upper()
+        matchPath = u'|' + path
+
+        for index, rule in self._candidates(path):
+            try:
+                kwargs = rule.match(matchPath)
+            except (RequestSlash, RequestAliasRedirect):
+                return None
+
+            if kwargs is None:
+                continue
+
+            if rule.methods is not None and method not in rule.methods:
+                continue
+
+            if index in self._delegate:
+                return None
+
+            return rule, kwargs
+
+        return None
+
+
+
+class AdapterCache(object):
+    """
+    A bounded cache of C{werkzeug.routing.MapAdapter}s bound to a
+    C{werkzeug.routing.Map}, and of the URLs they build.
+
+    Nearly all requests to an application share a handful of host names,
+    schemes and methods, so rather than binding a new adapter for every
+    request one is kept for each combination of them.  The adapters are
+    bound without a path; it must be passed to C{MapAdapter.match} instead.
+
+    Pages tend to link to the same few URLs over and over again, so the URLs
+    built by L{build} are remembered too.
+
+    @ivar _url_map: The C{werkzeug.routing.Map} to bind.
+    @ivar _size: The maximum number of adapters to keep.
+    @ivar _adapters: A C{dict} mapping C{(server_name, script_name,
+        url_scheme, method)} to a bound adapter.
+    @ivar _urls: An L{LRUCache} of built URLs.
+    """
+
+    def __init__(self, url_map, size=64, url_size=1024):
+        self._url_map = url_map
+        self._size = size
+        self._adapters = {}
+        self._urls = LRUCache(url_size)
+
+
+    def __len__(self):
+        return len(self._adapters)
+
+
+    def clear(self):
+        """
+        Discard all cached adapters and URLs.
+        """
+        self._adapters.clear()
+        self._urls.clear()
+
+
+    def bind(self, server_name, script_name, url_scheme, method):
+        """
+        Return an adapter bound with the given arguments, creating it if
+        necessary.
+
+        @see: C{werkzeug.routing.Map.bind}
+        """
+        key = (server_name, script_name, url_scheme, method)
+        adapter = self._adapters.get(key)
+        if adapter is None:
+            adapter = self._url_map.bind(server_name, script_name,
+                                         default_method=method,
+                                         url_scheme=url_scheme)
+            if len(self._adapters) >= self._size:
+                self._adapters.popitem()
+            self._adapters[key] = adapter
+        return adapter
+
+
+    def build(self, bind_args, endpoint, values=None, method=None,
+              force_external=False, append_unknown=True):
+        """
+        Build a URL for C{endpoint} with the adapter bound with C{bind_args},
+        or return the URL built for the same arguments before.
+
+        Only URLs built from a plain C{dict} of hashable values are
+        remembered.  The type of each value is part of the key, since values
+        which compare equal (like C{1} and C{True}) may build different URLs.
+
+        @param bind_args: The C{(server_name, script_name, url_scheme,
+            method)} to bind the adapter with.
+
+        @see: C{werkzeug.routing.MapAdapter.build}
+        """
+        key = None
+        if not values:
+            key = (bind_args, endpoint, None, method, force_external,
+                   append_unknown)
+        elif type(values) is dict:
+            try:
+                frozen = frozenset([(name, value.__class__, value)
+                                    for name, value in values.iteritems()
+                                    if value is not None])
+            except TypeError:
+                pass
+            else:
+                key = (bind_args, endpoint, frozen, method, force_external,
+                       append_unknown)
+
+        if key is not None:
+            url = self._urls.get(key)
+            if url is not None:
+                return url
+
+        url = self.bind(*bind_args).build(endpoint, values, method,
+                                          force_external, append_unknown)
+        if key is not None:
+            self._urls.set(key, url)
+        return url
@@ -0,0 +1,304 @@
+"""
+Serving static files without reading them into Python a buffer at a time.
+"""
+import errno
+import math
+import mmap
+import os
+
+from zope.interface import implements
+
+from twisted.internet.abstract import FileDescriptor
+from twisted.internet.interfaces import IPullProducer, ISSLTransport
+from twisted.python import log
+from twisted.web import http
+from twisted.web.static import (File, NoRangeStaticProducer,
+                                SingleRangeStaticProducer)
+
+from klein.resource import _not_modified
+
+__all__ = ["StaticFile"]
+
+
+try:
+    _sendfile = os.sendfile
+except AttributeError:
+    try:
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+
+
+def _sendfile_transport(request):
+    """
+    Return the transport of C{request} if the file can be sent to its socket
+    with C{sendfile(2)}, or C{None}.
+
+    That is only the case for plain TCP connections, since anything else,
+    such as TLS, needs to see the bytes being sent, and for transports which
+    say how much they hold, so that the file isn't sent before it.
+    """
+    if _sendfile is None or getattr(request, '_encoder', None) is not None:
+        return None
+
+    transport = getattr(request.channel, 'transport', None)
+    if (not isinstance(transport, FileDescriptor) or
+            getattr(transport, 'TLS', False) or
+            ISSLTransport.providedBy(transport) or
+            _buffered(transport) is None):
+        return None
+
+    try:
+        transport.fileno()
+    except Exception:
+        return None
+    return transport
+
+
+def _buffered(transport):
+    """
+    Return the number of bytes written to C{transport}, a L{FileDescriptor},
+    which it hasn't sent yet, or C{None} if it doesn't say.
+
+    L{FileDescriptor} keeps them in private attributes, which other versions
+    of Twisted may not have.
+    """
+    try:
+        return (len(transport.dataBuffer) - transport.offset +
+                transport._tempDataLen)
+    except (AttributeError, TypeError):
+        return None
+
+
+
+class _SendfileProducer(object):
+    """
+    Sends C{size} bytes of a file from C{offset} straight to the socket of a
+    request with C{sendfile(2)}, whenever the socket can take more.
+
+    Nothing can be sent while the transport still holds data written before,
+    such as the response headers, so the producer waits for the transport to
+    ask for more after sending it.  The same is done when the socket is full.
+
+    @ivar _transport: The transport of C{_request}, as returned by
+        L{_sendfile_transport}.
+    """
+    implements(IPullProducer)
+
+    def __init__(self, request, transport, fileObject, offset, size):
+        self._request = request
+        self._transport = transport
+        self._file = fileObject
+        self._offset = offset
+        self._remaining = size
+
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+
+    def resumeProducing(self):
+        request = self._request
+        if request is None:
+            return
+        if not request.startedWriting:
+            request.write('')
+
+        transport = self._transport
+        if _buffered(transport):
+            # The transport asks for more once that has been sent.
+            transport.startWriting()
+            return
+
+        sent = 0
+        if self._remaining:
+            try:
+                sent = _sendfile(transport.fileno(), self._file.fileno(),
+                                 self._offset, self._remaining)
+            except EnvironmentError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                   errno.EINTR):
+                    # The transport notices the connection is gone.
+                    log.err(None, "Unhandled Error sending file")
+                    self._lose()
+                    return
+                transport.startWriting()
+                return
+
+            if not sent:
+                # The file was truncated while it was being sent, so the
+                # client must not believe it got all of it.
+                self._lose()
+                return
+
+        self._offset += sent
+        self._remaining -= sent
+        request.sentLength += sent
+
+        if self._remaining:
+            # Writing nothing makes the transport ask for more as soon as
+            # the socket is writable again.
+            transport.startWriting()
+        else:
+            request.unregisterProducer()
+            request.finish()
+            self.stopProducing()
+
+
+    def stopProducing(self):
+        self._file.close()
+        self._request = None
+
+
+    def _lose(self):
+        request = self._request
+        request.unregisterProducer()
+        self.stopProducing()
+        request.transport.loseConnection()
+
+
+
+class _MmapProducer(object):
+    """
+    Writes C{size} bytes of a file from C{offset} to a request from a memory
+    map of the file, in large chunks and without a system call to read each
+    of them.
+
+    If the file can't be mapped, it is read instead.  Reading a mapped file
+    past its end after it was truncated kills the process with C{SIGBUS}, so
+    files served this way should be replaced, by renaming a new file over
+    them, rather than rewritten in place.
+    """
+    implements(IPullProducer)
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, request, fileObject, offset, size):
+        self._request = request
+        self._file = fileObject
+        self._offset = offset
+        self._remaining = size
+        self._map = None
+
+
+    def start(self):
+        if self._remaining:
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, mmap.error):
+                self._file.seek(self._offset)
+        self._request.registerProducer(self, False)
+
+
+    def resumeProducing(self):
+        if self._request is None:
+            return
+
+        size = min(self.chunk_size, self._remaining)
+        if self._map is not None:
+            data = self._map[self._offset:self._offset + size]
+        else:
+            data = self._file.read(size)
+
+        if data:
+            self._offset += len(data)
+            self._remaining -= len(data)
+            # This write may spin the reactor and call resumeProducing
+            # again, so be prepared for a re-entrant call.
+            self._request.write(data)
+
+        if self._request is not None and (not data or not self._remaining):
+            self._request.unregisterProducer()
+            self._request.finish()
+            self.stopProducing()
+
+
+    def stopProducing(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._request = None
+
+
+
+class StaticFile(File):
+    """
+    A L{File} which sends files with C{sendfile(2)} where it can, and writes
+    them from a memory map otherwise, rather than reading them a buffer at a
+    time.
+
+    C{sendfile(2)} is used on plain TCP connections if C{os.sendfile} or the
+    C{sendfile} package is available.  Requests for a single byte range are
+    served the same way; requests for several ranges are left to L{File}.
+
+    Files have an entity tag, and conditional requests the client has the
+    file for are answered with C{304 Not Modified}.
+
+    ::
+        @app.route("/static/", branch=True)
+        def static(request):
+            return StaticFile("/srv/static")
+
+    @ivar etags: A mapping of file paths to precomputed entity tags, such as
+        hashes of their contents, or C{None}.  Files which aren't in it get an
+        entity tag made from their inode, size and modification time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.etags = kwargs.pop('etags', None)
+        File.__init__(self, *args, **kwargs)
+
+
+    def createSimilarFile(self, path):
+        f = File.createSimilarFile(self, path)
+        f.etags = self.etags
+        return f
+
+
+    def etag(self):
+        """
+        Return the entity tag of the file.
+        """
+        if self.etags is not None:
+            etag = self.etags.get(self.path)
+            if etag is not None:
+                return etag
+
+        stat = self.statinfo
+        return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, int(stat.st_mtime))
+
+
+    def render_GET(self, request):
+        self.restat(False)
+        if self.exists() and not self.isdir():
+            request.etag = self.etag()
+            when = int(math.ceil(self.getmtime()))
+            if not request.lastModified or request.lastModified < when:
+                request.lastModified = when
+
+            if (request.method in ('GET', 'HEAD') and
+                    _not_modified(request, request.etag)):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return ''
+
+        return File.render_GET(self, request)
+    render_HEAD = render_GET
+
+
+    def makeProducer(self, request, fileForReading):
+        producer = File.makeProducer(self, request, fileForReading)
+        if isinstance(producer, NoRangeStaticProducer):
+            offset, size = 0, self.getFileSize()
+        elif isinstance(producer, SingleRangeStaticProducer):
+            offset, size = producer.offset, producer.size
+        else:
+            return producer
+
+        transport = _sendfile_transport(request)
+        if transport is not None:
+            return _SendfileProducer(request, transport, fileForReading,
+                                     offset, size)
+        return _MmapProducer(request, fileForReading, offset, size)
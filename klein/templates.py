@@ -0,0 +1,303 @@
+"""
+Caches for rendering L{twisted.web.template} documents.
+"""
+import time
+
+from functools import wraps
+from xml.sax import SAXParseException
+
+from zope.interface import implements
+
+from twisted.python.filepath import FilePath
+from twisted.web.error import MissingRenderMethod
+from twisted.web.iweb import IRenderable
+from twisted.web.template import (XMLFile, XMLString, flattenString,
+                                  TEMPLATE_NAMESPACE)
+
+from klein.cache import LRUCache
+
+__all__ = ["LoaderCache", "FragmentCache", "CachedFragment",
+           "cached_renderer", "loaders", "fragments"]
+
+
+class LoaderCache(object):
+    """
+    Template loaders which have parsed their templates already, shared by
+    everything rendering the same template.
+
+    Elements which create a loader for each instance, rather than sharing
+    one in their class, parse their template every time they are rendered;
+    asking a L{LoaderCache} for the loader instead makes it parsed once.
+
+    @ivar auto_reload: If C{True}, L{file} checks whether the template file
+        has been modified every time it is asked for it, and parses it again
+        if so.
+    """
+
+    def __init__(self, auto_reload=False):
+        self.auto_reload = auto_reload
+        self._files = {}
+        self._strings = {}
+
+
+    def file(self, path):
+        """
+        Return an C{XMLFile} loader for the template at C{path}.
+
+        @type path: L{FilePath} or C{str}
+        """
+        if not isinstance(path, FilePath):
+            path = FilePath(path)
+
+        entry = self._files.get(path.path)
+        if entry is not None and not self.auto_reload:
+            return entry[1]
+
+        modified = None
+        if self.auto_reload:
+            path.restat()
+            modified = path.getModificationTime()
+
+        if entry is None or entry[0] != modified:
+            loader = XMLFile(path)
+            loader.load()
+            entry = self._files[path.path] = (modified, loader)
+        return entry[1]
+
+
+    def string(self, source):
+        """
+        Return an C{XMLString} loader for the template C{source}.
+
+        @type source: C{str}
+        """
+        loader = self._strings.get(source)
+        if loader is None:
+            loader = self._strings[source] = XMLString(source)
+        return loader
+
+
+    def clear(self):
+        """
+        Discard every loader.
+        """
+        self._files.clear()
+        self._strings.clear()
+
+
+
+class FragmentCache(object):
+    """
+    Flattened fragments of documents, kept until they expire or are
+    discarded to make room for more recently used ones.
+
+    Each fragment is kept both as the bytes it flattened to and, if those can
+    be parsed, as a static Stan tree.  The bytes are written as they are when
+    the fragment is the whole response.  Twisted's flattener has no way to
+    write markup it is given as-is, so fragments nested in a document are
+    flattened from the static tree instead, which still skips running their
+    loaders and renderers.
+
+    @ivar _entries: An L{LRUCache} mapping keys to C{(expires, body, stan)}
+        tuples.
+    @ivar _seconds: A callable returning the current time, in seconds.
+    """
+
+    def __init__(self, size=1024, seconds=time.time):
+        self._entries = LRUCache(size)
+        self._seconds = seconds
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    @property
+    def hits(self):
+        """
+        The number of times a fragment was found in the cache.
+        """
+        return self._entries.hits
+
+
+    @property
+    def misses(self):
+        """
+        The number of times a fragment wasn't found in the cache.
+        """
+        return self._entries.misses
+
+
+    def get(self, key):
+        """
+        Return the C{(body, stan)} of the fragment cached for C{key}, or
+        C{None} if there isn't one or it has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, body, stan = entry
+        if expires is not None and expires <= self._seconds():
+            self._entries.pop(key)
+            self._entries.hits -= 1
+            self._entries.misses += 1
+            return None
+        return body, stan
+
+
+    def set(self, key, body, stan, ttl=None):
+        """
+        Cache a fragment for C{key}.
+
+        @param body: The flattened fragment.
+        @type body: C{str}
+
+        @param stan: The fragment as a static Stan tree, or C{None}.
+
+        @param ttl: The number of seconds after which the fragment expires, or
+            C{None} if it doesn't.
+        """
+        expires = None
+        if ttl is not None:
+            expires = self._seconds() + ttl
+        self._entries.set(key, (expires, body, stan))
+
+
+    def invalidate(self, key):
+        """
+        Discard the fragment cached for C{key}, if there is one.
+        """
+        self._entries.pop(key)
+
+
+    def clear(self):
+        """
+        Discard every fragment.
+        """
+        self._entries.clear()
+
+
+
+loaders = LoaderCache()
+fragments = FragmentCache()
+
+
+
+def _parse(body):
+    """
+    Parse the flattened fragment C{body} into a static Stan tree, or return
+    C{None} if it isn't well-formed enough to be parsed.
+    """
+    try:
+        return XMLString(
+            '<t:transparent xmlns:t="%s">%s</t:transparent>' % (
+                TEMPLATE_NAMESPACE, body)).load()
+    except SAXParseException:
+        return None
+
+
+
+class CachedFragment(object):
+    """
+    An L{IRenderable} which renders what C{produce} returns, and keeps what it
+    flattened to in a L{FragmentCache} under C{key} so that the next fragment
+    with the same key doesn't need to render it again.
+
+    When an endpoint returns a L{CachedFragment}, the cached bytes are
+    written as the response without flattening anything.
+
+    @ivar key: The key of the fragment in the cache.
+    @ivar _produce: A callable taking no arguments which returns what to
+        flatten when the fragment isn't cached.
+    @ivar _ttl: The number of seconds to cache the fragment for, or C{None}
+        to keep it until it is discarded to make room for others.
+    @ivar _cache: The L{FragmentCache}.
+    """
+    implements(IRenderable)
+
+    def __init__(self, key, produce, ttl=None, cache=None):
+        self.key = key
+        self._produce = produce
+        self._ttl = ttl
+        if cache is None:
+            cache = fragments
+        self._cache = cache
+
+
+    def _fill(self, request):
+        """
+        Flatten the fragment and cache it.
+
+        @return: A L{Deferred} which fires with the C{(body, stan)} of the
+            fragment.
+        """
+        def cache(body):
+            stan = _parse(body)
+            self._cache.set(self.key, body, stan, self._ttl)
+            return body, stan
+
+        return flattenString(request, self._produce()).addCallback(cache)
+
+
+    def flatten(self, request):
+        """
+        Return the bytes the fragment flattens to, or a L{Deferred} which
+        fires with them if they aren't cached.
+        """
+        entry = self._cache.get(self.key)
+        if entry is not None:
+            return entry[0]
+        return self._fill(request).addCallback(lambda entry: entry[0])
+
+
+    def render(self, request):
+        entry = self._cache.get(self.key)
+        if entry is None:
+            return self._fill(request).addCallback(self._stanOrRender)
+        return self._stanOrRender(entry)
+
+
+    def _stanOrRender(self, entry):
+        body, stan = entry
+        if stan is None:
+            return self._produce()
+        return stan
+
+
+    def lookupRenderMethod(self, name):
+        raise MissingRenderMethod(self, name)
+
+
+
+def cached_renderer(key, ttl=None, cache=None):
+    """
+    Decorate a renderer so that what it renders is kept in a L{FragmentCache}.
+
+    ::
+        class Page(Element):
+            @renderer
+            @cached_renderer(lambda self, request, tag: self.user, ttl=60)
+            def sidebar(self, request, tag):
+                ...
+
+    @param key: The key to cache what the renderer renders under, or a
+        callable taking the same arguments as the renderer which returns it.
+        It is combined with the name of the renderer, so different renderers
+        may use the same keys.
+
+    @param ttl: The number of seconds to cache for, or C{None}.
+
+    @param cache: The L{FragmentCache} to use, or C{None} for L{fragments}.
+    """
+    def deco(f):
+        @wraps(f)
+        def render(self, request, tag):
+            k = key
+            if callable(k):
+                k = k(self, request, tag)
+            return CachedFragment((f.__module__, f.__name__, k),
+                                  lambda: f(self, request, tag), ttl, cache)
+        return render
+
+    return deco
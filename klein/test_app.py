@@ -6,6 +6,8 @@ from mock import Mock, patch
 
 from twisted.python.components import registerAdapter
 
+from zope.interface.verify import verifyObject
+
 from klein import Klein
 from klein.app import KleinRequest
 from klein.interfaces import IKleinRequest
@@ -194,7 +196,7 @@ class KleinTestCase(unittest.TestCase):
     @patch('klein.app.KleinResource')
     @patch('klein.app.Site')
     @patch('klein.app.log')
-    @patch('klein.app.reactor')
+    @patch('twisted.internet.reactor')
     def test_run(self, reactor, mock_log, mock_site, mock_kr):
         """
         L{Klein.run} configures a L{KleinResource} and a L{Site}
@@ -218,7 +220,7 @@ class KleinTestCase(unittest.TestCase):
     @patch('klein.app.KleinResource')
     @patch('klein.app.Site')
     @patch('klein.app.log')
-    @patch('klein.app.reactor')
+    @patch('twisted.internet.reactor')
     def test_runWithLogFile(self, reactor, mock_log, mock_site, mock_kr):
         """
         L{Klein.run} logs to the specified C{logFile}.
@@ -238,6 +240,26 @@ class KleinTestCase(unittest.TestCase):
         mock_log.startLogging.assert_called_with(logFile)
 
 
+    @patch('klein.app.KleinResource')
+    @patch('klein.app.Site')
+    @patch('klein.app.log')
+    @patch('twisted.internet.reactor')
+    @patch('klein.app._workers')
+    def test_runWithWorkers(self, mock_workers, reactor, mock_log, mock_site,
+                            mock_kr):
+        """
+        L{Klein.run} serves from several processes when given C{workers}.
+        """
+        app = Klein()
+
+        app.run("localhost", 8080, workers=4)
+
+        mock_workers.serve.assert_called_with(
+            reactor, mock_site.return_value, "localhost", 8080, 4)
+        self.assertFalse(reactor.listenTCP.called)
+        reactor.run.assert_called_with()
+
+
     @patch('klein.app.KleinResource')
     def test_resource(self, mock_kr):
         """
@@ -248,3 +270,244 @@ class KleinTestCase(unittest.TestCase):
 
         mock_kr.assert_called_with(app)
         self.assertEqual(mock_kr.return_value, resource)
+
+
+    def test_compiledRoutingInvalidatedByRoute(self):
+        """
+        L{Klein.route} invalidates the compiled router so new routes can be
+        matched.
+        """
+        app = Klein(compiled_routing=True)
+
+        @app.route("/foo")
+        def foo(request):
+            return "foo"
+
+        self.assertEqual(app._router.match("/foo", "GET")[0].endpoint, "foo")
+
+        @app.route("/bar")
+        def bar(request):
+            return "bar"
+
+        self.assertEqual(app._router.match("/bar", "GET")[0].endpoint, "bar")
+
+
+    def test_routeClearsAdapters(self):
+        """
+        L{Klein.route} discards adapters bound to the old routing table.
+        """
+        app = Klein()
+
+        @app.route("/foo")
+        def foo(request):
+            return "foo"
+
+        app._adapters.bind("localhost", "/", "http", "GET")
+        self.assertEqual(len(app._adapters), 1)
+
+        @app.route("/bar")
+        def bar(request):
+            return "bar"
+
+        self.assertEqual(len(app._adapters), 0)
+
+
+    def test_matchCache(self):
+        """
+        L{Klein.match_cache} is only created if a size is given, and is
+        cleared by L{Klein.route}.
+        """
+        self.assertIdentical(Klein().match_cache, None)
+
+        app = Klein(match_cache_size=5)
+        self.assertEqual(app.match_cache.size, 5)
+        app.match_cache.set("key", "value")
+
+        @app.route("/foo")
+        def foo(request):
+            return "foo"
+
+        self.assertEqual(len(app.match_cache), 0)
+
+
+    def test_missCache(self):
+        """
+        L{Klein.miss_cache} is only created if a size is given, and is
+        cleared by L{Klein.route}.
+        """
+        self.assertIdentical(Klein().miss_cache, None)
+
+        app = Klein(miss_cache_size=5)
+        self.assertEqual(app.miss_cache.size, 5)
+        app.miss_cache.set("key", "value")
+
+        @app.route("/foo")
+        def foo(request):
+            return "foo"
+
+        self.assertEqual(len(app.miss_cache), 0)
+
+
+    def test_freeze(self):
+        """
+        L{Klein.freeze} compiles the routing table, and L{Klein.route} raises
+        C{RuntimeError} once it has been called.
+        """
+        app = Klein()
+
+        @app.route("/foo")
+        def foo(request):
+            return "foo"
+
+        app.freeze()
+        self.assertEqual(app._router.match("/foo", "GET")[0].endpoint, "foo")
+        self.assertRaises(RuntimeError, app.route, "/bar")
+
+
+    def test_freezeCache(self):
+        """
+        L{Klein.freeze} writes the compiled routing table to C{cache_path},
+        and applications with the same routes load it from there instead of
+        compiling it.
+        """
+        path = self.mktemp()
+
+        def makeApp(*urls):
+            app = Klein(compiled_routing=True)
+            for url in urls:
+                app.route(url, endpoint=url)(lambda request: url)
+            return app
+
+        makeApp("/foo", "/foo/<int:x>").freeze(path)
+
+        app = makeApp("/foo", "/foo/<int:x>")
+        app._router = Mock(wraps=app._router)
+        app.freeze(path)
+        app._router.load.assert_called_once_with(path)
+        self.assertEqual(app._router.compile.call_count, 0)
+        self.assertEqual(app._router.save.call_count, 0)
+
+        app = makeApp("/foo", "/foo/<int:x>", "/bar")
+        app._router = Mock(wraps=app._router)
+        app.freeze(path)
+        self.assertEqual(app._router.compile.call_count, 1)
+        app._router.save.assert_called_once_with(path)
+
+
+    def test_errorHandlersFor(self):
+        """
+        L{Klein._error_handlers_for} returns the positions and handlers
+        registered for an exception type or its bases, in order.
+        """
+        app = Klein()
+
+        @app.handle_errors(KeyError)
+        def key_error(request, failure):
+            pass
+
+        @app.handle_errors(LookupError, ValueError)
+        def lookup_error(request, failure):
+            pass
+
+        @app.handle_errors
+        def generic_error(request, failure):
+            pass
+
+        self.assertEqual(
+            [(p, h.__name__) for p, h in app._error_handlers_for(KeyError)],
+            [(0, "key_error"), (1, "lookup_error"), (2, "generic_error")])
+        self.assertEqual(
+            [(p, h.__name__) for p, h in app._error_handlers_for(ValueError)],
+            [(1, "lookup_error"), (2, "generic_error")])
+        self.assertIdentical(app._error_handlers_for(ValueError),
+                             app._error_handlers_for(ValueError))
+
+        @app.handle_errors(ValueError)
+        def value_error(request, failure):
+            pass
+
+        self.assertEqual(
+            [(p, h.__name__) for p, h in app._error_handlers_for(ValueError)],
+            [(1, "lookup_error"), (2, "generic_error"), (3, "value_error")])
+
+
+class KleinRequestTestCase(unittest.TestCase):
+    def test_slots(self):
+        """
+        L{KleinRequest} uses C{__slots__} rather than an instance
+        dictionary.
+        """
+        self.assertFalse(hasattr(KleinRequest(DummyRequest(1)), '__dict__'))
+
+
+    def test_interface(self):
+        """
+        L{KleinRequest} provides L{IKleinRequest}.
+        """
+        self.assertTrue(verifyObject(IKleinRequest,
+                                     KleinRequest(DummyRequest(1))))
+
+
+    def test_mapperBoundLazily(self):
+        """
+        L{KleinRequest.mapper} is looked up with the C{_klein_bind_args} of
+        the request the first time it is used, and again if they change.
+        """
+        adapters = Mock()
+
+        request = DummyRequest(1)
+        kleinRequest = KleinRequest(request)
+        self.assertIdentical(kleinRequest.mapper, None)
+
+        request._klein_bind_args = (adapters, ("localhost", "/", "http", "GET"))
+        self.assertEqual(adapters.bind.call_count, 0)
+
+        self.assertIdentical(kleinRequest.mapper, adapters.bind.return_value)
+        self.assertIdentical(kleinRequest.mapper, adapters.bind.return_value)
+        adapters.bind.assert_called_once_with("localhost", "/", "http", "GET")
+
+        request._klein_bind_args = (adapters, ("localhost", "/", "http", "PUT"))
+        kleinRequest.mapper
+        adapters.bind.assert_called_with("localhost", "/", "http", "PUT")
+
+
+    def test_setMapper(self):
+        """
+        Setting L{KleinRequest.mapper} replaces the mapper which would be
+        looked up.
+        """
+        adapters = Mock()
+        mapper = Mock()
+
+        request = DummyRequest(1)
+        request._klein_bind_args = (adapters, ("localhost", "/", "http", "GET"))
+        kleinRequest = KleinRequest(request)
+
+        kleinRequest.mapper = mapper
+        self.assertIdentical(kleinRequest.mapper, mapper)
+        self.assertEqual(adapters.bind.call_count, 0)
+
+
+    def test_urlForCached(self):
+        """
+        L{KleinRequest.url_for} builds URLs through the L{AdapterCache} of
+        the request, unless a mapper has been set explicitly.
+        """
+        adapters = Mock()
+        adapters.build.return_value = "/foo"
+        mapper = Mock()
+        mapper.build.return_value = "/bar"
+
+        request = DummyRequest(1)
+        bind_args = ("localhost", "/", "http", "GET")
+        request._klein_bind_args = (adapters, bind_args)
+        kleinRequest = KleinRequest(request)
+
+        self.assertEqual(kleinRequest.url_for("foo", {"x": 1}), "/foo")
+        adapters.build.assert_called_once_with(
+            bind_args, "foo", {"x": 1}, None, False, True)
+        self.assertEqual(adapters.bind.call_count, 0)
+
+        kleinRequest.mapper = mapper
+        self.assertEqual(kleinRequest.url_for("foo"), "/bar")
+        mapper.build.assert_called_once_with("foo", None, None, False, True)
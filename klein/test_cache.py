@@ -0,0 +1,265 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.web.http_headers import Headers
+
+from werkzeug.exceptions import NotFound
+
+from klein import Klein
+from klein.cache import LRUCache, CachePolicy, ResponseCache
+from klein.resource import KleinResource
+from klein.test_resource import requestMock, _render
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_getAndSet(self):
+        """
+        L{LRUCache.get} returns values stored with L{LRUCache.set}, or the
+        default, and counts hits and misses.
+        """
+        cache = LRUCache(2)
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("b", 2), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertIn("a", cache)
+        self.assertEqual(len(cache), 1)
+
+
+    def test_evictsLeastRecentlyUsed(self):
+        """
+        When full, L{LRUCache.set} discards the least recently used item.
+        """
+        cache = LRUCache(3)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        cache.get("a")
+        cache.set("b", 4)
+        cache.set("d", 5)
+
+        self.assertNotIn("c", cache)
+        self.assertEqual([cache.get(k) for k in "abd"], [1, 4, 5])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 1)
+
+        cache.set("e", 6)
+        self.assertNotIn("a", cache)
+
+
+    def test_pop(self):
+        """
+        L{LRUCache.pop} removes an item and returns its value.
+        """
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertEqual(cache.pop("a", 3), 3)
+        cache.set("c", 3)
+        cache.set("d", 4)
+        self.assertNotIn("b", cache)
+
+
+    def test_clear(self):
+        """
+        L{LRUCache.clear} removes every item.
+        """
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.clear()
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get("a"), None)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("b"), 2)
+
+
+    def test_size(self):
+        """
+        L{LRUCache} must be able to hold at least one item.
+        """
+        self.assertRaises(ValueError, LRUCache, 0)
+
+
+    def test_popitem(self):
+        """
+        L{LRUCache.popitem} removes and returns the least recently used item,
+        and raises L{KeyError} when the cache is empty.
+        """
+        cache = LRUCache(3)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+
+        self.assertEqual(cache.popitem(), ("b", 2))
+        self.assertEqual(cache.popitem(), ("a", 1))
+        self.assertRaises(KeyError, cache.popitem)
+
+
+
+class FakeResponse(object):
+    def __init__(self, code=200, headers=None):
+        self.code = code
+        self.cookies = []
+        self.etag = None
+        self.startedWriting = False
+        self.responseHeaders = Headers(headers or {})
+
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResponseCache(1024, clock=self.clock)
+        self.policy = CachePolicy(ttl=10)
+
+
+    def test_expires(self):
+        """
+        Responses are fresh for C{ttl} seconds, then discarded.
+        """
+        self.cache.store(self.policy, "a", FakeResponse(
+            headers={'Content-Type': ['text/plain'], 'Date': ['now']}), "body")
+
+        entry, fresh = self.cache.get("e", "a")
+        self.assertTrue(fresh)
+        self.assertEqual(entry.body, "body")
+        self.assertEqual(entry.headers, [('Content-Type', ['text/plain'])])
+
+        self.clock.advance(10)
+        self.assertEqual(self.cache.get("e", "a"), (None, False))
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+        stats = self.cache.stats("e")
+        self.assertEqual((stats.hits, stats.misses), (1, 1))
+
+
+    def test_maxBytes(self):
+        """
+        Bodies larger than the C{max_bytes} of the policy are not cached.
+        """
+        policy = CachePolicy(ttl=10, max_bytes=3)
+        self.cache.store(policy, "a", FakeResponse(), "body")
+        self.cache.store(policy, "b", FakeResponse(), u"bod")
+        self.assertEqual(self.cache.get("e", "a"), (None, False))
+        self.assertEqual(self.cache.get("e", "b")[0].body, "bod")
+
+
+    def test_evictsLeastRecentlyUsed(self):
+        """
+        Once the cache holds more than C{max_bytes}, the least recently used
+        responses are discarded, and responses which can never fit are not
+        cached at all.
+        """
+        body = "x" * 50
+        for key in "abc":
+            self.cache.store(self.policy, key, FakeResponse(), body)
+        self.cache.get("e", "a")
+        self.cache.store(self.policy, "d", FakeResponse(), body)
+
+        self.assertEqual([self.cache.get("e", key)[0] is not None
+                          for key in "abcd"], [True, False, True, True])
+        self.assertTrue(self.cache.size <= self.cache.max_bytes)
+
+        self.cache.store(self.policy, "e", FakeResponse(), "x" * 1024)
+        self.assertEqual(self.cache.get("e", "e"), (None, False))
+        self.assertEqual(len(self.cache), 3)
+
+
+    def test_variant(self):
+        """
+        L{ResponseCache.variant} makes a variant of a cached body once, and
+        counts it towards the size of the cache.
+        """
+        self.cache.store(self.policy, "a", FakeResponse(), "body")
+        entry, fresh = self.cache.get("e", "a")
+        size = self.cache.size
+
+        self.assertEqual(self.cache.variant(entry, "upper", str.upper), "BODY")
+        self.assertEqual(self.cache.variant(entry, "upper", None), "BODY")
+        self.assertEqual(self.cache.size, size + 4)
+
+        self.cache.clear()
+        self.cache.variant(entry, "lower", str.lower)
+        self.assertEqual(self.cache.size, 0)
+
+
+
+class MatchCacheTests(unittest.TestCase):
+    """
+    Tests for L{KleinResource} when the application caches matches.
+    """
+    def setUp(self):
+        self.app = Klein(match_cache_size=10)
+        self.kr = KleinResource(self.app)
+
+
+    def test_matchCached(self):
+        """
+        Matches are cached for the requests which have the same method and
+        path, and only for requests which matched.
+        """
+        app = self.app
+
+        @app.route("/foo/<int:bar>", methods=['GET'])
+        def foo(request, bar):
+            return str(bar)
+
+        requests = [requestMock('/foo/1'), requestMock('/foo/1'),
+                    requestMock('/foo/2'),
+                    requestMock('/foo/2', method='POST')]
+        for request in requests:
+            self.successResultOf(_render(self.kr, request))
+
+        requests[1].assertWritten('1')
+        requests[2].assertWritten('2')
+        self.assertEqual(requests[3].code, 405)
+        self.assertEqual(app.match_cache.hits, 1)
+        self.assertEqual(app.match_cache.misses, 3)
+        self.assertEqual(len(app.match_cache), 2)
+
+
+
+class MissCacheTests(unittest.TestCase):
+    """
+    Tests for L{KleinResource} when the application caches misses.
+    """
+    def setUp(self):
+        self.app = Klein(miss_cache_size=10)
+        self.kr = KleinResource(self.app)
+
+
+    def test_missCached(self):
+        """
+        Requests known to match nothing are answered without matching them
+        again, and are given the same exception, without a traceback, by the
+        error handlers.
+        """
+        app = self.app
+        handled = []
+
+        @app.route("/foo", methods=['GET'])
+        def foo(request):
+            return 'foo'
+
+        @app.handle_errors(NotFound)
+        def handle_not_found(request, failure):
+            handled.append(failure)
+            request.setResponseCode(404)
+            return 'Custom Not Found'
+
+        requests = [requestMock('/bar'), requestMock('/bar'),
+                    requestMock('/foo', method='POST'),
+                    requestMock('/foo', method='POST')]
+        for request in requests:
+            self.successResultOf(_render(self.kr, request))
+
+        requests[1].assertWritten('Custom Not Found')
+        self.assertEqual(len(handled), 2)
+        self.assertIdentical(handled[0].value, handled[1].value)
+        self.assertIdentical(handled[1].tb, None)
+        self.assertEqual(requests[3].code, 405)
+        self.assertEqual(app.miss_cache.hits, 2)
+        self.assertEqual(len(app.miss_cache), 2)
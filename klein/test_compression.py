@@ -0,0 +1,111 @@
+import zlib
+
+from twisted.trial import unittest
+from twisted.web.http_headers import Headers
+
+from klein.compression import Compression, _accepted_encoding
+
+
+class FakeRequest(object):
+    def __init__(self, accept=None, headers=None):
+        self.requestHeaders = Headers()
+        if accept is not None:
+            self.requestHeaders.setRawHeaders('accept-encoding', [accept])
+        self.responseHeaders = Headers(headers or {})
+
+
+    def getHeader(self, name):
+        values = self.requestHeaders.getRawHeaders(name)
+        if values:
+            return values[-1]
+
+
+
+class AcceptedEncodingTests(unittest.TestCase):
+    def test_negotiation(self):
+        """
+        L{_accepted_encoding} picks the content coding the client prefers
+        among C{gzip} and C{deflate}, preferring C{gzip} between equals.
+        C{*} only stands for the codings the header doesn't name.
+        """
+        for accept, encoding in [
+                (None, None),
+                ('identity', None),
+                ('gzip', 'gzip'),
+                ('deflate, gzip', 'gzip'),
+                ('gzip;q=0.5, deflate', 'deflate'),
+                ('GZIP;q=0, deflate;q=0', None),
+                ('br, *;q=0.1', 'gzip'),
+                ('gzip;q=0, *', 'deflate'),
+                ('*;q=0.5, deflate', 'deflate'),
+                ('*, gzip;q=0, deflate;q=0', None),
+                ('x-gzip', 'gzip'),
+                ('gzip;q=nonsense, deflate;q=0.2', 'deflate')]:
+            self.assertEqual(_accepted_encoding(FakeRequest(accept)),
+                             encoding, accept)
+
+
+
+class CompressionTests(unittest.TestCase):
+    def test_level(self):
+        """
+        Compression levels must be from 1 to 9.
+        """
+        self.assertRaises(ValueError, Compression, 0)
+        self.assertRaises(ValueError, Compression, 10)
+
+
+    def test_encoding(self):
+        """
+        L{Compression.encoding} leaves small, already compressed or already
+        encoded responses alone, and adds C{Accept-Encoding} to the C{Vary}
+        header of the others.
+        """
+        compression = Compression(min_bytes=10)
+
+        request = FakeRequest('gzip', {'Vary': ['Cookie']})
+        self.assertEqual(compression.encoding(request, 10), 'gzip')
+        self.assertEqual(request.responseHeaders.getRawHeaders('vary'),
+                         ['Cookie', 'Accept-Encoding'])
+        compression.encoding(request)
+        self.assertEqual(request.responseHeaders.getRawHeaders('vary'),
+                         ['Cookie', 'Accept-Encoding'])
+
+        request = FakeRequest('gzip')
+        self.assertIdentical(compression.encoding(request, 9), None)
+        self.assertFalse(request.responseHeaders.hasHeader('vary'))
+
+        for headers in [{'Content-Type': ['image/png']},
+                        {'Content-Encoding': ['br']}]:
+            request = FakeRequest('gzip', headers)
+            self.assertIdentical(compression.encoding(request), None)
+
+
+    def test_compress(self):
+        """
+        L{Compression.compress} returns the body in the given content coding.
+        """
+        compression = Compression(level=1)
+        body = "hello " * 100
+        gzipped = compression.compress('gzip', body)
+        self.assertEqual(gzipped[:2], '\x1f\x8b')
+        self.assertEqual(zlib.decompress(gzipped, 16 + zlib.MAX_WBITS), body)
+        self.assertEqual(
+            zlib.decompress(compression.compress('deflate', body)), body)
+
+
+    def test_encoder(self):
+        """
+        The encoder of L{Compression.encoder} flushes every chunk it is
+        given, so that each can be decompressed as soon as it arrives.
+        """
+        encoder = Compression().encoder('gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        self.assertEqual(encoder.encode(''), '')
+        for chunk in ["first ", "second"]:
+            self.assertEqual(decompressor.decompress(encoder.encode(chunk)),
+                             chunk)
+        decompressor.decompress(encoder.finish())
+        self.assertEqual(decompressor.flush(), '')
+        self.assertTrue(decompressor.unused_data == '')
@@ -0,0 +1,100 @@
+from twisted.internet.defer import CancelledError
+from twisted.trial import unittest
+
+from klein.limits import ConcurrencyLimit
+
+
+class ConcurrencyLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.limit = ConcurrencyLimit(2, max_queued=1)
+
+
+    def test_tryAcquire(self):
+        """
+        L{ConcurrencyLimit.try_acquire} takes a slot only if one is free.
+        """
+        self.assertTrue(self.limit.try_acquire())
+        self.assertTrue(self.limit.try_acquire())
+        self.assertFalse(self.limit.try_acquire())
+        self.assertEqual(self.limit.active, 2)
+
+
+    def test_acquire(self):
+        """
+        L{ConcurrencyLimit.acquire} waits for a slot when none is free, and
+        returns C{None} when too many requests are waiting already.
+        """
+        self.successResultOf(self.limit.acquire())
+        self.successResultOf(self.limit.acquire())
+        d = self.limit.acquire()
+        self.assertNoResult(d)
+        self.assertIdentical(self.limit.acquire(), None)
+        self.assertEqual((self.limit.queued, self.limit.rejected), (1, 1))
+
+        self.limit.release()
+        self.successResultOf(d)
+        self.assertEqual((self.limit.active, self.limit.queued), (2, 0))
+
+
+    def test_noneWhileWaiting(self):
+        """
+        No slot is taken by L{ConcurrencyLimit.try_acquire} while others
+        wait for one, so that they keep their turn.
+        """
+        self.limit.limit = 0
+        d = self.limit.acquire()
+        self.limit.limit = None
+        self.successResultOf(d)
+        self.assertTrue(self.limit.try_acquire())
+
+
+    def test_changeLimit(self):
+        """
+        Raising the limit lets waiting requests through; lowering it lets no
+        more through until enough slots are given back.
+        """
+        self.limit.max_queued = 2
+        for i in range(2):
+            self.limit.acquire()
+        waiting = [self.limit.acquire(), self.limit.acquire()]
+
+        self.limit.limit = 3
+        self.successResultOf(waiting[0])
+        self.assertNoResult(waiting[1])
+
+        self.limit.limit = 1
+        self.limit.release()
+        self.limit.release()
+        self.assertNoResult(waiting[1])
+        self.limit.release()
+        self.successResultOf(waiting[1])
+
+
+    def test_cancel(self):
+        """
+        Cancelling a request waiting for a slot takes it out of the queue.
+        """
+        for i in range(2):
+            self.limit.acquire()
+        d = self.limit.acquire()
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(self.limit.queued, 0)
+        self.limit.release()
+        self.assertEqual(self.limit.active, 1)
+
+
+    def test_stats(self):
+        """
+        L{ConcurrencyLimit.stats} gives the numbers of requests handled,
+        waiting and turned away, and the limits.
+        """
+        for i in range(4):
+            self.limit.acquire()
+        stats = self.limit.stats()
+        self.assertEqual(
+            (stats.active, stats.queued, stats.rejected, stats.limit,
+             stats.max_queued), (2, 1, 1, 2, 1))
+        self.assertEqual(
+            repr(stats), "<ConcurrencyStats active=2 queued=1 rejected=1 "
+            "limit=2 max_queued=1>")
@@ -0,0 +1,385 @@
+import cPickle as pickle
+import os
+import signal
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from mock import patch
+
+from klein import processes
+from klein.processes import (ProcessPool, RemoteError, RequestSnapshot, _call,
+                             _init_worker)
+from klein.test_resource import requestMock
+
+
+def _add(x, y):
+    return x + y
+
+
+def _pid():
+    return os.getpid()
+
+
+def _fail():
+    raise ValueError("no")
+
+
+def _unpicklable():
+    return lambda: None
+
+
+def _sigterm():
+    return signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+
+
+def _die():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+
+class FakeReactor(Clock):
+    """
+    Calls what is called from threads straight away, and records shutdown
+    triggers.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.triggers = []
+
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+    def addSystemEventTrigger(self, phase, event, f, *args):
+        self.triggers.append((phase, event, f, args))
+
+
+
+class FakePool(object):
+    """
+    A C{multiprocessing.Pool} which runs the calls given to it when told to.
+    """
+    def __init__(self, processes, initializer, initargs=(),
+                 maxtasksperchild=None):
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.maxtasksperchild = maxtasksperchild
+        self.calls = []
+        self.terminated = False
+
+
+    def apply_async(self, f, args, callback):
+        self.calls.append((f, args, callback))
+
+
+    def start(self, index, pid):
+        """
+        Report that the call at C{index} started in the process C{pid}.
+        """
+        [started] = self.initargs
+        started.put((self.calls[index][1][0], pid))
+
+
+    def finish(self, index=0):
+        f, args, callback = self.calls.pop(index)
+        callback(f(*args))
+
+
+    def terminate(self):
+        self.terminated = True
+
+
+    def join(self):
+        pass
+
+
+
+class ProcessPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.pools = []
+
+        def factory(*args, **kwargs):
+            pool = FakePool(*args, **kwargs)
+            self.pools.append(pool)
+            return pool
+
+        self.pool = ProcessPool(2, max_queued=2, max_tasks=5,
+                                reactor=self.reactor, pool_factory=factory)
+
+
+    def test_run(self):
+        """
+        L{ProcessPool.run} starts the pool, with the number of processes and
+        tasks per process it was given, and returns a L{Deferred} firing with
+        the result of the call.
+        """
+        d = self.pool.run(_add, 1, y=2)
+        [pool] = self.pools
+        self.assertEqual(
+            (pool.processes, pool.initializer, pool.maxtasksperchild),
+            (2, _init_worker, 5))
+        self.assertEqual(self.pool.running, 1)
+        self.assertNoResult(d)
+
+        pool.finish()
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(self.pool.running, 0)
+
+
+    def test_error(self):
+        """
+        The L{Deferred} returned by L{ProcessPool.run} fails with the
+        exception raised by the call.
+        """
+        d = self.pool.run(_fail)
+        self.pools[0].finish()
+        self.failureResultOf(d, ValueError)
+
+
+    def test_unpicklableResult(self):
+        """
+        A result which can't be sent back fails with L{RemoteError}.
+        """
+        d = self.pool.run(_unpicklable)
+        self.pools[0].finish()
+        self.failureResultOf(d, RemoteError)
+
+
+    def test_queue(self):
+        """
+        Only as many calls as there are processes are given to the pool; the
+        others wait for one of them to finish, and when too many are waiting
+        L{ProcessPool.run} fails with L{ServiceUnavailable}.
+        """
+        running = [self.pool.run(_add, i, 0) for i in range(2)]
+        queued = [self.pool.run(_add, i, 0) for i in range(2, 4)]
+        [pool] = self.pools
+        self.assertEqual(len(pool.calls), 2)
+        self.assertEqual(self.pool.queued, 2)
+        self.failureResultOf(self.pool.run(_add, 4, 0), ServiceUnavailable)
+
+        pool.finish()
+        self.assertEqual(self.successResultOf(running[0]), 0)
+        self.assertEqual(len(pool.calls), 2)
+        self.assertEqual(self.pool.queued, 1)
+
+        pool.finish()
+        pool.finish()
+        pool.finish()
+        self.assertEqual([self.successResultOf(d) for d in queued], [2, 3])
+
+
+    def test_cancelQueued(self):
+        """
+        Cancelling a call waiting for a process removes it from the queue, so
+        that it is never made.
+        """
+        for i in range(2):
+            self.pool.run(_add, i, 0)
+        d = self.pool.run(_add, 2, 0)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.pool.queued, 0)
+
+        pool = self.pools[0]
+        pool.finish()
+        pool.finish()
+        self.assertEqual(pool.calls, [])
+
+
+    def test_cancelRunning(self):
+        """
+        Cancelling a running call discards its result, and its process is
+        only given another call once it is done.
+        """
+        d = self.pool.run(_add, 1, 2)
+        self.pool.run(_add, 3, 4)
+        queued = self.pool.run(_add, 5, 6)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.pool.queued, 1)
+
+        self.pools[0].finish()
+        self.assertEqual(self.pool.queued, 0)
+        self.assertEqual(self.pool.running, 2)
+        self.assertNoResult(queued)
+
+
+    def test_stop(self):
+        """
+        The pool is terminated when the reactor shuts down.
+        """
+        d = self.pool.run(_add, 1, 2)
+        [(phase, event, f, args)] = self.reactor.triggers
+        self.assertEqual((phase, event), ('during', 'shutdown'))
+        f(*args)
+        self.assertTrue(self.pools[0].terminated)
+        self.failureResultOf(d, RemoteError)
+
+        self.pool.run(_add, 1, 2)
+        self.assertEqual(len(self.pools), 2)
+        self.assertEqual(self.pool.running, 1)
+
+
+    def test_stopFailsCalls(self):
+        """
+        Stopping the pool fails the calls running in it and the calls
+        waiting for it with L{RemoteError}.
+        """
+        running = [self.pool.run(_add, i, 0) for i in range(2)]
+        queued = self.pool.run(_add, 2, 0)
+        self.pool.stop()
+        for d in running + [queued]:
+            self.failureResultOf(d, RemoteError)
+        self.assertEqual((self.pool.running, self.pool.queued), (0, 0))
+
+        # Results coming back after all are discarded.
+        self.pools[0].finish()
+        self.assertEqual(self.pool.running, 0)
+
+
+    def test_workerDied(self):
+        """
+        A running call whose worker process is gone at two checks in a row
+        fails with L{RemoteError}, and its place is given to a waiting call.
+        A process which is gone only at one check may have sent its result
+        already.
+        """
+        dead = set()
+        self.patch(processes, '_alive', lambda pid: pid not in dead)
+        lost = self.pool.run(_add, 1, 2)
+        finished = self.pool.run(_add, 3, 4)
+        queued = self.pool.run(_add, 5, 6)
+        [pool] = self.pools
+        pool.start(0, 100)
+        pool.start(1, 101)
+        dead.update([100, 101])
+
+        self.reactor.advance(self.pool.check_interval)
+        self.assertNoResult(lost)
+        pool.finish(1)
+        self.assertEqual(self.successResultOf(finished), 7)
+
+        self.reactor.advance(self.pool.check_interval)
+        self.failureResultOf(lost, RemoteError)
+        self.assertEqual(self.pool.running, 1)
+        self.assertEqual(len(pool.calls), 2)
+
+        # A result coming back after all is discarded.
+        pool.finish(0)
+        self.assertEqual(self.pool.running, 1)
+        pool.finish()
+        self.assertEqual(self.successResultOf(queued), 11)
+
+        # Checks stop once nothing is running.
+        self.reactor.advance(self.pool.check_interval)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+
+    def test_finishedWorkerReported(self):
+        """
+        A worker process which reported starting a call, and ended after it
+        returned, isn't taken for the process running a later call, even
+        though the report is only read once the later call is running and
+        its L{_Task} has the same C{id}.
+        """
+        dead = set()
+        self.patch(processes, '_alive', lambda pid: pid not in dead)
+        with patch.object(processes, 'id', lambda obj: 0, create=True):
+            self.pool.run(_add, 1, 2)
+            [pool] = self.pools
+            pool.start(0, 100)
+            pool.finish()
+            dead.add(100)
+
+            d = self.pool.run(_add, 3, 4)
+            self.reactor.advance(self.pool.check_interval)
+            self.reactor.advance(self.pool.check_interval)
+        self.assertNoResult(d)
+        self.assertEqual(self.pool.running, 1)
+
+
+
+class RealProcessPoolTests(unittest.TestCase):
+    def test_recycle(self):
+        """
+        Calls are made in other processes, which are replaced after
+        C{max_tasks} calls.
+        """
+        pool = ProcessPool(1, max_tasks=2, reactor=reactor)
+        self.addCleanup(pool.stop)
+
+        pids = []
+        d = defer.succeed(None)
+        for i in range(4):
+            d.addCallback(lambda ignored: pool.run(_pid))
+            d.addCallback(pids.append)
+
+        def _cb(ignored):
+            self.assertNotIn(os.getpid(), pids)
+            self.assertEqual(pids[0], pids[1])
+            self.assertEqual(pids[2], pids[3])
+            self.assertNotEqual(pids[1], pids[2])
+
+        return d.addCallback(_cb)
+
+
+    def test_signals(self):
+        """
+        Worker processes end on C{SIGTERM}, even if the process which forked
+        them handles it, so that the pool can be terminated.
+        """
+        original = signal.signal(signal.SIGTERM, lambda *args: None)
+        self.addCleanup(signal.signal, signal.SIGTERM, original)
+
+        pool = ProcessPool(1, reactor=reactor)
+        self.addCleanup(pool.stop)
+        return pool.run(_sigterm).addCallback(self.assertTrue)
+
+
+    def test_workerDied(self):
+        """
+        A call whose worker process dies fails with L{RemoteError}, and the
+        process is replaced.
+        """
+        pool = ProcessPool(1, reactor=reactor)
+        pool.check_interval = 0.1
+        self.addCleanup(pool.stop)
+
+        d = self.assertFailure(pool.run(_die), RemoteError)
+        d.addCallback(lambda ignored: pool.run(_add, 1, 2))
+        return d.addCallback(self.assertEqual, 3)
+
+
+
+class RequestSnapshotTests(unittest.TestCase):
+    def test_snapshot(self):
+        """
+        L{RequestSnapshot} copies what can be pickled of a request.
+        """
+        request = requestMock("/foo?a=1", method="POST", host="example.com",
+                              port=8443, isSecure=True, body="body",
+                              headers={"X-Foo": ["1", "2"]})
+        request.args = {"a": ["1"]}
+        snapshot = RequestSnapshot(request, ["x", "y"])
+        snapshot = _call(lambda s: s, (snapshot,), {})
+
+        succeeded, snapshot = pickle.loads(snapshot)
+        self.assertTrue(succeeded)
+        self.assertEqual(
+            (snapshot.method, snapshot.uri, snapshot.args, snapshot.content,
+             snapshot.host, snapshot.port, snapshot.secure,
+             snapshot.branch_segments),
+            ("POST", "/foo?a=1", {"a": ["1"]}, "body", "example.com", 8443,
+             True, ["x", "y"]))
+        self.assertEqual(snapshot.getHeader("x-foo"), "2")
+        self.assertEqual(snapshot.getHeader("x-bar"), None)
+        self.assertEqual(snapshot.client_ip, "127.0.0.1")
+        self.assertEqual(request.content.read(), "body")
@@ -1,4 +1,9 @@
+import gc
 import os
+import platform
+import sys
+import threading
+import zlib
 
 from StringIO import StringIO
 
@@ -6,23 +11,29 @@ from twisted.trial import unittest
 
 from klein import Klein
 
+from klein.cache import CachePolicy
+from klein.compression import Compression
+from klein.deadlines import GatewayTimeout
 from klein.interfaces import IKleinRequest
-from klein.resource import KleinResource, ensure_utf8_bytes
+from klein.templates import CachedFragment, FragmentCache
+from klein.resource import (KleinResource, ensure_utf8_bytes,
+                             _http_exception_response)
 
+from twisted.internet.address import IPv4Address
 from twisted.internet.defer import succeed, Deferred, fail, CancelledError
 from twisted.internet.error import ConnectionLost
 from twisted.internet.task import Clock
-from twisted.web import server
+from twisted.web import http, server
 from twisted.web.static import File
 from twisted.web.resource import Resource
+from twisted.web.error import FlattenerError
 from twisted.web.template import Element, XMLString, renderer
 from twisted.web.test.test_web import DummyChannel
 from twisted.web.http_headers import Headers
 
-from werkzeug.exceptions import NotFound
-
-from mock import Mock, call
+from werkzeug.exceptions import NotFound, MethodNotAllowed
 
+from mock import Mock, call, patch
 
 def requestMock(path, method="GET", host="localhost", port=8080, isSecure=False,
                 body=None, headers=None):
@@ -40,6 +51,7 @@ def requestMock(path, method="GET", host="localhost", port=8080, isSecure=False,
     request.content.seek(0)
     request.requestHeaders = Headers(headers)
     request.setHost(host, port, isSecure)
+    request.client = IPv4Address('TCP', '127.0.0.1', 12345)
     request.uri = path
     request.prepath = []
     request.postpath = path.split('/')[1:]
@@ -73,6 +85,11 @@ def requestMock(path, method="GET", host="localhost", port=8080, isSecure=False,
     def finish():
         request._finishCalled += 1
 
+        if request._encoder and not request.finished:
+            data = request._encoder.finish()
+            if data:
+                request._written.write(data)
+
         if not request.startedWriting:
             request.write('')
 
@@ -85,6 +102,8 @@ def requestMock(path, method="GET", host="localhost", port=8080, isSecure=False,
         request.startedWriting = True
 
         if not request.finished:
+            if request._encoder:
+                data = request._encoder.encode(data)
             request._written.write(data)
         else:
             raise RuntimeError('Request.write called on a request after '
@@ -142,6 +161,15 @@ def _render(resource, request):
         raise ValueError("Unexpected return value: %r" % (result,))
 
 
+def _inProcess(request, name):
+    """
+    A handler of a route sent to another process, which has to be defined at
+    the top level of a module.
+    """
+    return "%s %s %s %d" % (request.method, name, request.branch_segments[0],
+                            os.getpid())
+
+
 class SimpleElement(Element):
     loader = XMLString("""
     <h1 xmlns:t="http://twistedmatrix.com/ns/twisted.web.template/0.1" t:render="name" />
@@ -392,6 +420,188 @@ class KleinResourceTests(unittest.TestCase):
         return d
 
 
+    def test_cachedFragmentRendering(self):
+        """
+        An endpoint returning a L{CachedFragment} has the flattened fragment
+        written as the response, and the fragment is only rendered once.
+        """
+        app = self.app
+        cache = FragmentCache()
+        rendered = []
+
+        def produce():
+            rendered.append(None)
+            return SimpleElement("foo")
+
+        @app.route("/")
+        def element(request):
+            return CachedFragment("foo", produce, cache=cache)
+
+        requests = [requestMock("/"), requestMock("/")]
+        d = _render(self.kr, requests[0])
+        d.addCallback(lambda _: _render(self.kr, requests[1]))
+
+        def _cb(result):
+            for request in requests:
+                request.assertWritten("<h1>foo</h1>")
+                request.assertFinishedOnce()
+            self.assertEqual(len(rendered), 1)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_cachedResponse(self):
+        """
+        A route with a L{CachePolicy} has its response written again, headers
+        and all, without calling its endpoint while the response is fresh.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", cache=CachePolicy(ttl=10))
+        def cached(request):
+            calls.append(request)
+            request.setHeader('X-Foo', 'bar')
+            return 'foo%d' % (len(calls),)
+
+        requests = [requestMock("/"), requestMock("/")]
+        d = _render(self.kr, requests[0])
+        d.addCallback(lambda _: _render(self.kr, requests[1]))
+
+        def _cb(result):
+            for request in requests:
+                request.assertWritten('foo1')
+                self.assertEqual(
+                    request.responseHeaders.getRawHeaders('X-Foo'), ['bar'])
+            self.assertEqual(len(calls), 1)
+
+            stats = app.response_cache.stats('cached')
+            self.assertEqual((stats.hits, stats.misses), (1, 1))
+            self.assertEqual(stats.hit_rate, 0.5)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_cachedResponseVary(self):
+        """
+        Responses are cached separately for every value of the request
+        headers named by C{vary}.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", cache=CachePolicy(ttl=10, vary=['Accept-Language']))
+        def cached(request):
+            calls.append(request)
+            return request.getHeader('Accept-Language')
+
+        requests = [
+            requestMock("/", headers={'Accept-Language': ['en']}),
+            requestMock("/", headers={'Accept-Language': ['fr']}),
+            requestMock("/", headers={'Accept-Language': ['en']})]
+        d = _render(self.kr, requests[0])
+        d.addCallback(lambda _: _render(self.kr, requests[1]))
+        d.addCallback(lambda _: _render(self.kr, requests[2]))
+
+        def _cb(result):
+            for request, body in zip(requests, ['en', 'fr', 'en']):
+                request.assertWritten(body)
+            self.assertEqual(len(calls), 2)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_cachedResponseNotCacheable(self):
+        """
+        Responses which aren't successful, set cookies or forbid caching are
+        not cached.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/<int:kind>", cache=CachePolicy(ttl=10))
+        def cached(request, kind):
+            calls.append(kind)
+            if kind == 0:
+                request.setResponseCode(404)
+            elif kind == 1:
+                request.addCookie('session', 'x')
+            else:
+                request.setHeader('Cache-Control', 'no-store')
+            return 'foo'
+
+        d = succeed(None)
+        for path in ["/0", "/1", "/2"] * 2:
+            d.addCallback(lambda _, path=path: _render(self.kr,
+                                                       requestMock(path)))
+
+        def _cb(result):
+            self.assertEqual(calls, [0, 1, 2] * 2)
+            self.assertEqual(len(app.response_cache), 0)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_cachedResponseWritten(self):
+        """
+        Responses which were written to the request, in part or in full,
+        before the endpoint returned are not cached.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", cache=CachePolicy(ttl=10))
+        def cached(request):
+            calls.append(request)
+            request.write("hello world")
+            return None
+
+        requests = [requestMock("/"), requestMock("/")]
+        for request in requests:
+            self.successResultOf(_render(self.kr, request))
+            request.assertWritten("hello world")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(app.response_cache), 0)
+
+
+    def test_cachedResponseRevalidated(self):
+        """
+        A stale response is still written during C{stale_while_revalidate},
+        while the endpoint is called in the background to replace it.
+        """
+        app = self.app
+        clock = Clock()
+        app.response_cache.clock = clock
+        calls = []
+
+        @app.route("/", cache=CachePolicy(ttl=10, stale_while_revalidate=30))
+        def cached(request):
+            calls.append(request)
+            return 'foo%d' % (len(calls),)
+
+        requests = [requestMock("/"), requestMock("/"), requestMock("/"),
+                    requestMock("/")]
+        self.successResultOf(_render(self.kr, requests[0]))
+        clock.advance(15)
+        self.successResultOf(_render(self.kr, requests[1]))
+        self.successResultOf(_render(self.kr, requests[2]))
+        self.assertEqual(len(calls), 1)
+
+        clock.advance(0)
+        self.assertEqual(len(calls), 2)
+        self.assertNotIn(calls[1], requests)
+        self.successResultOf(_render(self.kr, requests[3]))
+
+        for request, body in zip(requests, ['foo1', 'foo1', 'foo1', 'foo2']):
+            request.assertWritten(body)
+        stats = app.response_cache.stats('cached')
+        self.assertEqual((stats.hits, stats.stale, stats.misses), (1, 2, 1))
+
+
     def test_leafResourceRendering(self):
         app = self.app
 
@@ -500,6 +710,183 @@ class KleinResourceTests(unittest.TestCase):
         return d
 
 
+    def test_contentLength(self):
+        """
+        A response returned in full is sent with a C{Content-Length} rather
+        than chunked.
+        """
+        app = self.app
+
+        @app.route("/")
+        def root(request):
+            return u'\u2603'
+
+        channel = DummyChannel()
+        request = server.Request(channel, False)
+        request.content = StringIO()
+        request.method = "GET"
+        request.uri = request.path = "/"
+        request.clientproto = "HTTP/1.1"
+        request.setHost("localhost", 8080)
+        request.prepath, request.postpath = [], [""]
+        self.kr.render(request)
+
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'), ['3'])
+        written = channel.transport.written.getvalue()
+        self.assertNotIn('chunked', written.lower())
+        self.assertTrue(written.endswith("\r\n\r\n\xe2\x98\x83"))
+
+
+    def test_contentLengthEmpty(self):
+        """
+        A response without a body has a C{Content-Length} of C{0}, unless it
+        is one which never has a body.
+        """
+        app = self.app
+
+        @app.route("/")
+        def root(request):
+            return None
+
+        @app.route("/empty")
+        def empty(request):
+            request.setResponseCode(204)
+            return None
+
+        request = requestMock("/")
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'), ['0'])
+
+        request = requestMock("/empty")
+        self.successResultOf(_render(self.kr, request))
+        self.assertFalse(request.responseHeaders.hasHeader('content-length'))
+
+
+    def test_contentLengthNotReplaced(self):
+        """
+        Responses which were partly written by their endpoint, or which were
+        given a C{Content-Length} by it, are left alone.
+        """
+        app = self.app
+
+        @app.route("/written")
+        def written(request):
+            request.write("foo")
+            return "bar"
+
+        @app.route("/given")
+        def given(request):
+            request.setHeader('Content-Length', '3')
+            return "foo"
+
+        request = requestMock("/written")
+        self.successResultOf(_render(self.kr, request))
+        request.assertWritten("foobar")
+        self.assertFalse(request.responseHeaders.hasHeader('content-length'))
+
+        request = requestMock("/given")
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'), ['3'])
+
+
+    def test_synchronousRendering(self):
+        app = self.app
+
+        request = requestMock("/")
+
+        @app.route("/")
+        def root(request):
+            return 'sync'
+
+        with patch.object(sys.modules["klein.resource"], "defer") as mock_defer:
+            self.assertEqual(self.kr.render(request), server.NOT_DONE_YET)
+
+        self.assertEqual(mock_defer.mock_calls, [])
+        request.assertWrittenOnceWith('sync')
+        request.assertFinishedOnce()
+
+    def test_synchronousRaise(self):
+        app = self.app
+
+        request = requestMock("/")
+
+        @app.route("/")
+        def root(request):
+            raise ValueError("sync")
+
+        @app.handle_errors(ValueError)
+        def handle_value_error(request, failure):
+            request.setResponseCode(400)
+            return failure.getErrorMessage()
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            self.assertEqual(request.code, 400)
+            request.assertWrittenOnceWith('sync')
+            request.assertFinishedOnce()
+
+        d.addCallback(_cb)
+        return d
+
+    def test_allocationBudget(self):
+        """
+        Rendering requests for an endpoint which returns its body straight
+        away, or in a L{Deferred} which has fired already, makes no garbage
+        cycles and keeps fewer than two objects the garbage collector tracks
+        for each request once it is answered.
+        """
+        app = self.app
+
+        @app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            return 'foo'
+
+        @app.route("/deferred/<int:bar>")
+        def deferred(request, bar):
+            return succeed('foo')
+
+        def plainRequest(path):
+            # The mocks of requestMock keep a record of their calls.
+            request = server.Request(DummyChannel(), False)
+            request.gotLength(0)
+            request.setHost('localhost', 8080)
+            request.uri = request.path = path
+            request.prepath = []
+            request.postpath = path.split('/')[1:]
+            request.method = 'GET'
+            request.clientproto = 'HTTP/1.1'
+            return request
+
+        count = 100
+        for path in ["/foo/1", "/deferred/1"]:
+            # Warm up any caches.
+            self.kr.render(plainRequest(path))
+
+            requests = [plainRequest(path) for i in range(count)]
+            gc.collect()
+            gc.disable()
+            try:
+                before = len(gc.get_objects())
+                for request in requests:
+                    self.kr.render(request)
+                garbage = gc.collect()
+                kept = len(gc.get_objects()) - before
+            finally:
+                gc.enable()
+
+            for request in requests:
+                self.assertTrue(request.finished)
+            self.assertEqual(garbage, 0, path)
+            self.assertTrue(kept < 2 * count,
+                            "%s kept %d objects" % (path, kept))
+
+    if platform.python_implementation() != 'CPython':
+        test_allocationBudget.skip = "Only CPython counts objects exactly"
+
     def test_renderNone(self):
         app = self.app
 
@@ -833,6 +1220,62 @@ class KleinResourceTests(unittest.TestCase):
         d.addCallback(_cb)
         return d
 
+    def test_failingErrorHandler(self):
+        app = self.app
+        request = requestMock("/")
+        handled = []
+
+        @app.route("/")
+        def root(request):
+            raise ValueError("bad value")
+
+        @app.handle_errors(TypeError)
+        def early_type_error(request, failure):
+            handled.append("early")
+
+        @app.handle_errors(ValueError)
+        def value_error(request, failure):
+            handled.append("value")
+            raise TypeError("bad type")
+
+        @app.handle_errors(ValueError)
+        def late_value_error(request, failure):
+            handled.append("late value")
+
+        @app.handle_errors(TypeError)
+        def late_type_error(request, failure):
+            handled.append("late type")
+            request.setResponseCode(400)
+            return "bad"
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            self.assertEqual(handled, ["value", "late type"])
+            self.assertEqual(request.code, 400)
+            request.assertWritten("bad")
+
+        d.addCallback(_cb)
+        return d
+
+    def test_notFoundWithoutTraceback(self):
+        app = self.app
+        request = requestMock("/foo")
+        failures = []
+
+        @app.handle_errors(NotFound)
+        def handle_not_found(request, failure):
+            failures.append(failure)
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            self.assertIdentical(failures[0].tb, None)
+            self.assertEqual(failures[0].frames, [])
+
+        d.addCallback(_cb)
+        return d
+
     def test_notFoundException(self):
         app = self.app
         request = requestMock("/foo")
@@ -959,6 +1402,41 @@ class KleinResourceTests(unittest.TestCase):
         d.addCallback(_cb)
         return d
 
+    def test_mapperReused(self):
+        app = self.app
+        mappers = []
+
+        @app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            mappers.append(IKleinRequest(request).mapper)
+            return 'foo'
+
+        d = _render(self.kr, requestMock('/foo/1'))
+        d.addCallback(lambda _: _render(self.kr, requestMock('/foo/2')))
+
+        def _cb(result):
+            self.assertIdentical(mappers[0], mappers[1])
+
+        d.addCallback(_cb)
+        return d
+
+    def test_notAdaptedUnlessNeeded(self):
+        app = self.app
+        request = requestMock('/foo')
+
+        @app.route("/foo")
+        def foo(request):
+            return 'foo'
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            request.assertWritten('foo')
+            self.assertEqual(request._adapterCache, {})
+
+        d.addCallback(_cb)
+        return d
+
     def test_cancelledDeferred(self):
         app = self.app
         request = requestMock("/")
@@ -1040,7 +1518,1123 @@ class KleinResourceTests(unittest.TestCase):
 
         return d
 
+    def test_coalescedRequests(self):
+        """
+        Identical requests to a route with C{coalesce} set which arrive while
+        its endpoint is waiting for a L{Deferred} all get its result, and the
+        response code and headers it set, without calling it again.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", coalesce=True)
+        def root(request):
+            calls.append(Deferred())
+            request.setResponseCode(201)
+            request.setHeader('X-Foo', 'bar')
+            request.addCookie('session', 'x')
+            return calls[-1]
+
+        requests = [requestMock("/"), requestMock("/"), requestMock("/")]
+        requests[2].uri = "/?x=1"
+        ds = [_render(self.kr, request) for request in requests]
+        self.assertEqual(len(calls), 2)
+
+        for d in calls:
+            d.callback('foo')
+
+        for d in ds:
+            self.successResultOf(d)
+        for request in requests:
+            request.assertWritten('foo')
+            self.assertEqual(request.code, 201)
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('X-Foo'), ['bar'])
+        self.assertEqual(requests[1].cookies, [])
+        self.assertEqual(app._in_flight, {})
+
+        # Once the result is sent, the endpoint is called again.
+        _render(self.kr, requestMock("/"))
+        self.assertEqual(len(calls), 3)
+
+
+    def test_coalescedVary(self):
+        """
+        Requests to a route coalescing on some request headers are only
+        coalesced if the values of those headers are the same.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", coalesce=['Accept'])
+        def root(request):
+            calls.append(Deferred())
+            return calls[-1]
+
+        for accept in ['text/html', 'text/plain', 'text/html']:
+            _render(self.kr, requestMock("/", headers={'Accept': [accept]}))
+        self.assertEqual(len(calls), 2)
+
+
+    def test_coalescedIterator(self):
+        """
+        An iterator returned by a coalescing route can only be streamed once,
+        so it is sent to the request the endpoint was called for, and the
+        endpoint is called again for the others.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", coalesce=True)
+        def root(request):
+            calls.append(Deferred())
+            return calls[-1]
+
+        requests = [requestMock("/"), requestMock("/"), requestMock("/")]
+        ds = [_render(self.kr, request) for request in requests]
+        self.assertEqual(len(calls), 1)
+
+        calls[0].callback(iter(['foo', 'bar']))
+        self.assertEqual(len(calls), 3)
+        self.successResultOf(ds[0])
+        requests[0].assertWritten('foobar')
+        self.assertNoResult(ds[1])
+
+        calls[1].callback(iter(['baz']))
+        calls[2].callback('qux')
+        for d in ds:
+            self.successResultOf(d)
+        requests[1].assertWritten('baz')
+        requests[2].assertWritten('qux')
+        self.assertEqual(app._in_flight, {})
+
+
+    def test_coalescedIteratorCancelled(self):
+        """
+        A request going away while the endpoint is called again for it
+        cancels that call.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", coalesce=True)
+        def root(request):
+            calls.append(Deferred())
+            return calls[-1]
+
+        requests = [requestMock("/"), requestMock("/")]
+        ds = [_render(self.kr, request) for request in requests]
+        calls[0].callback(iter(['foo']))
+
+        requests[1].connectionLost(ConnectionLost())
+        self.failureResultOf(ds[1], ConnectionLost)
+        self.assertTrue(calls[1].called)
+
+
+    def test_coalescedWaiterDisconnects(self):
+        """
+        A request going away while coalesced with others doesn't cancel the
+        call they share, which is only cancelled once every one of them has
+        gone away.
+        """
+        app = self.app
+        handler_d = Deferred()
+        handler_d.addErrback(lambda f: f.trap(CancelledError))
+
+        @app.route("/", coalesce=True)
+        def root(request):
+            return handler_d
+
+        requests = [requestMock("/"), requestMock("/"), requestMock("/")]
+        ds = [_render(self.kr, request) for request in requests]
+
+        requests[0].connectionLost(ConnectionLost())
+        self.failureResultOf(ds[0], ConnectionLost)
+        self.assertFalse(handler_d.called)
+
+        requests[1].connectionLost(ConnectionLost())
+        self.failureResultOf(ds[1], ConnectionLost)
+        self.assertFalse(handler_d.called)
+
+        requests[2].connectionLost(ConnectionLost())
+        self.failureResultOf(ds[2], ConnectionLost)
+        self.assertTrue(handler_d.called)
+        self.assertEqual(app._in_flight, {})
+
+        for request in requests:
+            self.assertEqual(request.processingFailed.call_count, 0)
+
+
+    def test_coalescedSynchronous(self):
+        """
+        Results returned straight away by a coalescing route are not shared.
+        """
+        app = self.app
+
+        @app.route("/", coalesce=True)
+        def root(request):
+            return succeed('foo')
+
+        request = requestMock("/")
+        self.successResultOf(_render(self.kr, request))
+        request.assertWritten('foo')
+        self.assertEqual(app._in_flight, {})
+
+
+    def test_threadedRoute(self):
+        """
+        Threaded routes are called in a thread of their pool, and their
+        result written once they return.
+        """
+        app = self.app
+        threads = []
+
+        @app.route("/", threaded=True, pool="db")
+        def root(request):
+            threads.append(threading.current_thread())
+            return 'foo'
+
+        self.addCleanup(app.thread_pools.stop)
+        request = requestMock("/")
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            request.assertWritten('foo')
+            self.assertIn("klein-db", threads[0].name)
+            self.assertEqual(app.thread_pools.stats("db").working, 0)
+
+        return d.addCallback(_cb)
+
+
+    def test_processRoute(self):
+        """
+        Routes sent to another process are called there with a snapshot of
+        the request, and their result written once they return.
+        """
+        app = self.app
+        app.route("/<name>", process=True, branch=True)(_inProcess)
+        self.addCleanup(app.process_pool.stop)
+
+        request = requestMock("/foo/bar")
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            method, name, segment, pid = request._written.getvalue().split()
+            self.assertEqual((method, name, segment), ("GET", "foo", "bar"))
+            self.assertNotEqual(int(pid), os.getpid())
+            self.assertEqual(app.process_pool.running, 0)
+
+        return d.addCallback(_cb)
+
+
+    def test_generatorStreaming(self):
+        """
+        The chunks produced by a generator returned from an endpoint are
+        written one after another through a streaming producer, and the
+        request is finished when the generator is exhausted.
+        """
+        app = self.app
+        request = requestMock("/")
+
+        @app.route("/")
+        def root(request):
+            yield "a"
+            yield u"\u2202"
+            yield None
+            yield "c"
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            request.assertWritten("a\xe2\x88\x82c")
+            request.assertFinishedOnce()
+            self.assertIdentical(request.producer, None)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_generatorPaused(self):
+        """
+        No more chunks are taken from a generator while the transport has
+        paused the producer.
+        """
+        app = self.app
+        request = requestMock("/")
+        write = request.write
+
+        def pausingWrite(data):
+            write(data)
+            request.producer.pauseProducing()
+
+        request.write = pausingWrite
+
+        @app.route("/")
+        def root(request):
+            for chunk in ["a", "b", "c"]:
+                yield chunk
+
+        d = _render(self.kr, request)
+        request.assertWritten("a")
+        self.assertFalse(request.finished)
+
+        request.producer.resumeProducing()
+        request.assertWritten("ab")
+
+        request.producer.resumeProducing()
+        request.producer.resumeProducing()
+        request.assertWritten("abc")
+        request.assertFinishedOnce()
+        return d
+
+
+    def test_generatorYieldingDeferreds(self):
+        """
+        A generator may yield L{Deferred}s, which are waited for before their
+        result is written and the next chunk is taken.
+        """
+        app = self.app
+        request = requestMock("/")
+        chunk = Deferred()
+
+        @app.route("/")
+        def root(request):
+            yield succeed("a")
+            yield chunk
+            yield "c"
+
+        d = _render(self.kr, request)
+        request.assertWritten("a")
+
+        chunk.callback("b")
+        request.assertWritten("abc")
+        request.assertFinishedOnce()
+        return d
+
+
+    def test_generatorFailsBeforeWriting(self):
+        """
+        If a generator fails before anything was written, its failure is
+        given to the error handlers.
+        """
+        app = self.app
+        request = requestMock("/")
+
+        @app.route("/")
+        def root(request):
+            yield 1 / 0
+
+        @app.handle_errors(ZeroDivisionError)
+        def zero(request, failure):
+            request.setResponseCode(500)
+            return "oops"
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            request.assertWritten("oops")
+            request.setResponseCode.assert_called_with(500)
+            request.assertFinishedOnce()
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_generatorBadChunk(self):
+        """
+        A chunk which can't be written fails the response like an exception
+        raised by the generator.
+        """
+        app = self.app
+        request = requestMock("/")
+
+        @app.route("/")
+        def root(request):
+            yield 5
+
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            self.assertEqual(request.processingFailed.call_count, 1)
+            self.flushLoggedErrors(TypeError)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_generatorFailsAfterWriting(self):
+        """
+        If a generator fails after something was written, the failure is
+        logged and the connection is dropped rather than finishing the
+        response.
+        """
+        app = self.app
+        request = requestMock("/")
+
+        @app.route("/")
+        def root(request):
+            yield "a"
+            raise ZeroDivisionError()
+
+        _render(self.kr, request)
+
+        request.assertWritten("a")
+        self.assertEqual(request._finishCalled, 0)
+        self.assertTrue(request.transport.disconnected)
+        self.assertIdentical(request.producer, None)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+    def test_generatorClosedOnConnectionLost(self):
+        """
+        When the connection is lost the generator is closed and the
+        L{Deferred} it is waiting for is cancelled.
+        """
+        app = self.app
+        request = requestMock("/")
+        chunk = Deferred()
+        closed = []
+
+        @app.route("/")
+        def root(request):
+            try:
+                yield "a"
+                yield chunk
+                yield "b"
+            finally:
+                closed.append(True)
+
+        d = _render(self.kr, request)
+        request.connectionLost(ConnectionLost())
+
+        def _cb(result):
+            request.assertWritten("a")
+            self.assertEqual(closed, [True])
+            self.assertTrue(chunk.called)
+            self.assertEqual(request.processingFailed.call_count, 0)
+
+        d.addErrback(lambda f: f.trap(ConnectionLost))
+        d.addCallback(_cb)
+        chunk.addErrback(lambda f: f.trap(CancelledError))
+        return d
+
+
     def test_ensure_utf8_bytes(self):
         self.assertEqual(ensure_utf8_bytes(u"abc"), "abc")
         self.assertEqual(ensure_utf8_bytes(u"\u2202"), "\xe2\x88\x82")
         self.assertEqual(ensure_utf8_bytes("\xe2\x88\x82"), "\xe2\x88\x82")
+
+
+
+class FailingElement(Element):
+    loader = XMLString("""
+    <div xmlns:t="http://twistedmatrix.com/ns/twisted.web.template/0.1">
+    <p>before</p><p t:render="fail" />
+    </div>
+    """)
+
+    @renderer
+    def fail(self, request, tag):
+        raise ZeroDivisionError()
+
+
+
+class FlattenChunkTests(unittest.TestCase):
+    """
+    Tests for applications which flatten renderables straight to the
+    request.
+    """
+    def setUp(self):
+        self.app = Klein(flatten_chunk_size=4)
+        self.kr = KleinResource(self.app)
+
+
+    def test_elementWrittenInChunks(self):
+        """
+        Renderables are written as they are flattened, in chunks of at least
+        C{flatten_chunk_size} bytes.
+        """
+        app = self.app
+
+        @app.route("/")
+        def element(request):
+            return SimpleElement("foo")
+
+        request = requestMock("/")
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            request.assertWritten("<h1>foo</h1>")
+            self.assertEqual(request._writeCalled, 2)
+            request.assertFinishedOnce()
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_elementWrittenInChunksNotCached(self):
+        """
+        Renderables written in chunks as they are flattened are not cached,
+        since only their last chunk reaches the response cache.
+        """
+        app = self.app
+        calls = []
+
+        @app.route("/", cache=CachePolicy(ttl=10))
+        def element(request):
+            calls.append(request)
+            return SimpleElement("foo")
+
+        requests = [requestMock("/"), requestMock("/")]
+        for request in requests:
+            self.successResultOf(_render(self.kr, request))
+            request.assertWritten("<h1>foo</h1>")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(app.response_cache), 0)
+
+
+    def test_flattenErrorHandled(self):
+        """
+        A renderable which fails before anything was written has its failure
+        given to the error handlers, and what it had rendered is discarded.
+        """
+        self.app = app = Klein(flatten_chunk_size=1024)
+        self.kr = KleinResource(app)
+
+        @app.route("/")
+        def element(request):
+            return FailingElement()
+
+        @app.handle_errors(FlattenerError)
+        def zero(request, failure):
+            request.setResponseCode(500)
+            return "oops"
+
+        request = requestMock("/")
+        d = _render(self.kr, request)
+
+        def _cb(result):
+            request.assertWritten("oops")
+            request.setResponseCode.assert_called_with(500)
+
+        d.addCallback(_cb)
+        return d
+
+
+    def test_flattenErrorAfterWriting(self):
+        """
+        A renderable which fails after part of it was written has its failure
+        logged and the connection dropped.
+        """
+        app = self.app
+
+        @app.route("/")
+        def element(request):
+            return FailingElement()
+
+        request = requestMock("/")
+        _render(self.kr, request)
+
+        self.assertTrue(request._written.getvalue().startswith("<div>"))
+        self.assertEqual(request._finishCalled, 0)
+        self.assertTrue(request.transport.disconnected)
+        self.assertEqual(len(self.flushLoggedErrors(FlattenerError)), 1)
+
+
+
+class ETagTests(unittest.TestCase):
+    """
+    Tests for the entity tags of an application created with C{etags=True}.
+    """
+    def setUp(self):
+        self.app = Klein(etags=True)
+        self.kr = KleinResource(self.app)
+        self.calls = []
+
+        @self.app.route("/")
+        def root(request):
+            self.calls.append(request)
+            return 'foo'
+
+
+    def render(self, *tags):
+        headers = {}
+        if tags:
+            headers['If-None-Match'] = [', '.join(tags)]
+        request = requestMock("/", headers=headers)
+        self.successResultOf(_render(self.kr, request))
+        return request
+
+
+    def test_etag(self):
+        """
+        A response returned in full is given an entity tag computed from its
+        body.
+        """
+        first, second = self.render(), self.render()
+        first.assertWritten('foo')
+        self.assertEqual(first.code, 200)
+        self.assertEqual(first.etag, '"3-8c736521"')
+        self.assertEqual(second.etag, first.etag)
+
+
+    def test_notModified(self):
+        """
+        A request whose C{If-None-Match} matches the entity tag of the
+        response, weakly or as one of several, gets a C{304 Not Modified}
+        response without a body.
+        """
+        for tags in [('"3-8c736521"',), ('"x"', 'W/"3-8c736521"'), ('*',)]:
+            request = self.render(*tags)
+            self.assertEqual(request.code, 304)
+            request.assertWritten('')
+
+        request = self.render('"x"')
+        self.assertEqual(request.code, 200)
+        request.assertWritten('foo')
+
+
+    def test_handlerETag(self):
+        """
+        An entity tag given by the handler is used instead of computing one.
+        """
+        @self.app.route("/tagged")
+        def tagged(request):
+            request.setETag('"v1"')
+            return 'foo'
+
+        request = requestMock("/tagged",
+                              headers={'If-None-Match': ['"v1"']})
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.code, 304)
+        self.assertEqual(request.etag, '"v1"')
+        request.assertWritten('')
+
+
+    def test_isFresh(self):
+        """
+        L{IKleinRequest.is_fresh} lets a handler answer a conditional request
+        with C{304 Not Modified} before producing the response.
+        """
+        calls = []
+
+        @self.app.route("/cheap")
+        def cheap(request):
+            if IKleinRequest(request).is_fresh(etag='v2', last_modified=60):
+                return None
+            calls.append(request)
+            return 'expensive'
+
+        def render(**headers):
+            request = requestMock("/cheap", headers=dict(
+                [(name.replace('_', '-'), [value])
+                 for name, value in headers.items()]))
+            self.successResultOf(_render(self.kr, request))
+            return request
+
+        fresh = render(If_None_Match='"v2"')
+        self.assertEqual((fresh.code, fresh.etag), (304, '"v2"'))
+        fresh.assertWritten('')
+
+        fresh = render(If_Modified_Since=http.datetimeToString(60))
+        self.assertEqual(fresh.code, 304)
+
+        # If-None-Match takes precedence over If-Modified-Since.
+        stale = render(If_None_Match='"v1"',
+                       If_Modified_Since=http.datetimeToString(60))
+        self.assertEqual(stale.code, 200)
+        stale.assertWritten('expensive')
+        self.assertEqual(len(calls), 1)
+
+
+    def test_notSuccessful(self):
+        """
+        Responses which aren't successful aren't given an entity tag.
+        """
+        request = requestMock("/missing",
+                              headers={'If-None-Match': ['*']})
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.code, 404)
+        self.assertIdentical(request.etag, None)
+
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+
+class CompressionTests(unittest.TestCase):
+    """
+    Tests for the compression of the responses of an application created
+    with a C{compress_level}.
+    """
+    body = "compressible " * 100
+
+    def setUp(self):
+        self.app = Klein(compress_level=6, compress_min_bytes=100)
+        self.kr = KleinResource(self.app)
+
+
+    def render(self, path, accept='gzip'):
+        request = requestMock(path, headers={'Accept-Encoding': [accept]})
+        self.successResultOf(_render(self.kr, request))
+        return request
+
+
+    def test_buffered(self):
+        """
+        A response returned in full is compressed with the content coding
+        the client accepts.
+        """
+        @self.app.route("/")
+        def root(request):
+            return self.body
+
+        request = self.render("/")
+        self.assertEqual(gunzip(request._written.getvalue()), self.body)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-encoding'),
+            ['gzip'])
+        self.assertEqual(request.responseHeaders.getRawHeaders('vary'),
+                         ['Accept-Encoding'])
+
+        request = self.render("/", accept='identity')
+        request.assertWritten(self.body)
+        self.assertFalse(request.responseHeaders.hasHeader('content-encoding'))
+
+
+    def test_bufferedLength(self):
+        """
+        A response returned in full and compressed has the C{Content-Length}
+        of its compressed body, even if the endpoint set one.
+        """
+        @self.app.route("/")
+        def root(request):
+            request.setHeader('Content-Length', str(len(self.body)))
+            return self.body
+
+        request = self.render("/")
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'),
+            [str(len(request._written.getvalue()))])
+
+        request = self.render("/", accept='identity')
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'),
+            [str(len(self.body))])
+
+
+    def test_notCompressed(self):
+        """
+        Small responses, responses which are compressed already and the
+        responses of routes with C{compress=0} are not compressed.
+        """
+        @self.app.route("/small")
+        def small(request):
+            return "small"
+
+        @self.app.route("/image")
+        def image(request):
+            request.setHeader('Content-Type', 'image/png')
+            return self.body
+
+        @self.app.route("/off", compress=0)
+        def off(request):
+            return self.body
+
+        self.render("/small").assertWritten("small")
+        self.render("/image").assertWritten(self.body)
+        self.render("/off").assertWritten(self.body)
+
+
+    def test_routeLevel(self):
+        """
+        A route may compress its responses with its own level, even if the
+        application doesn't compress responses.
+        """
+        app = self.app = Klein()
+        self.kr = KleinResource(app)
+
+        @app.route("/", compress=1)
+        def root(request):
+            return self.body
+
+        @app.route("/plain")
+        def plain(request):
+            return self.body
+
+        request = self.render("/")
+        self.assertEqual(app.endpoints['root'].compression.level, 1)
+        self.assertEqual(gunzip(request._written.getvalue()), self.body)
+        self.render("/plain").assertWritten(self.body)
+
+
+    def test_streamed(self):
+        """
+        Responses produced by an iterator are compressed chunk by chunk.
+        """
+        chunks = []
+
+        @self.app.route("/")
+        def root(request):
+            request.setETag('"v1"')
+            for chunk in ["first ", "second"]:
+                chunks.append(chunk)
+                yield chunk
+
+        request = self.render("/", accept='deflate')
+        self.assertEqual(zlib.decompress(request._written.getvalue()),
+                         "first second")
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-encoding'),
+            ['deflate'])
+        self.assertEqual(request.etag, '"v1-deflate"')
+
+
+    def test_streamedWithoutEncoder(self):
+        """
+        Responses produced by an iterator are sent uncompressed by versions
+        of Twisted whose requests can't compress what is written to them.
+        """
+        self.patch(sys.modules['klein.resource'], '_STREAM_ENCODING', False)
+
+        @self.app.route("/")
+        def root(request):
+            yield "first "
+            yield "second"
+
+        request = self.render("/")
+        request.assertWritten("first second")
+        self.assertFalse(request.responseHeaders.hasHeader('content-encoding'))
+
+
+    def test_etag(self):
+        """
+        Compressed responses have entity tags of their own.
+        """
+        self.app._etags = True
+
+        @self.app.route("/")
+        def root(request):
+            return self.body
+
+        compressed = self.render("/").etag
+        plain = self.render("/", accept='identity').etag
+        self.assertEqual(compressed, plain[:-1] + '-gzip"')
+
+        request = requestMock("/", headers={'Accept-Encoding': ['gzip'],
+                                            'If-None-Match': [plain]})
+        self.successResultOf(_render(self.kr, request))
+        self.assertEqual(request.code, 200)
+
+
+    def test_cachedVariants(self):
+        """
+        The compressed bodies of cached responses are kept along with them,
+        so that they are only compressed once.
+        """
+        compressed = []
+        compress = Compression.compress
+
+        def counting(compression, encoding, body):
+            compressed.append(encoding)
+            return compress(compression, encoding, body)
+
+        self.patch(Compression, 'compress', counting)
+
+        @self.app.route("/", cache=CachePolicy(ttl=10))
+        def root(request):
+            return self.body
+
+        for i in range(3):
+            request = self.render("/")
+            self.assertEqual(gunzip(request._written.getvalue()), self.body)
+        self.render("/", accept='identity').assertWritten(self.body)
+
+        # The first response is compressed before it is cached.
+        self.assertEqual(compressed, ['gzip', 'gzip'])
+        self.assertTrue(self.app.response_cache.size > len(self.body))
+
+
+
+class ConcurrencyTests(unittest.TestCase):
+    """
+    Tests for the concurrency limits of applications and routes.
+    """
+    def setUp(self):
+        self.app = Klein(max_queued=1, retry_after=5)
+        self.kr = KleinResource(self.app)
+        self.calls = []
+
+        @self.app.route("/slow", max_concurrency=1)
+        def slow(request):
+            self.calls.append(Deferred())
+            return self.calls[-1]
+
+        @self.app.route("/fast")
+        def fast(request):
+            return 'fast'
+
+
+    def render(self, path):
+        request = requestMock(path)
+        return request, _render(self.kr, request)
+
+
+    def assertShed(self, request, d):
+        """
+        C{request} was answered with C{503 Service Unavailable} straight
+        away.
+        """
+        self.successResultOf(d)
+        self.assertEqual(request.code, 503)
+        self.assertEqual(request.responseHeaders.getRawHeaders('retry-after'),
+                         ['5'])
+        self.assertIn("503 Service Unavailable", request._written.getvalue())
+
+
+    def test_routeLimit(self):
+        """
+        Requests for a route beyond its C{max_concurrency} wait for earlier
+        ones to finish, and beyond its C{max_queued} are turned away without
+        calling its handler.  Other routes aren't affected.
+        """
+        first, firstDone = self.render("/slow")
+        second, secondDone = self.render("/slow")
+        self.assertEqual(len(self.calls), 1)
+
+        third, thirdDone = self.render("/slow")
+        self.assertShed(third, thirdDone)
+        self.assertEqual(len(self.calls), 1)
+
+        fast, fastDone = self.render("/fast")
+        self.successResultOf(fastDone)
+        fast.assertWritten('fast')
+
+        stats = self.app.concurrency_limit("slow").stats()
+        self.assertEqual((stats.active, stats.queued, stats.rejected),
+                         (1, 1, 1))
+
+        self.calls[0].callback('first')
+        self.successResultOf(firstDone)
+        first.assertWritten('first')
+        self.assertEqual(len(self.calls), 2)
+
+        self.calls[1].callback('second')
+        self.successResultOf(secondDone)
+        second.assertWritten('second')
+        self.assertEqual(self.app.concurrency_limit("slow").active, 0)
+
+
+    def test_appLimit(self):
+        """
+        The C{max_concurrency} of the application limits requests for every
+        route.
+        """
+        self.app.concurrency_limit().limit = 1
+        slow, slowDone = self.render("/slow")
+        fast, fastDone = self.render("/fast")
+        self.assertNoResult(fastDone)
+
+        shed, shedDone = self.render("/fast")
+        self.assertShed(shed, shedDone)
+        self.assertEqual(self.app.concurrency_limit().stats().rejected, 1)
+
+        self.calls[0].callback('slow')
+        self.successResultOf(fastDone)
+        fast.assertWritten('fast')
+
+
+    def test_routeQueueHoldsNoAppSlot(self):
+        """
+        Requests waiting for a slot of their route don't hold a slot of the
+        application.
+        """
+        self.app.concurrency_limit().limit = 2
+        self.render("/slow")
+        self.render("/slow")
+        fast, fastDone = self.render("/fast")
+        self.successResultOf(fastDone)
+        self.assertEqual(self.app.concurrency_limit().active, 1)
+
+
+    def test_raiseLimit(self):
+        """
+        Raising a limit while the application runs lets waiting requests
+        through.
+        """
+        self.render("/slow")
+        self.render("/slow")
+        self.app.concurrency_limit("slow").limit = 2
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_waitingRequestGoesAway(self):
+        """
+        A request whose connection goes away while it waits for its turn
+        leaves the queue, and its handler is never called.
+        """
+        self.render("/slow")
+        second, secondDone = self.render("/slow")
+        second.connectionLost(ConnectionLost())
+        self.failureResultOf(secondDone, ConnectionLost)
+        self.assertEqual(self.app.concurrency_limit("slow").queued, 0)
+
+        self.calls[0].callback('first')
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.app.concurrency_limit("slow").active, 0)
+
+
+    def test_unlimited(self):
+        """
+        Routes and applications have no limit by default.
+        """
+        self.assertIdentical(self.app.concurrency_limit("fast").limit, None)
+        self.assertIdentical(self.app.concurrency_limit().limit, None)
+        for i in range(3):
+            self.successResultOf(self.render("/fast")[1])
+        self.assertEqual(self.app.concurrency_limit("fast").active, 0)
+
+
+
+class TimeoutTests(unittest.TestCase):
+    """
+    Tests for the deadlines of requests.
+    """
+    def setUp(self):
+        self.app = Klein(timeout=10)
+        self.app.clock = self.clock = Clock()
+        self.kr = KleinResource(self.app)
+        self.calls = []
+        self.remaining = []
+
+        def slow(request):
+            self.remaining.append(IKleinRequest(request).time_remaining())
+            self.calls.append(Deferred())
+            return self.calls[-1]
+
+        self.app.route("/default", endpoint="default")(slow)
+        self.app.route("/short", endpoint="short", timeout=1)(slow)
+        self.app.route("/none", endpoint="none", timeout=0)(slow)
+
+
+    def render(self, path):
+        request = requestMock(path)
+        return request, _render(self.kr, request)
+
+
+    def test_timeout(self):
+        """
+        A handler which hasn't returned by the deadline of its route is
+        cancelled, and the request answered with C{504 Gateway Timeout}.
+        """
+        request, d = self.render("/short")
+        self.clock.advance(0.5)
+        self.assertNoResult(d)
+
+        self.clock.advance(0.5)
+        self.successResultOf(d)
+        self.assertTrue(self.calls[0].called)
+        self.assertEqual(request.code, 504)
+        self.assertIn("504 Gateway Timeout", request._written.getvalue())
+
+
+    def test_appTimeout(self):
+        """
+        Routes not giving a C{timeout} have the C{timeout} of the
+        application, and routes giving C{0} have none.
+        """
+        request, d = self.render("/default")
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(request.code, 504)
+
+        request, d = self.render("/none")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.remaining[-1], None)
+
+
+    def test_inTime(self):
+        """
+        A handler returning by the deadline is answered as usual, and the
+        deadline forgotten.
+        """
+        request, d = self.render("/short")
+        self.calls[0].callback('foo')
+        self.successResultOf(d)
+        request.assertWritten('foo')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_errorHandler(self):
+        """
+        Requests which time out go through the error handlers for
+        L{GatewayTimeout}.
+        """
+        @self.app.handle_errors(GatewayTimeout)
+        def timeout(request, failure):
+            request.setResponseCode(504)
+            return 'too slow'
+
+        request, d = self.render("/short")
+        self.clock.advance(1)
+        self.successResultOf(d)
+        request.assertWritten('too slow')
+
+
+    def test_disconnect(self):
+        """
+        A request whose connection goes away before its deadline is not
+        answered with C{504 Gateway Timeout}, and the deadline is
+        forgotten.
+        """
+        request, d = self.render("/short")
+        request.connectionLost(ConnectionLost())
+        self.failureResultOf(d, ConnectionLost)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(request.processingFailed.call_count, 0)
+
+
+    def test_timeRemaining(self):
+        """
+        L{IKleinRequest.time_remaining} gives the number of seconds left
+        before the deadline of the request.
+        """
+        self.clock.advance(100)
+        request, d = self.render("/short")
+        self.assertEqual(self.remaining, [1.0])
+        self.clock.advance(0.25)
+        self.assertEqual(IKleinRequest(request).time_remaining(), 0.75)
+
+        self.assertEqual(
+            IKleinRequest(requestMock("/")).time_remaining(), None)
+
+
+
+class HTTPExceptionResponseTests(unittest.TestCase):
+    def test_response(self):
+        """
+        L{_http_exception_response} returns the code, headers and body of
+        the response werkzeug would send for an exception.
+        """
+        code, headers, body = _http_exception_response(
+            MethodNotAllowed(['GET', 'HEAD']))
+
+        self.assertEqual(code, 405)
+        self.assertIn(('Allow', 'GET, HEAD'), headers)
+        self.assertIn("405 Method Not Allowed", body)
+        self.assertIsInstance(body, str)
+
+
+    def test_remembered(self):
+        """
+        L{_http_exception_response} reuses the response to an equivalent
+        routing exception.
+        """
+        self.assertIdentical(_http_exception_response(NotFound()),
+                             _http_exception_response(NotFound()))
+        self.assertNotIdentical(
+            _http_exception_response(MethodNotAllowed(['GET'])),
+            _http_exception_response(MethodNotAllowed(['POST'])))
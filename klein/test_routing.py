@@ -0,0 +1,429 @@
+from twisted.trial import unittest
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.routing import Map, Rule, RequestRedirect, BuildError
+from werkzeug.exceptions import NotFound, MethodNotAllowed
+
+from klein import Klein
+from klein.resource import KleinResource
+from klein.routing import CompiledRouter, AdapterCache
+from klein.test_resource import requestMock, _render
+
+
+class CompiledRouterTests(unittest.TestCase):
+    def assertMatchesLikeWerkzeug(self, url_map, path, method="GET"):
+        """
+        Assert that L{CompiledRouter.match} gives the same answer as
+        werkzeug for C{path}, or defers to werkzeug.
+        """
+        router = CompiledRouter(url_map)
+        adapter = url_map.bind("localhost")
+
+        result = router.match(path, method)
+
+        try:
+            expected = adapter.match(path, method, return_rule=True)
+        except (NotFound, MethodNotAllowed, RequestRedirect):
+            self.assertIdentical(result, None)
+        else:
+            if result is not None:
+                self.assertIdentical(result[0], expected[0])
+                self.assertEqual(result[1], expected[1])
+
+        return result
+
+
+    def test_static(self):
+        """
+        Rules without converters are matched by path.
+        """
+        url_map = Map([Rule("/", endpoint="root"),
+                       Rule("/foo", endpoint="foo"),
+                       Rule("/foo/bar", endpoint="bar")])
+
+        for path in ["/", "/foo", "/foo/bar"]:
+            rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, path)
+            self.assertEqual(rule.rule, path)
+            self.assertEqual(kwargs, {})
+
+
+    def test_converters(self):
+        """
+        Rules with converters are matched with their converted arguments.
+        """
+        url_map = Map([Rule("/foo/<int:bar>", endpoint="int"),
+                       Rule("/foo/<bar>", endpoint="string"),
+                       Rule("/<a>/<b>", endpoint="both"),
+                       Rule("/file.<ext>", endpoint="ext")])
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/foo/1")
+        self.assertEqual((rule.endpoint, kwargs), ("int", {"bar": 1}))
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/foo/x")
+        self.assertEqual((rule.endpoint, kwargs), ("string", {"bar": u"x"}))
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/x/y")
+        self.assertEqual(kwargs, {"a": u"x", "b": u"y"})
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/file.txt")
+        self.assertEqual((rule.endpoint, kwargs), ("ext", {"ext": u"txt"}))
+
+
+    def test_branch(self):
+        """
+        Path converters consume the rest of the URL.
+        """
+        url_map = Map([Rule("/static/", endpoint="static"),
+                       Rule("/static/<path:__rest__>", endpoint="branch"),
+                       Rule("/static/special", endpoint="special")])
+
+        for path in ["/static/", "/static/special", "/static/a/b/c"]:
+            self.assertMatchesLikeWerkzeug(url_map, path)
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/static/a/b")
+        self.assertEqual(kwargs, {"__rest__": u"a/b"})
+
+
+    def test_methods(self):
+        """
+        Rules which don't allow the request method are skipped, and if no
+        rule allows it werkzeug is asked to raise L{MethodNotAllowed}.
+        """
+        url_map = Map([Rule("/", endpoint="post", methods=["POST"]),
+                       Rule("/", endpoint="get"),
+                       Rule("/only", endpoint="only", methods=["GET"])])
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/", "POST")
+        self.assertEqual(rule.endpoint, "post")
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/", "get")
+        self.assertEqual(rule.endpoint, "get")
+
+        self.assertIdentical(
+            self.assertMatchesLikeWerkzeug(url_map, "/only", "DELETE"), None)
+
+
+    def test_strictSlashes(self):
+        """
+        A path which werkzeug would redirect to add a trailing slash is
+        deferred to werkzeug, even if a later rule would match it.
+        """
+        url_map = Map([Rule("/foo/", endpoint="foo"),
+                       Rule("/<name>", endpoint="name"),
+                       Rule("/bar/<int:x>/", endpoint="bar"),
+                       Rule("/baz/", endpoint="baz", strict_slashes=False)])
+
+        self.assertIdentical(
+            self.assertMatchesLikeWerkzeug(url_map, "/foo"), None)
+        self.assertIdentical(
+            self.assertMatchesLikeWerkzeug(url_map, "/bar/1"), None)
+
+        rule, kwargs = self.assertMatchesLikeWerkzeug(url_map, "/baz")
+        self.assertEqual(rule.endpoint, "baz")
+
+
+    def test_notFound(self):
+        """
+        L{CompiledRouter.match} returns C{None} if nothing matches.
+        """
+        url_map = Map([Rule("/foo/<int:x>", endpoint="foo")])
+
+        for path in ["/", "/foo", "/foo/bar", "/bar/1"]:
+            self.assertIdentical(
+                self.assertMatchesLikeWerkzeug(url_map, path), None)
+
+
+    def test_redirects(self):
+        """
+        Rules werkzeug would answer with a redirect are deferred to werkzeug.
+        """
+        url_map = Map([Rule("/old", redirect_to="/new"),
+                       Rule("/page/", endpoint="page", defaults={"n": 1}),
+                       Rule("/page/<int:n>", endpoint="page")])
+
+        for path in ["/old", "/page/1", "/page/2"]:
+            self.assertMatchesLikeWerkzeug(url_map, path)
+
+        self.assertIdentical(CompiledRouter(url_map).match("/old", "GET"),
+                             None)
+        self.assertIdentical(CompiledRouter(url_map).match("/page/1", "GET"),
+                             None)
+
+
+    def test_subdomains(self):
+        """
+        Maps with subdomain rules are always deferred to werkzeug.
+        """
+        url_map = Map([Rule("/", endpoint="root", subdomain="www")])
+        self.assertIdentical(CompiledRouter(url_map).match("/", "GET"), None)
+
+
+    def test_invalidate(self):
+        """
+        Rules added after L{CompiledRouter.invalidate} are matched.
+        """
+        url_map = Map([Rule("/foo", endpoint="foo")])
+        router = CompiledRouter(url_map)
+        self.assertIdentical(router.match("/bar", "GET"), None)
+
+        url_map.add(Rule("/bar", endpoint="bar"))
+        router.invalidate()
+
+        rule, kwargs = router.match("/bar", "GET")
+        self.assertEqual(rule.endpoint, "bar")
+
+
+    def buildSnapshotMap(self, extra=()):
+        """
+        Build a L{Map} with a mix of rules to take snapshots of.
+        """
+        return Map([Rule("/", endpoint="root"),
+                    Rule("/foo/", endpoint="foo"),
+                    Rule("/foo/<int:x>", endpoint="foo"),
+                    Rule("/foo/<x>", endpoint="foo_name"),
+                    Rule("/bar/<path:rest>", endpoint="bar"),
+                    Rule("/old", redirect_to="/foo/")] + list(extra))
+
+
+    def test_snapshot(self):
+        """
+        A snapshot from L{CompiledRouter.snapshot} can be restored on a map
+        with the same rules, which then matches and builds like werkzeug
+        without being compiled.
+        """
+        snapshot = CompiledRouter(self.buildSnapshotMap()).snapshot()
+
+        url_map = self.buildSnapshotMap()
+        router = CompiledRouter(url_map)
+        self.assertTrue(router.restore(snapshot))
+        router.compile = lambda: self.fail("compiled")
+
+        expected = self.buildSnapshotMap()
+        expected.update()
+        self.assertEqual([(r.rule, r.endpoint) for r in url_map._rules],
+                         [(r.rule, r.endpoint) for r in expected._rules])
+        self.assertEqual(
+            [r.rule for r in url_map._rules_by_endpoint["foo"]],
+            [r.rule for r in expected._rules_by_endpoint["foo"]])
+
+        for path in ["/", "/foo/", "/foo/1", "/foo/x", "/bar/a/b", "/old"]:
+            self.assertEqual(router.match(path, "GET"),
+                             CompiledRouter(expected).match(path, "GET"))
+        self.assertEqual(url_map.bind("localhost").build("foo", {"x": 1}),
+                         "/foo/1")
+        self.assertEqual(router.snapshot(), snapshot)
+
+
+    def test_snapshotDifferentRules(self):
+        """
+        L{CompiledRouter.restore} refuses snapshots of different rules, or of
+        the same rules added in a different order.
+        """
+        snapshot = CompiledRouter(self.buildSnapshotMap()).snapshot()
+
+        url_map = self.buildSnapshotMap([Rule("/baz", endpoint="baz")])
+        router = CompiledRouter(url_map)
+        self.assertFalse(router.restore(snapshot))
+        rule, kwargs = router.match("/baz", "GET")
+        self.assertEqual(rule.endpoint, "baz")
+
+        url_map = Map([rule.empty()
+                       for rule in reversed(self.buildSnapshotMap()._rules)])
+        self.assertFalse(CompiledRouter(url_map).restore(snapshot))
+
+
+    def test_saveLoad(self):
+        """
+        L{CompiledRouter.save} writes a snapshot which L{CompiledRouter.load}
+        restores.  Missing and corrupt files aren't loaded.
+        """
+        path = self.mktemp()
+        self.assertFalse(CompiledRouter(self.buildSnapshotMap()).load(path))
+
+        CompiledRouter(self.buildSnapshotMap()).save(path)
+        router = CompiledRouter(self.buildSnapshotMap())
+        self.assertTrue(router.load(path))
+        rule, kwargs = router.match("/foo/1", "GET")
+        self.assertEqual((rule.endpoint, kwargs), ("foo", {"x": 1}))
+
+        with open(path, "wb") as f:
+            f.write("garbage")
+        self.assertFalse(CompiledRouter(self.buildSnapshotMap()).load(path))
+
+
+
+class AdapterCacheTests(unittest.TestCase):
+    def test_reused(self):
+        """
+        L{AdapterCache.bind} returns the same adapter for the same arguments
+        and different adapters for different ones.
+        """
+        cache = AdapterCache(Map([Rule("/foo", endpoint="foo")]))
+
+        adapter = cache.bind("localhost", "/", "http", "GET")
+        self.assertIdentical(cache.bind("localhost", "/", "http", "GET"),
+                             adapter)
+        self.assertNotIdentical(cache.bind("localhost", "/", "https", "GET"),
+                                adapter)
+        self.assertNotIdentical(cache.bind("localhost", "/", "http", "POST"),
+                                adapter)
+        self.assertEqual(len(cache), 3)
+
+        self.assertEqual(adapter.match("/foo"), ("foo", {}))
+        self.assertEqual(adapter.build("foo", force_external=True),
+                         "http://localhost/foo")
+
+
+    def test_bounded(self):
+        """
+        L{AdapterCache} never holds more adapters than its size.
+        """
+        cache = AdapterCache(Map(), size=2)
+        for host in ["a", "b", "c", "d"]:
+            cache.bind(host, "/", "http", "GET")
+        self.assertEqual(len(cache), 2)
+
+
+    def test_clear(self):
+        """
+        L{AdapterCache.clear} discards all adapters.
+        """
+        cache = AdapterCache(Map())
+        adapter = cache.bind("localhost", "/", "http", "GET")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertNotIdentical(cache.bind("localhost", "/", "http", "GET"),
+                                adapter)
+
+
+    def test_buildCached(self):
+        """
+        L{AdapterCache.build} builds URLs like werkzeug and remembers them.
+        """
+        cache = AdapterCache(Map([Rule("/foo/<x>", endpoint="foo")]))
+        bind_args = ("localhost", "/", "http", "GET")
+
+        self.assertEqual(cache.build(bind_args, "foo", {"x": "a"}), "/foo/a")
+        self.assertEqual(cache._urls.misses, 1)
+        self.assertEqual(cache.build(bind_args, "foo", {"x": "a"}), "/foo/a")
+        self.assertEqual(cache._urls.hits, 1)
+
+        self.assertEqual(cache.build(bind_args, "foo", {"x": "a"},
+                                     force_external=True),
+                         "http://localhost/foo/a")
+        self.assertEqual(
+            cache.build(("example.com", "/", "https", "GET"), "foo",
+                        {"x": "a"}, force_external=True),
+            "https://example.com/foo/a")
+
+        cache.clear()
+        self.assertEqual(len(cache._urls), 0)
+
+
+    def test_buildValueTypes(self):
+        """
+        Values which compare equal but have different types don't share a
+        cached URL.
+        """
+        cache = AdapterCache(Map([Rule("/foo/<x>", endpoint="foo")]))
+        bind_args = ("localhost", "/", "http", "GET")
+
+        self.assertEqual(cache.build(bind_args, "foo", {"x": 1}), "/foo/1")
+        self.assertEqual(cache.build(bind_args, "foo", {"x": True}),
+                         "/foo/True")
+        self.assertEqual(cache.build(bind_args, "foo", {"x": 1.0}),
+                         "/foo/1.0")
+
+
+    def test_buildUncacheable(self):
+        """
+        URLs built from unhashable values or a C{MultiDict} are built every
+        time rather than cached.
+        """
+        cache = AdapterCache(Map([Rule("/foo", endpoint="foo")]))
+        bind_args = ("localhost", "/", "http", "GET")
+
+        self.assertEqual(cache.build(bind_args, "foo", {"x": ["a", "b"]}),
+                         "/foo?x=a&x=b")
+        values = MultiDict([("x", "a"), ("x", "b")])
+        self.assertEqual(cache.build(bind_args, "foo", values),
+                         cache.bind(*bind_args).build("foo", values))
+        self.assertEqual(len(cache._urls), 0)
+
+
+    def test_buildErrorNotCached(self):
+        """
+        L{AdapterCache.build} raises C{BuildError} for URLs which can't be
+        built, every time.
+        """
+        cache = AdapterCache(Map([Rule("/foo", endpoint="foo")]))
+        bind_args = ("localhost", "/", "http", "GET")
+
+        self.assertRaises(BuildError, cache.build, bind_args, "bar")
+        self.assertRaises(BuildError, cache.build, bind_args, "bar")
+
+
+
+class CompiledRoutingResourceTests(unittest.TestCase):
+    """
+    Tests for L{KleinResource} when the application uses compiled routing.
+    """
+    def setUp(self):
+        self.app = Klein(compiled_routing=True)
+        self.kr = KleinResource(self.app)
+
+
+    def render(self, path, method="GET"):
+        request = requestMock(path, method=method)
+        self.successResultOf(_render(self.kr, request))
+        return request
+
+
+    def test_routing(self):
+        """
+        Requests are routed to the endpoints whose rules they match, with the
+        values of their converters.
+        """
+        app = self.app
+
+        @app.route("/")
+        def root(request):
+            return 'root'
+
+        @app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            return 'foo %d' % (bar,)
+
+        @app.route("/files/", branch=True)
+        def files(request):
+            return '/'.join(request.postpath)
+
+        self.render("/").assertWritten('root')
+        self.render("/foo/3").assertWritten('foo 3')
+        self.render("/files/a/b").assertWritten('a/b')
+
+
+    def test_notMatched(self):
+        """
+        Requests which match no rule are answered with C{404 Not Found}, and
+        requests whose method no rule allows with C{405 Method Not Allowed}.
+        """
+        @self.app.route("/foo", methods=['GET'])
+        def foo(request):
+            return 'foo'
+
+        self.assertEqual(self.render("/bar").code, 404)
+        self.assertEqual(self.render("/foo", method="POST").code, 405)
+
+
+    def test_mapperNotBound(self):
+        """
+        Matching a request with compiled routing doesn't bind a mapper for
+        it.
+        """
+        @self.app.route("/foo/<int:bar>")
+        def foo(request, bar):
+            return 'foo'
+
+        self.render('/foo/1').assertWritten('foo')
+        self.assertEqual(len(self.app._adapters), 0)
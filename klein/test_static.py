@@ -0,0 +1,236 @@
+import os
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.abstract import FileDescriptor
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.web import server
+
+from klein import Klein, static
+from klein.static import StaticFile, _sendfile_transport
+from klein.test_resource import requestMock, _render
+
+
+class StaticFileTests(unittest.TestCase):
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.content = "".join([chr(i % 256) for i in range(1000)])
+        self.root.child("data.bin").setContent(self.content)
+        self.root.child("empty.txt").setContent("")
+
+        self.app = Klein()
+        self.etags = {}
+
+        @self.app.route("/", branch=True)
+        def root(request):
+            return StaticFile(self.root.path, etags=self.etags)
+
+        self.resource = self.app.resource()
+
+
+    def render(self, path, method="GET", **headers):
+        request = requestMock(path, method=method, headers=dict(
+            [(name.replace('_', '-'), [value])
+             for name, value in headers.items()]))
+        self.successResultOf(_render(self.resource, request))
+        return request
+
+
+    def test_mapped(self):
+        """
+        Files are written from a memory map of them, with an entity tag.
+        """
+        request = self.render("/data.bin")
+        request.assertWritten(self.content)
+        request.assertFinishedOnce()
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'),
+            ['1000'])
+
+        stat = os.stat(self.root.child("data.bin").path)
+        self.assertEqual(request.etag, '"%x-%x-%x"' % (
+            stat.st_ino, stat.st_size, int(stat.st_mtime)))
+
+
+    def test_chunks(self):
+        """
+        Files larger than a chunk are written a chunk at a time.
+        """
+        self.patch(static._MmapProducer, 'chunk_size', 300)
+        request = self.render("/data.bin")
+        request.assertWritten(self.content)
+        self.assertEqual(request._writeCalled, 4)
+
+
+    def test_empty(self):
+        """
+        Empty files are finished without being mapped.
+        """
+        request = self.render("/empty.txt")
+        request.assertWritten("")
+        request.assertFinishedOnce()
+
+
+    def test_range(self):
+        """
+        A request for a single byte range gets just those bytes, and one for
+        several ranges is answered by L{File}.
+        """
+        request = self.render("/data.bin", Range="bytes=10-19")
+        self.assertEqual(request.code, 206)
+        request.assertWritten(self.content[10:20])
+
+        request = self.render("/data.bin", Range="bytes=-5")
+        request.assertWritten(self.content[-5:])
+
+        request = self.render("/data.bin", Range="bytes=0-1,5-6")
+        self.assertEqual(request.code, 206)
+        written = request._written.getvalue()
+        self.assertIn(self.content[0:2], written)
+        self.assertIn("multipart/byteranges",
+                      request.responseHeaders.getRawHeaders(
+                          'content-type')[0])
+
+
+    def test_notModified(self):
+        """
+        A conditional request for a file the client has is answered with
+        C{304 Not Modified}, using precomputed entity tags where given.
+        """
+        etag = self.render("/data.bin").etag
+        request = self.render("/data.bin", If_None_Match=etag)
+        self.assertEqual(request.code, 304)
+        request.assertWritten("")
+
+        self.etags[self.root.child("data.bin").path] = '"sha-1"'
+        request = self.render("/data.bin", If_None_Match=etag)
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.etag, '"sha-1"')
+
+        request = self.render("/data.bin", If_None_Match='"sha-1"')
+        self.assertEqual(request.code, 304)
+
+
+    def test_head(self):
+        """
+        A C{HEAD} request gets the headers without the file.
+        """
+        request = self.render("/data.bin", method="HEAD")
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders('content-length'),
+            ['1000'])
+        self.assertEqual(request._written.getvalue(), "")
+
+
+
+class Collector(protocol.Protocol):
+    def connectionMade(self):
+        self.data = []
+        self.transport.write(self.factory.request)
+
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+
+    def connectionLost(self, reason):
+        self.factory.done.callback("".join(self.data))
+
+
+
+class SendfileTests(unittest.TestCase):
+    """
+    Tests for sending files over real TCP connections with C{sendfile(2)},
+    or an equivalent of it where it isn't available.
+    """
+    def setUp(self):
+        self.calls = []
+
+        def sendfile(out_fd, in_fd, offset, count):
+            self.calls.append((offset, count))
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            return os.write(out_fd, os.read(in_fd, min(count, 65536)))
+
+        self.patch(static, '_sendfile', sendfile)
+
+        path = FilePath(self.mktemp())
+        self.content = os.urandom(512 * 1024)
+        path.setContent(self.content)
+
+        app = Klein()
+
+        @app.route("/file")
+        def file(request):
+            return StaticFile(path.path)
+
+        self.port = reactor.listenTCP(0, server.Site(app.resource()),
+                                      interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+
+    def get(self, *headers):
+        factory = protocol.ClientFactory()
+        factory.protocol = Collector
+        factory.request = "\r\n".join(
+            ("GET /file HTTP/1.0",) + headers + ("", ""))
+        factory.done = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.port.getHost().port, factory)
+        return factory.done.addCallback(lambda data: data.split("\r\n\r\n", 1))
+
+
+    def test_sendfile(self):
+        """
+        Files are sent to plain TCP connections with C{sendfile(2)}, after
+        the response headers.
+        """
+        def check((headers, body)):
+            self.assertIn("200 OK", headers)
+            self.assertIn("Content-Length: %d" % (len(self.content),), headers)
+            self.assertEqual(body, self.content)
+            self.assertEqual(self.calls[0], (0, len(self.content)))
+            self.assertTrue(len(self.calls) > 1)
+
+        return self.get().addCallback(check)
+
+
+    def test_range(self):
+        """
+        Single byte ranges are sent with C{sendfile(2)} too.
+        """
+        def check((headers, body)):
+            self.assertIn("206 Partial Content", headers)
+            self.assertEqual(body, self.content[100:200100])
+            self.assertEqual(self.calls[0], (100, 200000))
+
+        return self.get("Range: bytes=100-200099").addCallback(check)
+
+
+
+class SendfileTransportTests(unittest.TestCase):
+    """
+    Tests for L{_sendfile_transport}.
+    """
+    def setUp(self):
+        self.patch(static, '_sendfile', lambda *args: 0)
+        self.transport = FileDescriptor(reactor)
+        self.transport.fileno = lambda: 0
+        self.request = requestMock("/")
+        self.request.channel.transport = self.transport
+
+
+    def test_fileDescriptor(self):
+        """
+        Files can be sent to the socket of a L{FileDescriptor}.
+        """
+        self.assertIdentical(_sendfile_transport(self.request),
+                             self.transport)
+
+
+    def test_unknownBuffer(self):
+        """
+        Files aren't sent to a transport which doesn't say how much data it
+        holds, since they could be sent before that data.
+        """
+        del self.transport._tempDataLen
+        self.assertIdentical(_sendfile_transport(self.request), None)
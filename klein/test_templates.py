@@ -0,0 +1,178 @@
+import os
+
+from twisted.trial import unittest
+
+from twisted.python.filepath import FilePath
+from twisted.web.template import (CharRef, Element, XMLString, flattenString,
+                                  renderer, tags)
+
+from klein.templates import (LoaderCache, FragmentCache, CachedFragment,
+                             cached_renderer)
+
+
+class LoaderCacheTests(unittest.TestCase):
+    def test_file(self):
+        """
+        L{LoaderCache.file} returns the same loader for the same path, whether
+        it is given as a C{str} or a L{FilePath}.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent("<p>hello</p>")
+        cache = LoaderCache()
+
+        loader = cache.file(path.path)
+        self.assertIdentical(cache.file(path), loader)
+        self.assertEqual(loader.load()[0].children, [u"hello"])
+
+
+    def test_autoReload(self):
+        """
+        A L{LoaderCache} with C{auto_reload} set parses a template again once
+        its file has been modified.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent("<p>hello</p>")
+        cache = LoaderCache(auto_reload=True)
+
+        loader = cache.file(path)
+        self.assertIdentical(cache.file(path), loader)
+
+        path.setContent("<p>goodbye</p>")
+        modified = path.getModificationTime() + 10
+        os.utime(path.path, (modified, modified))
+
+        loader = cache.file(path)
+        self.assertEqual(loader.load()[0].children, [u"goodbye"])
+
+
+    def test_string(self):
+        """
+        L{LoaderCache.string} returns the same loader for the same source.
+        """
+        cache = LoaderCache()
+        loader = cache.string("<p>hello</p>")
+        self.assertIdentical(cache.string("<p>hello</p>"), loader)
+        self.assertNotIdentical(cache.string("<p>goodbye</p>"), loader)
+
+        cache.clear()
+        self.assertNotIdentical(cache.string("<p>hello</p>"), loader)
+
+
+
+class FragmentCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = FragmentCache(size=2, seconds=lambda: self.now)
+
+
+    def test_expires(self):
+        """
+        Fragments cached with a C{ttl} are discarded once it has passed.
+        """
+        self.cache.set("a", "<p>a</p>", None, ttl=10)
+        self.cache.set("b", "<p>b</p>", None)
+
+        self.now += 9
+        self.assertEqual(self.cache.get("a"), ("<p>a</p>", None))
+
+        self.now += 1
+        self.assertIdentical(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("b"), ("<p>b</p>", None))
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+
+    def test_invalidate(self):
+        """
+        L{FragmentCache.invalidate} discards a fragment.
+        """
+        self.cache.set("a", "<p>a</p>", None)
+        self.cache.invalidate("a")
+        self.cache.invalidate("b")
+        self.assertIdentical(self.cache.get("a"), None)
+
+
+
+class CachedElement(Element):
+    loader = XMLString("""
+    <div xmlns:t="http://twistedmatrix.com/ns/twisted.web.template/0.1">
+    <p t:render="cached" /><p t:render="uncached" />
+    </div>
+    """)
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    @renderer
+    def uncached(self, request, tag):
+        return tag(str(len(self.calls)))
+
+    @renderer
+    @cached_renderer("key")
+    def cached(self, request, tag):
+        self.calls.append(tag)
+        return tag(u"<&> \u2202", tags.br(), class_="x")
+
+
+
+class CachedFragmentTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = FragmentCache()
+        self.calls = []
+
+
+    def produce(self):
+        self.calls.append(None)
+        return tags.p(u"<hello>")
+
+
+    def test_flatten(self):
+        """
+        L{CachedFragment.flatten} flattens what C{produce} returns the first
+        time, and returns what it flattened to afterwards.
+        """
+        fragment = CachedFragment("key", self.produce, cache=self.cache)
+        d = fragment.flatten(None)
+        self.assertEqual(self.successResultOf(d), "<p>&lt;hello&gt;</p>")
+
+        fragment = CachedFragment("key", self.produce, cache=self.cache)
+        self.assertEqual(fragment.flatten(None), "<p>&lt;hello&gt;</p>")
+        self.assertEqual(len(self.calls), 1)
+
+
+    def test_nested(self):
+        """
+        A fragment cached by L{cached_renderer} is flattened the same way
+        from the cache as it was by its renderer.
+        """
+        import klein.templates
+        self.patch(klein.templates, "fragments", self.cache)
+
+        first = self.successResultOf(
+            flattenString(None, CachedElement(self.calls)))
+        second = self.successResultOf(
+            flattenString(None, CachedElement(self.calls)))
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(first.replace(">0<", ">1<"), second)
+        self.assertIn('<p class="x">&lt;&amp;&gt; \xe2\x88\x82<br /></p>',
+                      second)
+
+
+    def test_unparsable(self):
+        """
+        A fragment which can't be parsed once flattened is rendered again
+        every time it is nested in a document, but is still written from the
+        cache when it is the whole response.
+        """
+        def produce():
+            self.calls.append(None)
+            return tags.p(CharRef(0))
+
+        fragment = CachedFragment("key", produce, cache=self.cache)
+        self.assertEqual(self.successResultOf(flattenString(None, fragment)),
+                         "<p>&#0;</p>")
+        self.assertEqual(fragment.flatten(None), "<p>&#0;</p>")
+        self.assertEqual(self.successResultOf(flattenString(None, fragment)),
+                         "<p>&#0;</p>")
+        self.assertEqual(len(self.calls), 3)
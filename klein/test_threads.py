@@ -0,0 +1,90 @@
+import threading
+
+from twisted.internet import reactor
+from twisted.trial import unittest
+
+from klein.threads import ThreadPools
+
+
+class TriggerRecordingReactor(object):
+    """
+    The global reactor, except that shutdown triggers are recorded rather
+    than added.
+    """
+    def __init__(self):
+        self.triggers = []
+
+
+    def callFromThread(self, f, *args, **kwargs):
+        return reactor.callFromThread(f, *args, **kwargs)
+
+
+    def addSystemEventTrigger(self, phase, event, f, *args):
+        self.triggers.append((phase, event, f, args))
+
+
+
+class ThreadPoolsTests(unittest.TestCase):
+    def setUp(self):
+        self.reactor = TriggerRecordingReactor()
+        self.pools = ThreadPools({"db": 1}, default_size=3,
+                                 reactor=self.reactor)
+        self.addCleanup(self.pools.stop)
+
+
+    def test_run(self):
+        """
+        L{ThreadPools.run} calls a function in a thread of the named pool.
+        """
+        d = self.pools.run("db", lambda x, y: (threading.current_thread(),
+                                                x + y), 1, y=2)
+
+        def check((thread, result)):
+            self.assertNotIdentical(thread, threading.current_thread())
+            self.assertIn("klein-db", thread.name)
+            self.assertEqual(result, 3)
+
+        return d.addCallback(check)
+
+
+    def test_pools(self):
+        """
+        Pools are created once for each name, with their own size or the
+        default one, and are stopped when the reactor shuts down.
+        """
+        db = self.pools.get("db")
+        self.assertIdentical(self.pools.get("db"), db)
+        self.assertEqual(db.max, 1)
+        self.assertEqual(self.pools.get("other").max, 3)
+        self.assertTrue(db.started)
+
+        [(phase, event, stop, args)] = self.reactor.triggers[:1]
+        self.assertEqual((phase, event), ('during', 'shutdown'))
+        stop(*args)
+        self.assertTrue(db.joined)
+        self.assertNotIdentical(self.pools.get("db"), db)
+
+
+    def test_stats(self):
+        """
+        L{ThreadPools.stats} counts the calls waiting for a thread and the
+        threads running them.
+        """
+        self.assertEqual(self.pools.stats("db").size, 1)
+        self.assertEqual(self.pools.stats("db").working, 0)
+
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        first = self.pools.run("db", block)
+        second = self.pools.run("db", lambda: None)
+        started.wait()
+
+        stats = self.pools.stats("db")
+        self.assertEqual((stats.queued, stats.working, stats.idle,
+                          stats.size), (1, 1, 0, 1))
+        release.set()
+        return first.addCallback(lambda ignored: second)
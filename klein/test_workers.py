@@ -0,0 +1,199 @@
+import os
+import socket
+
+from zope.interface import implements
+
+from twisted.internet import error
+from twisted.internet.interfaces import IReactorSocket
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from klein import workers
+
+
+class FakeProcess(object):
+    def __init__(self, protocol, executable, args, env, childFDs):
+        self.protocol = protocol
+        self.executable = executable
+        self.args = args
+        self.env = env
+        self.childFDs = childFDs
+        self.signals = []
+        self.exited = False
+
+
+    def signalProcess(self, name):
+        if self.exited:
+            raise error.ProcessExitedAlready()
+        self.signals.append(name)
+
+
+    def exit(self, reason=error.ProcessDone(0)):
+        self.exited = True
+        self.protocol.processEnded(Failure(reason))
+
+
+
+class FakeReactor(Clock):
+    implements(IReactorSocket)
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.processes = []
+        self.running = []
+        self.triggers = []
+        self.adopted = []
+
+
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        process = FakeProcess(protocol, executable, args, env, childFDs)
+        self.processes.append(process)
+        return process
+
+
+    def callWhenRunning(self, f, *args):
+        self.running.append((f, args))
+
+
+    def addSystemEventTrigger(self, phase, event, f):
+        self.triggers.append((phase, event, f))
+
+
+    def adoptStreamPort(self, fd, family, factory):
+        self.adopted.append((os.fstat(fd), family, factory))
+        return "port"
+
+
+    def run(self):
+        for f, args in self.running:
+            f(*args)
+
+
+
+class ServeTests(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.factory = object()
+
+
+    def serve(self, count=2, **kwargs):
+        supervisor = workers.serve(self.reactor, self.factory, "127.0.0.1", 0,
+                                   count, argv=["python", "app.py"],
+                                   environ={"PATH": "/bin"}, **kwargs)
+        self.addCleanup(supervisor._socket.close)
+        return supervisor
+
+
+    def test_spawn(self):
+        """
+        L{workers.serve} creates a listening socket and, once the reactor
+        runs, starts the workers with it as their file descriptor 3.
+        """
+        supervisor = self.serve()
+        sock = supervisor._socket
+        self.assertEqual(self.reactor.processes, [])
+
+        self.reactor.run()
+        self.assertEqual(len(self.reactor.processes), 2)
+        for process in self.reactor.processes:
+            self.assertEqual(process.args, ["python", "app.py"])
+            self.assertEqual(process.childFDs[3], sock.fileno())
+            self.assertEqual(process.env, {
+                "PATH": "/bin", "KLEIN_WORKER_FD": "3",
+                "KLEIN_WORKER_FAMILY": str(socket.AF_INET)})
+
+        self.assertNotEqual(sock.getsockname()[1], 0)
+        self.assertEqual(self.reactor.triggers,
+                         [("before", "shutdown", supervisor.stop)])
+
+
+    def test_restart(self):
+        """
+        A worker which exits is started again after C{restart_delay}.
+        """
+        supervisor = self.serve()
+        self.reactor.run()
+
+        self.reactor.processes[0].exit(error.ProcessTerminated(1))
+        self.assertEqual(len(self.reactor.processes), 2)
+
+        self.reactor.advance(supervisor.restart_delay)
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertEqual(sorted(supervisor._processes.values()),
+                         sorted(self.reactor.processes[1:]))
+
+
+    def test_stop(self):
+        """
+        Stopping the supervisor asks the workers to exit, cancels pending
+        restarts and fires once every worker has exited.
+        """
+        supervisor = self.serve(count=3)
+        self.reactor.run()
+        first, second, third = self.reactor.processes
+        third.exit()
+
+        d = supervisor.stop()
+        self.assertEqual(first.signals, ["TERM"])
+        self.assertEqual(second.signals, ["TERM"])
+
+        first.exit()
+        self.assertNoResult(d)
+        second.exit()
+        self.successResultOf(d)
+
+        self.reactor.advance(supervisor.stop_timeout)
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertEqual(first.signals, ["TERM"])
+
+
+    def test_kill(self):
+        """
+        Workers which haven't exited C{stop_timeout} seconds after being
+        asked to are killed.
+        """
+        supervisor = self.serve(count=1)
+        self.reactor.run()
+        [process] = self.reactor.processes
+
+        d = supervisor.stop()
+        self.reactor.advance(supervisor.stop_timeout)
+        self.assertEqual(process.signals, ["TERM", "KILL"])
+        process.exit(error.ProcessTerminated(signal=9))
+        self.successResultOf(d)
+
+
+    def test_stopWithoutWorkers(self):
+        """
+        Stopping a supervisor without workers doesn't wait for anything.
+        """
+        self.assertIdentical(self.serve().stop(), None)
+
+
+    def test_worker(self):
+        """
+        In a worker, L{workers.serve} adopts the listening socket it was
+        given and closes its own copy of it.
+        """
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        fd = os.dup(sock.fileno())
+
+        port = workers.serve(self.reactor, self.factory, "127.0.0.1", 0, 2,
+                             environ={"KLEIN_WORKER_FD": str(fd),
+                                      "KLEIN_WORKER_FAMILY": "2"})
+        self.assertEqual(port, "port")
+        [(stat, family, factory)] = self.reactor.adopted
+        self.assertEqual(stat, os.fstat(sock.fileno()))
+        self.assertEqual((family, factory), (2, self.factory))
+        self.assertRaises(OSError, os.fstat, fd)
+
+
+    def test_unsupported(self):
+        """
+        L{workers.serve} raises L{NotImplementedError} for reactors which
+        can't adopt sockets.
+        """
+        self.assertRaises(NotImplementedError, workers.serve, Clock(),
+                          self.factory, "127.0.0.1", 0, 2)
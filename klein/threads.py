@@ -0,0 +1,107 @@
+"""
+Thread pools for running endpoints which block.
+"""
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+__all__ = ["ThreadPools", "ThreadPoolStats"]
+
+
+class ThreadPoolStats(object):
+    """
+    A snapshot of how busy a thread pool is.
+
+    @ivar queued: The number of calls waiting for a thread.
+    @ivar working: The number of threads running a call.
+    @ivar idle: The number of threads waiting for a call.
+    @ivar size: The most threads the pool runs.
+    """
+    __slots__ = ('queued', 'working', 'idle', 'size')
+
+    def __init__(self, queued, working, idle, size):
+        self.queued = queued
+        self.working = working
+        self.idle = idle
+        self.size = size
+
+
+    def __repr__(self):
+        return "<ThreadPoolStats queued=%d working=%d idle=%d size=%d>" % (
+            self.queued, self.working, self.idle, self.size)
+
+
+
+class ThreadPools(object):
+    """
+    Named thread pools, each running at most a given number of threads,
+    which are started when they are first used and stopped when the reactor
+    shuts down.
+
+    @ivar sizes: A C{dict} mapping the names of pools to the most threads
+        they run.
+    @ivar default_size: The most threads run by pools not in C{sizes}.
+    @ivar _reactor: The reactor the pools are started with, by default the
+        global reactor.
+    @ivar _pools: A C{dict} mapping names to the L{ThreadPool}s started.
+    """
+
+    def __init__(self, sizes=None, default_size=10, reactor=None):
+        self.sizes = dict(sizes or {})
+        self.default_size = default_size
+        self._reactor = reactor
+        self._pools = {}
+
+
+    def get(self, name):
+        """
+        Return the L{ThreadPool} named C{name}, starting it if it hasn't been.
+        """
+        pool = self._pools.get(name)
+        if pool is None:
+            if self._reactor is None:
+                from twisted.internet import reactor
+                self._reactor = reactor
+            pool = self._pools[name] = ThreadPool(
+                0, self.sizes.get(name, self.default_size),
+                "klein-%s" % (name,))
+            pool.start()
+            self._reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._stop, name, pool)
+        return pool
+
+
+    def run(self, name, f, *args, **kwargs):
+        """
+        Call C{f} with C{args} and C{kwargs} in a thread of the pool named
+        C{name}.
+
+        @return: A L{Deferred} which fires with the result of C{f}.
+        """
+        pool = self.get(name)
+        return deferToThreadPool(self._reactor, pool, f, *args, **kwargs)
+
+
+    def stats(self, name):
+        """
+        Return a L{ThreadPoolStats} for the pool named C{name}.
+        """
+        pool = self._pools.get(name)
+        if pool is None:
+            return ThreadPoolStats(
+                0, 0, 0, self.sizes.get(name, self.default_size))
+        return ThreadPoolStats(pool.q.qsize(), len(pool.working),
+                               len(pool.waiters), pool.max)
+
+
+    def stop(self):
+        """
+        Stop every pool, waiting for the calls they are running to return.
+        """
+        for name, pool in self._pools.items():
+            self._stop(name, pool)
+
+
+    def _stop(self, name, pool):
+        if self._pools.get(name) is pool:
+            del self._pools[name]
+            pool.stop()
@@ -0,0 +1,203 @@
+"""
+Serving an application from several processes sharing one listening socket.
+
+The process calling L{serve} creates the socket and runs the script it was
+started with again in each worker process, telling it through its
+environment which file descriptor the socket is.  When the script calls
+L{serve} in a worker, the socket is adopted instead of another being
+created.
+"""
+import os
+import socket
+import sys
+
+from twisted.internet import defer, error
+from twisted.internet.interfaces import IReactorSocket
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+__all__ = ["serve"]
+
+
+# The names of the environment variables telling a worker the file
+# descriptor and address family of the listening socket.
+_FD = 'KLEIN_WORKER_FD'
+_FAMILY = 'KLEIN_WORKER_FAMILY'
+
+# The file descriptor of the listening socket in workers.
+_WORKER_FD = 3
+
+
+def _listen(host, port, backlog=50):
+    """
+    Return a non-blocking socket listening on C{port} of the interface
+    C{host}.
+    """
+    family, socktype, proto, canonname, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+
+class _Worker(ProcessProtocol):
+    """
+    Tells a L{_Supervisor} when the worker process C{number} ends.
+    """
+
+    def __init__(self, supervisor, number):
+        self._supervisor = supervisor
+        self.number = number
+
+
+    def processEnded(self, reason):
+        self._supervisor._ended(self, reason)
+
+
+
+class _Supervisor(object):
+    """
+    Keeps C{count} worker processes serving from a listening socket,
+    starting a new one C{restart_delay} seconds after one exits, until it is
+    stopped.
+
+    @ivar _processes: A C{dict} mapping the numbers of the running workers to
+        their L{IProcessTransport}s.
+    @ivar _restarts: A C{dict} mapping the numbers of workers about to be
+        started again to the L{IDelayedCall}s doing it.
+    @ivar _stopped: A L{defer.Deferred} which fires once every worker has
+        exited after L{stop}, or C{None}.
+    """
+    restart_delay = 1.0
+    stop_timeout = 10.0
+
+    def __init__(self, reactor, sock, count, argv, environ):
+        self._reactor = reactor
+        self._socket = sock
+        self._count = count
+        self._argv = argv
+        self._environ = environ
+        self._processes = {}
+        self._restarts = {}
+        self._stopping = False
+        self._stopped = None
+        self._kill = None
+
+
+    def start(self):
+        """
+        Start every worker.
+        """
+        for number in range(self._count):
+            self._spawn(number)
+
+
+    def _spawn(self, number):
+        self._restarts.pop(number, None)
+        env = dict(self._environ)
+        env[_FD] = str(_WORKER_FD)
+        env[_FAMILY] = str(self._socket.family)
+        self._processes[number] = self._reactor.spawnProcess(
+            _Worker(self, number), self._argv[0], self._argv, env=env,
+            childFDs={0: 0, 1: 1, 2: 2, _WORKER_FD: self._socket.fileno()})
+
+
+    def _ended(self, worker, reason):
+        self._processes.pop(worker.number, None)
+        if self._stopping:
+            if not self._processes:
+                if self._kill is not None and self._kill.active():
+                    self._kill.cancel()
+                self._stopped.callback(None)
+            return
+
+        log.msg("Worker %d exited (%s), starting it again in %s seconds" % (
+            worker.number, reason.getErrorMessage(), self.restart_delay))
+        self._restarts[worker.number] = self._reactor.callLater(
+            self.restart_delay, self._spawn, worker.number)
+
+
+    def stop(self):
+        """
+        Ask every worker to exit, and kill those which haven't after
+        C{stop_timeout} seconds.
+
+        @return: A L{defer.Deferred} which fires once every worker has
+            exited, or C{None} if none were running.
+        """
+        self._stopping = True
+        for call in self._restarts.values():
+            call.cancel()
+        self._restarts.clear()
+
+        if not self._processes:
+            return None
+
+        self._stopped = defer.Deferred()
+        self._signal('TERM')
+        self._kill = self._reactor.callLater(
+            self.stop_timeout, self._signal, 'KILL')
+        return self._stopped
+
+
+    def _signal(self, name):
+        for process in self._processes.values():
+            try:
+                process.signalProcess(name)
+            except error.ProcessExitedAlready:
+                pass
+
+
+
+def serve(reactor, factory, host, port, workers, argv=None, environ=None):
+    """
+    Serve C{factory} on C{port} of the interface C{host} from C{workers}
+    processes, once C{reactor} runs.
+
+    The calling process creates the listening socket and runs C{argv}, by
+    default the command it was started with, in each worker.  That command
+    must call L{serve} again with the same arguments, which then adopts the
+    socket.  Workers which exit are started again, and they are all asked to
+    exit with C{SIGTERM} when the calling process shuts down.
+
+    @param factory: The L{IProtocolFactory} to serve, such as a L{Site}.
+
+    @param workers: The number of worker processes.
+    @type workers: int
+
+    @param argv: The command to run workers with, or C{None}.
+    @type argv: C{list} of C{str}
+
+    @param environ: The environment of the calling process, or C{None} for
+        C{os.environ}.
+
+    @return: The L{IListeningPort} in a worker, or the supervisor of the
+        workers in the calling process.
+
+    @raise NotImplementedError: If C{reactor} can't adopt sockets.
+    """
+    if not IReactorSocket.providedBy(reactor):
+        raise NotImplementedError(
+            "%r can't adopt listening sockets, so it can't serve from "
+            "several processes" % (reactor,))
+    if environ is None:
+        environ = os.environ
+
+    if _FD in environ:
+        fd = int(environ[_FD])
+        port = reactor.adoptStreamPort(fd, int(environ[_FAMILY]), factory)
+        # The port has a copy of it.
+        os.close(fd)
+        return port
+
+    if argv is None:
+        argv = [sys.executable] + sys.argv
+    supervisor = _Supervisor(reactor, _listen(host, port), workers, argv,
+                             environ)
+    reactor.callWhenRunning(supervisor.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    return supervisor